@@ -0,0 +1,121 @@
+"""
+合成した対象プログラムに対して ezopt の最適化を実際に回し，並列数ごとのスループット (trials/sec) と，
+各フェーズの時間（trial の user attribute `timings`）から見た ezopt 自体のオーバーヘッドを測るベンチマーク
+
+    python benchmarks/bench_end_to_end.py [--trials N] [--json OUTPUT]
+
+対象プログラム:
+- echo: ソースを読まずに `echo Score: 1` するだけのシェルコマンド（ezopt 以外のコストがほぼ 0．HP の数を変えて測る）
+- cpp: HP の値の和を出力する自明な C++ プログラム（試行ごとにビルドする）
+- cpp-compile-once: 同じプログラムを --compile-once で（一度だけビルドして）実行する
+"""
+import argparse
+import json
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from typing import Any
+
+from common import generate_source  # NOTE: ezopt を import できるよう，先に import する
+
+import optuna
+
+from ezopt.output_evaluator import OutputEvaluator
+from ezopt.source_executor import SourceExecutorPool
+from ezopt.source_parameterizer import SourceParameterizer
+from ezopt.study_conductor import BayesianOptimizationStudyConductor
+
+# 試行中のフェーズのうち，対象プログラムのビルド・実行そのものにかかる時間
+PROGRAM_PHASES = ("build", "run", "execute")
+
+
+def run_target(cmd: str, source_path: Path, n_trials: int, n_jobs: int, compile_once: bool = False) -> dict[str, Any]:
+    parameterizer = SourceParameterizer(source_path.read_text())
+    executor = SourceExecutorPool(cmd, n_workers=n_jobs)
+    conductor = BayesianOptimizationStudyConductor(parameterizer, executor, OutputEvaluator("Score: (.+)"), compile_once=compile_once)
+    start = time.perf_counter()
+    try:
+        study_result = conductor.run(n_trials=n_trials, direction="minimize")
+        elapsed_seconds = time.perf_counter() - start
+    finally:
+        # NOTE: プロセスごとのサンドボックスを残さないよう，必ず close する
+        executor.close()
+    assert study_result.study is not None
+
+    trials = study_result.study.get_trials(deepcopy=False)
+    phase_seconds: dict[str, float] = {}
+    for trial in trials:
+        for name, seconds in trial.user_attrs.get("timings", {}).items():
+            phase_seconds[name] = phase_seconds.get(name, 0.0) + seconds / len(trials)
+    program_seconds = sum(seconds for name, seconds in phase_seconds.items() if name in PROGRAM_PHASES)
+    return {
+        "n_trials": len(trials),
+        "n_failed_trials": sum(1 for t in trials if t.state != optuna.trial.TrialState.COMPLETE),
+        "elapsed_seconds": elapsed_seconds,
+        "trials_per_second": len(trials) / elapsed_seconds,
+        "phase_seconds_per_trial": phase_seconds,
+        # NOTE: 各ワーカーが 1 試行に費やした時間のうち，対象プログラムのビルド・実行以外の部分
+        # （compile-once の場合は，最初に一度だけ行うビルドの時間もここに含まれる）
+        "overhead_seconds_per_trial": elapsed_seconds * n_jobs / len(trials) - program_seconds,
+    }
+
+
+DEFAULT_N_JOBS = [1, 2, 4]
+DEFAULT_N_HPS = [10, 100, 1000]
+
+
+def run(
+    n_jobs_list: list[int] = DEFAULT_N_JOBS,
+    n_hps_list: list[int] = DEFAULT_N_HPS,
+    n_trials_echo: int = 100,
+    n_trials_cpp: int = 16,
+) -> list[dict[str, Any]]:
+    """
+    echo は n_hps_list の各 HP 数で，C++ の対象プログラムは HP 数 n_hps_list[0] でのみ測る（ビルドに時間がかかるため）
+    """
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    results: list[dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # (対象の名前, HP 数, CMD, 試行数, compile_once)
+        targets: list[tuple[str, int, str, int, bool]] = []
+        source_paths: dict[int, Path] = {}
+        for n_hps in n_hps_list:
+            source_paths[n_hps] = Path(tmp_dir) / f"target_{n_hps}.cpp"
+            source_paths[n_hps].write_text(generate_source(max(n_hps * 2, 100), n_hps, print_score=True))
+            targets.append(("echo", n_hps, f"true {source_paths[n_hps]} && echo Score: 1", n_trials_echo, False))
+        if shutil.which("g++") is not None:
+            n_hps = n_hps_list[0]
+            binary_path = Path(tmp_dir) / "target"
+            cpp_cmd = f"g++ -O0 {source_paths[n_hps]} -o {binary_path} && {binary_path}"
+            targets.append(("cpp", n_hps, cpp_cmd, n_trials_cpp, False))
+            targets.append(("cpp-compile-once", n_hps, cpp_cmd, n_trials_echo, True))
+        else:
+            print("g++ is not found: the C++ targets are skipped")
+
+        for name, n_hps, cmd, n_trials, compile_once in targets:
+            for n_jobs in n_jobs_list:
+                result = run_target(cmd, source_paths[n_hps], n_trials, n_jobs, compile_once=compile_once)
+                results.append({"target": name, "n_hps": n_hps, "n_jobs": n_jobs, **result})
+                print(
+                    f"{name:>17} HPs={n_hps:<5} jobs={n_jobs}: {result['trials_per_second']:8.2f} trials/s, "
+                    f"overhead {result['overhead_seconds_per_trial'] * 1e3:7.2f} ms/trial"
+                )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end throughput of ezopt on synthetic targets")
+    parser.add_argument("--trials", type=int, default=100, help="Number of trials for the cheap targets (the per-trial build target uses 1/6 of them)")
+    parser.add_argument("--hps", type=int, nargs="+", default=DEFAULT_N_HPS, help="Numbers of hyperparameters in the target source")
+    parser.add_argument("--json", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(n_hps_list=args.hps, n_trials_echo=args.trials, n_trials_cpp=max(1, args.trials // 6))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+OutputEvaluator の評価値抽出 (evaluate) のコストが，出力の大きさに対してどう増えるかを測るマイクロベンチマーク
+
+    python benchmarks/bench_output_evaluator.py [--json OUTPUT]
+"""
+import argparse
+import json
+from typing import Any
+
+from common import measure  # NOTE: ezopt を import できるよう，先に import する
+
+from ezopt.models import ExecutionResult
+from ezopt.output_evaluator import OutputEvaluator
+
+
+def generate_output(n_lines: int, value_every: int) -> str:
+    """
+    n_lines 行のログのうち value_every 行ごとに "Score: ..." の行を含む出力を生成する
+    """
+    return "".join(
+        f"Score: {i}\n" if i % value_every == 0 else f"iter {i} temperature {1.0 / (i + 1):.6f} best 12345\n"
+        for i in range(n_lines)
+    )
+
+
+DEFAULT_SIZES = [(n_lines, value_every) for n_lines in [1_000, 100_000, 1_000_000] for value_every in [1, 1000]]
+
+
+def run(sizes: list[tuple[int, int]] = DEFAULT_SIZES, repeat: int = 3) -> list[dict[str, Any]]:
+    evaluator = OutputEvaluator("Score: (.+)")
+    results: list[dict[str, Any]] = []
+    for n_lines, value_every in sizes:
+        output = generate_output(n_lines, value_every)
+        execution_result = ExecutionResult(stdout=output, stderr="", return_code=0)
+        seconds = measure(lambda: evaluator.evaluate(execution_result), repeat=repeat)
+        results.append({
+            "n_lines": n_lines,
+            "value_every": value_every,
+            "output_bytes": len(output),
+            "evaluate_seconds": seconds,
+            "megabytes_per_second": len(output) / seconds / 1e6,
+        })
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmark of OutputEvaluator.evaluate")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of evaluations per size")
+    parser.add_argument("--json", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(repeat=args.repeat)
+    print(f"{'lines':>9} {'every':>6} {'MB':>7} {'evaluate[ms]':>13} {'MB/s':>8}")
+    for r in results:
+        print(
+            f"{r['n_lines']:>9} {r['value_every']:>6} {r['output_bytes'] / 1e6:>7.1f} "
+            f"{r['evaluate_seconds'] * 1e3:>13.2f} {r['megabytes_per_second']:>8.1f}"
+        )
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
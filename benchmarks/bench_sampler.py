@@ -0,0 +1,71 @@
+"""
+optuna の sampler による HP の提案 (ask + suggest_*) のコストが，試行数と HP の数に対してどう増えるかを測るベンチマーク
+（目的関数は HP の値の和で，実行のコストは含まない）
+
+    python benchmarks/bench_sampler.py [--trials N] [--json OUTPUT]
+"""
+import argparse
+import json
+import time
+from typing import Any
+
+from common import generate_source  # NOTE: ezopt を import できるよう，先に import する
+
+import optuna
+
+from ezopt.models import HyperParameterWithChoices, HyperParameterWithRange
+from ezopt.source_parameterizer import SourceParameterizer
+
+
+DEFAULT_N_HPS = [10, 100]
+
+
+def run(n_hps_list: list[int] = DEFAULT_N_HPS, n_trials: int = 500, window: int = 100) -> list[dict[str, Any]]:
+    """
+    window 試行ごとに，1 試行あたりの提案にかかった平均時間を記録する
+    """
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    results: list[dict[str, Any]] = []
+    for n_hps in n_hps_list:
+        parameterizer = SourceParameterizer(generate_source(max(n_hps * 2, 100), n_hps))
+        study = optuna.create_study(direction="minimize", sampler=optuna.samplers.TPESampler(seed=0))
+        window_seconds = 0.0
+        for i in range(n_trials):
+            start = time.perf_counter()
+            trial = study.ask()
+            value = 0.0
+            for hp in parameterizer.hps:
+                if isinstance(hp, HyperParameterWithChoices):
+                    value += float(trial.suggest_categorical(hp.name, hp.choices))  # type: ignore[arg-type]
+                elif isinstance(hp, HyperParameterWithRange):
+                    value += trial.suggest_float(hp.name, hp.low, hp.high, log=hp.log)
+            window_seconds += time.perf_counter() - start
+            study.tell(trial, value)
+            if (i + 1) % window == 0:
+                results.append({
+                    "n_hps": n_hps,
+                    "trials_from": i + 1 - window,
+                    "trials_to": i + 1,
+                    "sample_seconds_per_trial": window_seconds / window,
+                })
+                window_seconds = 0.0
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of the optuna sampler cost as the number of trials grows")
+    parser.add_argument("--trials", type=int, default=500, help="Number of trials per number of hyperparameters")
+    parser.add_argument("--json", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(n_trials=args.trials)
+    print(f"{'HPs':>5} {'trials':>11} {'sample[ms/trial]':>17}")
+    for r in results:
+        print(f"{r['n_hps']:>5} {r['trials_from']:>5}-{r['trials_to']:<5} {r['sample_seconds_per_trial'] * 1e3:>17.2f}")
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
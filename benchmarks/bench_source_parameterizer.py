@@ -0,0 +1,74 @@
+"""
+SourceParameterizer の具体値埋め込み (apply_params) のコストが，ソースの行数と HP の数に対してどう増えるかを測るマイクロベンチマーク
+
+    python benchmarks/bench_source_parameterizer.py [--json OUTPUT]
+
+比較のため，HP ごとに str.replace する以前の実装 (legacy) も併せて測る
+"""
+import argparse
+import json
+import random
+from typing import Any
+
+from common import generate_source, measure, sample_values  # NOTE: ezopt を import できるよう，先に import する
+
+from ezopt.models import ChoiceType
+from ezopt.source_parameterizer import SourceParameterizer
+
+
+def legacy_apply_params(parameterizer: SourceParameterizer, values: tuple[ChoiceType, ...]) -> str:
+    source = parameterizer.source
+    for hp, value in zip(parameterizer.hps, values):
+        source = source.replace(hp.hash, SourceParameterizer._to_cpp_repr(value))
+    return source
+
+
+DEFAULT_SIZES = [(n_lines, n_hps) for n_lines in [500, 5000] for n_hps in [10, 100, 1000] if n_hps <= n_lines]
+
+
+def run(sizes: list[tuple[int, int]] = DEFAULT_SIZES, n_variants: int = 200) -> list[dict[str, Any]]:
+    results: list[dict[str, Any]] = []
+    for n_lines, n_hps in sizes:
+        source = generate_source(n_lines, n_hps)
+        parse_seconds = measure(lambda: SourceParameterizer(source), repeat=3)
+        parameterizer = SourceParameterizer(source)
+        rng = random.Random(0)
+        values_list = [sample_values(parameterizer, rng) for _ in range(n_variants)]
+        it = iter(values_list * 2)
+        legacy_seconds = measure(lambda: legacy_apply_params(parameterizer, next(it)), repeat=n_variants)
+        it = iter(values_list * 2)
+        render_seconds = measure(lambda: parameterizer.apply_params(next(it)), repeat=n_variants)
+        batch_seconds = measure(lambda: parameterizer.apply_params_batch(values_list), repeat=3) / n_variants
+        results.append({
+            "n_lines": n_lines,
+            "n_hps": n_hps,
+            "source_bytes": len(source),
+            "parse_seconds": parse_seconds,
+            "legacy_apply_params_seconds": legacy_seconds,
+            "apply_params_seconds": render_seconds,
+            "apply_params_batch_seconds_per_variant": batch_seconds,
+        })
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmark of SourceParameterizer.apply_params")
+    parser.add_argument("--variants", type=int, default=200, help="Number of parameter tuples rendered per size")
+    parser.add_argument("--json", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(n_variants=args.variants)
+    print(f"{'lines':>6} {'HPs':>5} {'parse[ms]':>10} {'legacy[us]':>11} {'render[us]':>11} {'batch[us]':>10}")
+    for r in results:
+        print(
+            f"{r['n_lines']:>6} {r['n_hps']:>5} {r['parse_seconds'] * 1e3:>10.2f} "
+            f"{r['legacy_apply_params_seconds'] * 1e6:>11.1f} {r['apply_params_seconds'] * 1e6:>11.1f} "
+            f"{r['apply_params_batch_seconds_per_variant'] * 1e6:>10.1f}"
+        )
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
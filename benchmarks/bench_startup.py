@@ -0,0 +1,126 @@
+"""
+ezopt の起動（--help の表示や ezopt worker の開始など，実際の処理を始めるまで）にかかる時間と，
+1 試行あたりに確保される記録 (ExecutionResult / PhaseSpan / StreamedValues) のメモリ量・生成時間を測るベンチマーク
+
+    python benchmarks/bench_startup.py [--repeat N] [--records N] [--json OUTPUT]
+
+起動時間は新しい Python プロセスで測る（import 済みのモジュールのキャッシュが効かないように）
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any
+
+from common import REPO_ROOT, measure  # NOTE: ezopt を import できるよう，先に import する
+
+from ezopt.models import ExecutionResult, PhaseSpan, StreamedValues
+
+
+# 起動時に import されているかを調べる重いモジュール
+HEAVY_MODULES = ("optuna", "plotly", "pydantic", "numpy")
+
+# (名前, 起動するときの sys.argv) ．--help などは SystemExit で終わるので，それを捕まえてから import 済みのモジュールを調べる
+STARTUP_CASES: list[tuple[str, list[str] | None]] = [
+    ("import", None),
+    ("help", ["ezopt", "--help"]),
+    ("worker_help", ["ezopt", "worker", "--help"]),
+    ("merge_help", ["ezopt", "merge", "--help"]),
+]
+
+
+def _startup_script(argv: list[str] | None) -> str:
+    lines = ["import sys"]
+    if argv is None:
+        lines.append("import ezopt")
+    else:
+        lines += [
+            "import runpy",
+            f"sys.argv = {argv!r}",
+            "try:",
+            "    runpy.run_module('ezopt.ezopt', run_name='__main__', alter_sys=True)",
+            "except SystemExit:",
+            "    pass",
+        ]
+    lines.append(f"print('EZOPT_MODULES=' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    return "\n".join(lines)
+
+
+def measure_startup(argv: list[str] | None, repeat: int) -> dict[str, Any]:
+    env = {**os.environ, "PYTHONPATH": str(REPO_ROOT)}
+    script = _startup_script(argv)
+    seconds: list[float] = []
+    modules: list[str] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True)
+        seconds.append(time.perf_counter() - start)
+        modules = next(line for line in result.stdout.splitlines() if line.startswith("EZOPT_MODULES=")).split("=", 1)[1].split(",")
+    return {
+        "min_seconds": min(seconds),
+        "median_seconds": statistics.median(seconds),
+        # NOTE: 結果を比較するときのキーにならないよう，文字列ではなくリストとして記録する
+        "heavy_modules": [m for m in modules if m],
+    }
+
+
+def create_trial_record(i: int) -> ExecutionResult:
+    """
+    典型的な 1 試行分の実行結果（出力は逐次評価済みで，末尾も空．フェーズは write / build / run の 3 つ）
+    """
+    now = float(i)
+    return ExecutionResult(
+        stdout="",
+        stderr="",
+        return_code=0,
+        spans=[PhaseSpan(name=name, start=now, end=now + 1.0, thread="worker_0") for name in ("write", "build", "run")],
+        peak_rss_kb=1024,
+        streamed_values=StreamedValues(stdout_count=1, stdout_aggregate=float(i)),
+    )
+
+
+def measure_trial_records(n_records: int) -> dict[str, Any]:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    records = [create_trial_record(i) for i in range(n_records)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(records) == n_records
+    return {
+        "bytes_per_record": (after - before) / n_records,
+        "create_seconds_per_record": measure(lambda: create_trial_record(0), repeat=n_records),
+    }
+
+
+def run(repeat: int = 5, n_records: int = 10000) -> list[dict[str, Any]]:
+    results: list[dict[str, Any]] = []
+    for name, argv in STARTUP_CASES:
+        results.append({"case": name, **measure_startup(argv, repeat)})
+    results.append({"case": "trial_records", "n_records": n_records, **measure_trial_records(n_records)})
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of the startup time of ezopt and the memory footprint of per-trial records")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of process launches per startup case")
+    parser.add_argument("--records", type=int, default=10000, help="Number of per-trial records to allocate")
+    parser.add_argument("--json", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(repeat=args.repeat, n_records=args.records)
+    print(f"{'case':>12} {'min[ms]':>9} {'median[ms]':>11}  heavy modules")
+    for r in results[:-1]:
+        print(f"{r['case']:>12} {r['min_seconds'] * 1e3:>9.1f} {r['median_seconds'] * 1e3:>11.1f}  {','.join(r['heavy_modules']) or '-'}")
+    r = results[-1]
+    print(f"trial records: {r['bytes_per_record']:.0f} bytes/record, {r['create_seconds_per_record'] * 1e6:.2f} us/record ({r['n_records']} records)")
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+ベンチマークのスクリプトたちで共通に用いる処理（このディレクトリのスクリプトから import される）
+"""
+import os
+from pathlib import Path
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Callable
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))  # NOTE: pip install していなくても ezopt を import できるようにする
+
+from ezopt.models import ChoiceType, HyperParameterWithChoices  # noqa: E402
+from ezopt.source_parameterizer import SourceParameterizer  # noqa: E402
+
+
+def generate_source(n_lines: int, n_hps: int, print_score: bool = False) -> str:
+    """
+    n_lines 行のうち n_hps 行に HP の記述を含む C++ のソースを生成する
+    print_score=True の場合は，HP の値の和を "Score: ..." として出力する（コンパイル・実行できる）
+    """
+    hp_lines = sorted(random.Random(0).sample(range(n_lines), n_hps))
+    hp_line_set = set(hp_lines)
+    lines = ["#include<bits/stdc++.h>", "using namespace std;", "int main(){"]
+    for i in range(n_lines):
+        if i in hp_line_set:
+            if i % 2 == 0:
+                lines.append(f"    double x{i} = (0.5) /* HP_{i}: 0.0 -- 1.0 */;")
+            else:
+                lines.append(f"    int x{i} = (3) /* HP_{i}: [1, 2, 3, 4] */;")
+        else:
+            lines.append(f"    int y{i} = {i} * 2 + 1; // filler line {i}")
+    if print_score:
+        lines.append("    double score = 0;")
+        lines.extend(f"    score += x{i};" for i in hp_lines)
+        lines.append('    cout << "Score: " << score << endl;')
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def sample_values(parameterizer: SourceParameterizer, rng: random.Random) -> tuple[ChoiceType, ...]:
+    return tuple(
+        rng.choice(hp.choices) if isinstance(hp, HyperParameterWithChoices) else rng.uniform(0.0, 1.0)
+        for hp in parameterizer.hps
+    )
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> float:
+    """
+    fn を repeat 回呼んだときの 1 回あたりの平均時間 [秒]
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def describe_environment() -> dict[str, Any]:
+    """
+    結果を比較するときに必要となる，ベンチマークを実行した環境の情報
+    """
+    import optuna
+
+    try:
+        commit: str | None = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "optuna": optuna.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
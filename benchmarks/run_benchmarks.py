@@ -0,0 +1,100 @@
+"""
+ezopt 自体のオーバーヘッドを測るベンチマークをまとめて実行し，結果を JSON に書き出す
+
+    python benchmarks/run_benchmarks.py [--quick] [--only SUITE ...] [--json OUTPUT] [--compare BASELINE]
+
+--compare に以前の結果の JSON を渡すと，各指標の比 (今回 / 以前) を表示する（時間は小さいほど，trials/sec などは大きいほど良い）
+"""
+import argparse
+import json
+from typing import Any, Callable
+
+from common import describe_environment  # NOTE: ezopt を import できるよう，先に import する
+
+import bench_end_to_end
+import bench_output_evaluator
+import bench_sampler
+import bench_source_parameterizer
+import bench_startup
+
+
+def get_suites(quick: bool) -> dict[str, Callable[[], list[dict[str, Any]]]]:
+    """
+    quick=True の場合は，回帰の有無を手早く確認するための小さな設定で実行する
+    """
+    if quick:
+        return {
+            "source_parameterizer": lambda: bench_source_parameterizer.run(
+                sizes=[(500, 10), (5000, 100), (5000, 1000)], n_variants=50,
+            ),
+            "output_evaluator": lambda: bench_output_evaluator.run(sizes=[(1_000, 1), (100_000, 1000)], repeat=2),
+            "sampler": lambda: bench_sampler.run(n_hps_list=[10], n_trials=200, window=100),
+            "end_to_end": lambda: bench_end_to_end.run(n_jobs_list=[1, 2], n_hps_list=[10, 100], n_trials_echo=20, n_trials_cpp=4),
+            "startup": lambda: bench_startup.run(repeat=2, n_records=1000),
+        }
+    return {
+        "source_parameterizer": bench_source_parameterizer.run,
+        "output_evaluator": bench_output_evaluator.run,
+        "sampler": bench_sampler.run,
+        "end_to_end": bench_end_to_end.run,
+        "startup": bench_startup.run,
+    }
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any]) -> None:
+    """
+    数値でない・整数の項目（サイズや並列数など）が一致するレコードどうしで，実数の項目の比を表示する
+    """
+    def _split(record: dict[str, Any]) -> tuple[tuple[tuple[str, Any], ...], dict[str, float]]:
+        key = tuple((k, v) for k, v in record.items() if isinstance(v, (str, int, bool)) and not k.startswith("n_failed"))
+        metrics = {k: v for k, v in record.items() if isinstance(v, float)}
+        return key, metrics
+
+    for suite, records in current["results"].items():
+        baseline_records = dict(_split(record) for record in baseline.get("results", {}).get(suite, []))
+        for record in records:
+            key, metrics = _split(record)
+            if key not in baseline_records:
+                continue
+            label = " ".join(f"{k}={v}" for k, v in key)
+            for name, value in metrics.items():
+                base_value = baseline_records[key].get(name)
+                if base_value:
+                    print(f"{suite:>20} {label:<40} {name:<40} {base_value:>12.6g} -> {value:>12.6g} ({value / base_value:6.2f}x)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark suite of ezopt's own per-trial overhead")
+    parser.add_argument("--quick", action="store_true", help="Run smaller configurations (for a quick regression check)")
+    parser.add_argument("--only", type=str, nargs="+", help="Run only the given suites (source_parameterizer, output_evaluator, sampler, end_to_end, startup)")
+    parser.add_argument("--json", type=str, help="Write the results to this JSON file")
+    parser.add_argument("--compare", type=str, help="JSON file of a previous run to compare the results with")
+    args = parser.parse_args()
+
+    suites = get_suites(args.quick)
+    if args.only is not None:
+        unknown = set(args.only) - set(suites)
+        if len(unknown) > 0:
+            parser.error(f"unknown suites: {sorted(unknown)}")
+        suites = {name: suite for name, suite in suites.items() if name in args.only}
+
+    output: dict[str, Any] = {"environment": describe_environment(), "quick": args.quick, "results": {}}
+    for name, suite in suites.items():
+        print(f"== {name} ==")
+        output["results"][name] = suite()
+        for record in output["results"][name]:
+            print("    " + json.dumps(record))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"Results are written to {args.json}")
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        print("== comparison with", args.compare, "==")
+        compare(baseline, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,53 @@
-from ezopt.ezopt import *
+import importlib
+from typing import Any
+
+
+# 公開する名前 → それを定義しているモジュール
+# NOTE: `import ezopt` だけで optuna / pydantic などの重いモジュールを読み込まないよう，各名前は参照されたときにそのモジュールから読み込む
+_LAZY = {
+    # エントリーポイント
+    "main": "ezopt.ezopt",
+    "extract_cpp_file": "ezopt.ezopt",
+    "create_pruner": "ezopt.ezopt",
+    "load_worker_args": "ezopt.ezopt",
+    "merge_shards": "ezopt.ezopt",
+    "CONFIG_FILE_NAME": "ezopt.ezopt",
+    "STUDY_ATTR_KEY": "ezopt.ezopt",
+    # 各機能のクラス・関数
+    "BuildCache": "ezopt.build_cache",
+    "GridShard": "ezopt.grid_shard",
+    "GridShardResults": "ezopt.grid_shard",
+    "ExecutionLimits": "ezopt.models",
+    "ObjectiveSettings": "ezopt.models",
+    "OutputEvaluator": "ezopt.output_evaluator",
+    "SourceExecutor": "ezopt.source_executor",
+    "SourceExecutorPool": "ezopt.source_executor",
+    "SourceParameterizer": "ezopt.source_parameterizer",
+    "BayesianOptimizationStudyConductor": "ezopt.study_conductor",
+    "GridSearchStudyConductor": "ezopt.study_conductor",
+    "SuccessiveHalvingStudyConductor": "ezopt.study_conductor",
+    "create_storage": "ezopt.study_storage",
+    "StudyVisualizer": "ezopt.study_visualizer",
+    "PeriodicStudyVisualizer": "ezopt.study_visualizer",
+    "TrialMemo": "ezopt.trial_memo",
+    "TrialProfiler": "ezopt.trial_profiler",
+    "TrialReplicator": "ezopt.trial_replicator",
+    "WarmStart": "ezopt.warm_start",
+    "read_text_file": "ezopt.utils",
+    "write_text_file": "ezopt.utils",
+}
+
+__all__ = list(_LAZY)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY:
+        raise AttributeError(f"module 'ezopt' has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY[name]), name)
+    # NOTE: 二回目以降は __getattr__ を経由しないよう，パッケージの属性として保持しておく
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *__all__])
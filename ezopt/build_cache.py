@@ -0,0 +1,76 @@
+
+
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import threading
+
+from ezopt.utils import get_random_hex
+
+
+class BuildCache:
+    """
+    ビルド済みのバイナリを，(具体値代入後のソース, ビルドコマンド) のハッシュをキーとしてディレクトリに保存しておくキャッシュ
+    - ディレクトリ上のファイルとして保存されるので，ezopt の複数回の起動をまたいで再利用される
+    - 合計サイズが max_bytes を超えると，最後に使われた時刻 (mtime) が古いものから削除される (LRU)
+    """
+    def __init__(self, cache_dir: str | Path, max_bytes: int = 1 << 30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def compute_key(source: str, build_cmd: str) -> str:
+        h = hashlib.sha256()
+        h.update(build_cmd.encode())
+        h.update(b"\0")
+        h.update(source.encode())
+        return h.hexdigest()
+
+    def load(self, key: str, dst: Path) -> bool:
+        """
+        キャッシュにヒットすればバイナリを dst にコピーして True を返す
+        """
+        entry = self.cache_dir / key
+        try:
+            shutil.copy2(entry, dst)
+            os.utime(entry)  # NOTE: LRU のために最終使用時刻を更新する
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key: str, src: Path) -> None:
+        # NOTE: 書きかけのファイルが他のプロセスから見えないよう，一時ファイルに書いてから rename する
+        tmp_entry = self.cache_dir / f".{key}.{get_random_hex(8)}.tmp"
+        shutil.copy2(src, tmp_entry)
+        os.replace(tmp_entry, self.cache_dir / key)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        合計サイズが max_bytes 以下になるまで，古いエントリから削除する
+        """
+        with self._lock:
+            entries: list[tuple[float, int, Path]] = []
+            for path in self.cache_dir.iterdir():
+                if path.name.startswith("."):
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+
+    def __repr__(self):
+        return f"BuildCache(cache_dir={self.cache_dir}, max_bytes={self.max_bytes})"
@@ -1,15 +1,18 @@
 import argparse
 import datetime
+import glob
+import json
+import os
 from pathlib import Path
 import re
+import sys
+from typing import TYPE_CHECKING, Any
 
-from ezopt.output_evaluator import OutputEvaluator
-from ezopt.source_executor import SourceExecutor
-from ezopt.source_parameterizer import SourceParameterizer
-from ezopt.study_conductor import BayesianOptimizationStudyConductor, GridSearchStudyConductor
-from ezopt.study_visualizer import StudyVisualizer
 from ezopt.utils import read_text_file, write_text_file
 
+if TYPE_CHECKING:
+    import optuna
+
 
 def extract_cpp_file(cmd: str) -> str:
     cpp_files = re.findall(r"[\w\./]+\.cpp", cmd)
@@ -20,9 +23,102 @@ def extract_cpp_file(cmd: str) -> str:
     return cpp_files[0]
 
 
+CONFIG_FILE_NAME = "config.json"
+# study の user attribute に記録する，参加するプロセス (ezopt worker) が同じ設定で実行するための情報のキー
+STUDY_ATTR_KEY = "ezopt"
+
+
+def create_pruner(name: str) -> "optuna.pruners.BasePruner | None":
+    import optuna
+
+    if name == "none":
+        return None
+    elif name == "median":
+        return optuna.pruners.MedianPruner()
+    elif name == "hyperband":
+        return optuna.pruners.HyperbandPruner()
+    else:
+        raise ValueError(f"Unsupported pruner: {name}")
+
+
+def load_worker_args(parser: argparse.ArgumentParser, argv: list[str]) -> tuple[argparse.Namespace, dict[str, Any]]:
+    """
+    ezopt worker の引数を解釈し，参加する study に記録された設定から引数を復元する
+    戻り値は (引数, study に記録された情報 (config / source / hps / cwd))
+    """
+    worker_parser = argparse.ArgumentParser(prog="ezopt worker", description="Join a study created by ezopt and run its trials in this process")
+    worker_parser.add_argument("STORAGE", type=str, help="Storage of the study: a journal file path, an output directory containing study.journal, or a database URL")
+    worker_parser.add_argument("--study-name", type=str, default="ezopt", help="Name of the study in the storage")
+    worker_parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of trials to run in parallel in this process")
+    worker_parser.add_argument("--case-jobs", type=int, default=os.cpu_count() or 1, help="Number of input files to run in parallel")
+    worker_parser.add_argument("--pin-cpus", action="store_true", help="Pin each parallel job to its own subset of CPUs (for timing-sensitive values)")
+    worker_parser.add_argument("--cache-dir", type=str, help="Directory of the build cache shared across runs (build cache is disabled if not specified)")
+    worker_args = worker_parser.parse_args(argv)
+
+    import optuna
+    from ezopt.study_storage import create_storage
+
+    storage_path = worker_args.STORAGE
+    if "://" not in storage_path:
+        if Path(storage_path).is_dir():
+            storage_path = str(Path(storage_path) / "study.journal")
+        # NOTE: JournalStorage は存在しないファイルを作ってしまうので，先に確認する
+        if not Path(storage_path).is_file():
+            raise ValueError(f"Storage file does not exist: {storage_path}")
+    try:
+        study = optuna.load_study(study_name=worker_args.study_name, storage=create_storage(storage_path))
+    except KeyError:
+        raise ValueError(f"Study {worker_args.study_name} is not found in the storage {storage_path}")
+    if STUDY_ATTR_KEY not in study.user_attrs:
+        raise ValueError(f"The study {worker_args.study_name} has no settings to join (it must be created by ezopt with -M / -m and without --successive-halving)")
+    study_attr = study.user_attrs[STUDY_ATTR_KEY]
+    if study_attr["cwd"] != os.getcwd():
+        # NOTE: CMD や --inputs の相対パスはこのプロセスのカレントディレクトリから解決される
+        print(f"Warning: the study was created in {study_attr['cwd']}, but this worker runs in {os.getcwd()}; relative paths in CMD and --inputs are resolved from here")
+
+    # NOTE: 保存時より後に追加された引数はデフォルト値とし，このプロセスの実行環境に関わるものだけ上書きする
+    args = argparse.Namespace(**{**vars(parser.parse_args([])), **study_attr["config"]})
+    args.storage = storage_path
+    args.study_name = worker_args.study_name
+    args.jobs = worker_args.jobs
+    args.case_jobs = worker_args.case_jobs
+    args.pin_cpus = worker_args.pin_cpus
+    args.cache_dir = worker_args.cache_dir
+    args.resume = None
+    # NOTE: memo と trace はプロセスごとのものなので，参加するプロセスでは用いない
+    args.memo = False
+    args.memo_file = None
+    args.trace = False
+    return args, study_attr
+
+
+def merge_shards(argv: list[str]) -> None:
+    """
+    ezopt merge: --shard で分割実行した grid search の結果ファイルたちを一つの stats.json にまとめる
+    """
+    merge_parser = argparse.ArgumentParser(prog="ezopt merge", description="Merge the results files of grid search shards (--shard) into a single stats.json")
+    merge_parser.add_argument("PATHS", type=str, nargs="+", help="Results files of shards, or output directories containing them (shard_<i>_of_<N>.jsonl)")
+    merge_parser.add_argument("-o", "--output", type=str, help="Path of the merged stats.json (defaults to stats.json next to the first results file)")
+    merge_args = merge_parser.parse_args(argv)
+
+    from ezopt.grid_shard import GridShardResults
+
+    paths: list[Path] = []
+    for path in map(Path, merge_args.PATHS):
+        paths.extend(sorted(path.glob("shard_*_of_*.jsonl")) if path.is_dir() else [path])
+    if len(paths) == 0:
+        raise ValueError(f"No shard results files are found in {merge_args.PATHS}")
+    output_path = Path(merge_args.output) if merge_args.output is not None else paths[0].parent / "stats.json"
+    header = GridShardResults.merge(paths, output_path)
+    print(f"Merged {len(paths)} files (shards {header['shards']['merged']} of {header['shards']['n_shards']}) into {output_path}")
+    print(f"    - Points: {header['n_trials']} / {header['shards']['grid_size']} ({header['shards']['n_missing']} missing)")
+    print(f"    - Best params: {header['best_params']}")
+    print(f"    - Best value: {header['best_value']}")
+
+
 def main() -> None:  # NOTE: パッケージのエントリーポイントとして使われる
-    parser = argparse.ArgumentParser(description="EZOPT: Easy Optimization")
-    parser.add_argument("CMD", type=str, help="Command to run. Example: 'g++ main.cpp && ./a.out < in.txt'")
+    parser = argparse.ArgumentParser(description="EZOPT: Easy Optimization", epilog="Run 'ezopt worker STORAGE' to join a study created by another ezopt process and share its trials, and 'ezopt merge OUTPUT_DIR ...' to combine the results of grid search shards (see 'ezopt worker --help' / 'ezopt merge --help')")
+    parser.add_argument("CMD", type=str, nargs="?", help="Command to run. Example: 'g++ main.cpp && ./a.out < in.txt'")
     parser.add_argument("-p", "--value-pattern", type=str, default="Score: (.+)", help="Pattern to extract value")
     parser.add_argument("-M", "--maximize", action="store_true", help="Maximize the value")
     parser.add_argument("-m", "--minimize", action="store_true", help="Minimize the value")
@@ -30,8 +126,86 @@ def main() -> None:  # NOTE: パッケージのエントリーポイントとし
     parser.add_argument("-n", "--trials", type=int, default=100, help="Number of trials")
     parser.add_argument("-a", "--aggregation", type=str, default="sum", choices=["sum", "sumlog"], help="How to aggregate values from multiple matches")
     parser.add_argument("-o", "--output-dir", type=str, help="Output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of trials to run in parallel")
+    parser.add_argument("--compile-once", action="store_true", help="Build the binary only once and pass hyperparameters via environment variables (CMD must be '<build> && <run>')")
+    parser.add_argument("--persistent", action="store_true", help="Start the target once per job and send it one parameter set after another instead of starting it for every run (requires --compile-once; the target loops over ezopt_next() / ezopt_end())")
+    parser.add_argument("--persistent-max-evaluations", type=int, default=100, help="Restart a persistent target after this many evaluations")
+    parser.add_argument("--async-dispatch", action="store_true", help="Drive the trials with optuna's ask / tell from an asyncio event loop: the next candidate is suggested by constant-liar TPE while trials are running and results are told in the order they finish (not supported with --grid or --successive-halving)")
+    parser.add_argument("-i", "--inputs", type=str, help="Glob pattern of input files (e.g. 'in/*.txt'). Each trial is run on every input file")
+    parser.add_argument("--case-jobs", type=int, default=os.cpu_count() or 1, help="Number of input files to run in parallel")
+    parser.add_argument("--pruner", type=str, default="none", choices=["none", "median", "hyperband"], help="Pruner to stop unpromising trials based on intermediate values")
+    parser.add_argument("--progress-pattern", type=str, help="Pattern to extract intermediate values for pruning (used when --inputs is not specified; defaults to --value-pattern)")
+    parser.add_argument("--successive-halving", action="store_true", help="Evaluate TRIALS candidates on growing subsets of the input files and promote only the top ones (requires --inputs; candidates are sampled at random since they are all suggested before any result is known)")
+    parser.add_argument("--min-cases", type=int, default=8, help="Number of input files in the first rung of successive halving")
+    parser.add_argument("--reduction-factor", type=int, default=4, help="Growth factor of input files (and reduction factor of candidates) per rung of successive halving")
+    parser.add_argument("--seed", type=int, default=0, help="Seed to fix the order of input files and the candidates in successive halving, the sampling of trials in large reports and the first seed of replicated runs")
+    parser.add_argument("--cache-dir", type=str, help="Directory of the build cache shared across runs (build cache is disabled if not specified)")
+    parser.add_argument("--cache-size", type=float, default=1024, help="Maximum size of the build cache in MB")
+    parser.add_argument("--no-pch", action="store_true", help="Do not precompile the leading #include lines of the source into a precompiled header shared by the builds of all trials (only done for a plain g++ build command)")
+    parser.add_argument("--memo", action="store_true", help="Reuse the value of a parameter tuple that has already been run instead of running it again")
+    parser.add_argument("--memo-file", type=str, help="File to persist the memo across runs (implies --memo; defaults to a file in the output directory)")
+    parser.add_argument("--max-repeats", type=int, default=1, help="Number of times the same parameter tuple is actually run before the memo returns the mean value (for noisy targets)")
+    parser.add_argument("--replicate", type=int, default=1, help="Run each promising trial up to this many times with different seeds (passed via the environment variable EZOPT_SEED) and use the mean value (for noisy targets)")
+    parser.add_argument("--replicate-min", type=int, default=2, help="Minimum number of runs of a replicated trial before it can stop by the confidence interval")
+    parser.add_argument("--replicate-tolerance", type=float, default=0.01, help="Stop replicating once the half width of the confidence interval of the mean is within this fraction of its absolute value")
+    parser.add_argument("--replicate-confidence", type=float, default=0.95, help="Confidence level of the confidence interval of the mean of replicated runs")
+    parser.add_argument("--objective-time", action="store_true", help="Also minimize the wall-clock time of the run phase (mean over input files) as a second objective")
+    parser.add_argument("--extra-objective", type=str, nargs=2, action="append", default=[], metavar=("PATTERN", "DIRECTION"), help="Also optimize the value extracted by PATTERN in the given direction (minimize / maximize); can be given multiple times")
+    parser.add_argument("--time-limit", type=float, help="Constraint on the wall-clock time in seconds of the run phase at the --time-quantile over input files; trials exceeding it are treated as infeasible")
+    parser.add_argument("--time-quantile", type=float, default=0.99, help="Quantile of the run-phase wall-clock times over input files compared with --time-limit")
+    parser.add_argument("--extra-constraint", type=str, nargs=2, action="append", default=[], metavar=("PATTERN", "UPPER_BOUND"), help="Constraint that the value extracted by PATTERN is at most UPPER_BOUND; can be given multiple times")
+    parser.add_argument("--visualize-interval", type=float, default=300, help="Interval in seconds to refresh the visualization during the optimization")
+    parser.add_argument("--visualize-every", type=int, help="Refresh the visualization every N finished trials")
+    parser.add_argument("--max-plot-trials", type=int, default=2000, help="Maximum number of trials drawn in the parallel coordinate / importance / contour / slice plots (larger studies are downsampled)")
+    parser.add_argument("--storage", type=str, help="Storage of the study: a journal file path or a database URL such as 'sqlite:///study.db' (defaults to a journal file in the output directory)")
+    parser.add_argument("--study-name", type=str, help="Name of the study in the storage")
+    parser.add_argument("--timeout", type=float, help="Wall-clock time limit in seconds for each build / run (per input file); trials exceeding it are killed and marked as failed")
+    parser.add_argument("--cpu-time", type=float, help="CPU time limit in seconds for each process of a build / run")
+    parser.add_argument("--memory-limit", type=float, help="Address space limit in MB for each process of a build / run")
+    parser.add_argument("--pin-cpus", action="store_true", help="Pin each parallel job to its own subset of CPUs (for timing-sensitive values)")
+    parser.add_argument("--output-tail", type=float, default=64, help="Size in KB of the tail of stdout / stderr kept for error messages (values are extracted while the output is streamed)")
+    parser.add_argument("--trace", action="store_true", help="Record the start / end time of each phase of each trial and write them to trace.json (Chrome trace event format) in the output directory")
+    parser.add_argument("--shard", type=str, metavar="I/N", help="Run only the I-th (0-based) of N disjoint slices of the grid (requires --grid); results are appended to shard_<I>_of_<N>.jsonl in the output directory, rerunning with the same output directory skips finished points, and 'ezopt merge' combines the shards into stats.json")
+    parser.add_argument("--warm-start-default", action="store_true", help="Run the values written in the source first (values outside the search space are left to the sampler)")
+    parser.add_argument("--warm-start", type=str, nargs="+", action="extend", default=[], metavar="STATS", help="Run the top trials of earlier studies first: stats.json files or output directories (e.g. ezopt-results/*); values are matched by hyperparameter name and mapped into the current search space, or left to the sampler when outside it")
+    parser.add_argument("--warm-start-top-k", type=int, default=10, help="Number of top trials taken from each study given by --warm-start")
+    parser.add_argument("--resume", type=str, metavar="OUTPUT_DIR", help="Resume an interrupted study in the given output directory (the other arguments are restored from it)")
     # parser.add_argument("--verbose", action="store_true", help="Verbose mode")
-    args = parser.parse_args()
+    worker_study_attr: dict[str, Any] | None = None
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        merge_shards(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        # 他のプロセスが作った study に参加する: 引数と編集前ソースは study に記録されたものを用いる
+        args, worker_study_attr = load_worker_args(parser, sys.argv[2:])
+    else:
+        args = parser.parse_args()
+    WORKER: bool = worker_study_attr is not None
+
+    if args.resume is not None:
+        # 中断された study の再開: 引数は出力ディレクトリに保存されたものを用いる
+        resume_dir = args.resume
+        # NOTE: 保存時より後に追加された引数はデフォルト値とする
+        args = argparse.Namespace(**{**vars(parser.parse_args([])), **json.loads(read_text_file(Path(resume_dir) / CONFIG_FILE_NAME))})
+        args.resume = resume_dir
+        args.output_dir = resume_dir
+    if args.CMD is None:
+        parser.error("the following arguments are required: CMD")
+
+    # NOTE: --help などを速く表示できるよう，optuna / pydantic などを用いるモジュールは引数を解釈した後に読み込む
+    from ezopt.build_cache import BuildCache
+    from ezopt.grid_shard import GridShard, GridShardResults
+    from ezopt.models import ExecutionLimits, ObjectiveSettings
+    from ezopt.output_evaluator import OutputEvaluator
+    from ezopt.source_executor import SourceExecutorPool
+    from ezopt.source_parameterizer import SourceParameterizer
+    from ezopt.study_storage import create_storage
+    from ezopt.trial_memo import TrialMemo
+    from ezopt.study_conductor import BayesianOptimizationStudyConductor, GridSearchStudyConductor, SuccessiveHalvingStudyConductor
+    from ezopt.trial_profiler import TrialProfiler
+    from ezopt.trial_replicator import TrialReplicator
+    from ezopt.study_visualizer import PeriodicStudyVisualizer
+    from ezopt.warm_start import WarmStart
 
     CMD: str = args.CMD
     VALUE_PATTERN: str = args.value_pattern
@@ -45,51 +219,252 @@ def main() -> None:  # NOTE: パッケージのエントリーポイントとし
     N_TRIALS: int = args.trials
     GRID: bool = args.grid
     AGGREGAGION: str = args.aggregation
+    N_JOBS: int = args.jobs
+    COMPILE_ONCE: bool = args.compile_once
+    CACHE_DIR: Path | None = Path(args.cache_dir) if args.cache_dir is not None else None
+    CACHE_SIZE_MB: float = args.cache_size
+    INPUT_FILES: list[Path] | None = [Path(f) for f in sorted(glob.glob(args.inputs))] if args.inputs is not None else None
+    N_CASE_JOBS: int = args.case_jobs
+    if INPUT_FILES is not None and len(INPUT_FILES) == 0:
+        raise ValueError(f"No input files match the pattern: {args.inputs}")
+    PRUNER: str = args.pruner
+    PROGRESS_PATTERN: str | None = args.progress_pattern
+    SUCCESSIVE_HALVING: bool = args.successive_halving
+    if SUCCESSIVE_HALVING and INPUT_FILES is None:
+        raise ValueError("--successive-halving requires --inputs")
     OUTPUT_DIR: Path = Path(args.output_dir) if args.output_dir is not None else Path(f"./ezopt-results/{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}/")
-
-    # 編集後ソースを実行するクラス
-    executor = SourceExecutor(CMD)
+    RESUME: bool = args.resume is not None
+    if RESUME and SUCCESSIVE_HALVING:
+        raise ValueError("--resume is not supported for --successive-halving")
+    if WORKER and (SUCCESSIVE_HALVING or not OPTIMIZE):
+        raise ValueError("ezopt worker is not supported for --successive-halving or the mode without -M / -m")
+    SHARD: tuple[int, int] | None = GridShard.parse_spec(args.shard) if args.shard is not None else None
+    if SHARD is not None and not GRID:
+        raise ValueError("--shard requires --grid")
+    if SHARD is not None and (SUCCESSIVE_HALVING or RESUME or WORKER):
+        raise ValueError("--shard is not supported with --successive-halving, --resume or ezopt worker (rerun the same command with the same --output-dir to resume a shard)")
+    # NOTE: storage の指定が無い場合も，中断時に結果が失われないよう出力ディレクトリ内のファイルに書き込む
+    STORAGE: str = args.storage if args.storage is not None else str(OUTPUT_DIR / "study.journal")
+    STUDY_NAME: str = args.study_name if args.study_name is not None else "ezopt"
+    MEMO_FILE: Path | None = Path(args.memo_file) if args.memo_file is not None else (OUTPUT_DIR / "memo.jsonl" if args.memo else None)
+    MAX_REPEATS: int = args.max_repeats
+    LIMITS = ExecutionLimits(wall_time=args.timeout, cpu_time=args.cpu_time, memory_mb=args.memory_limit)
+    PERSISTENT: bool = args.persistent
+    if PERSISTENT and not COMPILE_ONCE:
+        raise ValueError("--persistent requires --compile-once")
+    if PERSISTENT and LIMITS.cpu_time is not None:
+        # NOTE: ulimit の CPU 時間は常駐プロセスの全ての評価の合計に対してかかってしまう
+        raise ValueError("--cpu-time is not supported with --persistent (use --timeout instead)")
+    REPLICATOR: TrialReplicator | None = TrialReplicator(
+        max_runs=args.replicate,
+        min_runs=args.replicate_min,
+        tolerance=args.replicate_tolerance,
+        confidence=args.replicate_confidence,
+        seed=args.seed,
+    ) if args.replicate > 1 else None
+    if REPLICATOR is not None and SUCCESSIVE_HALVING:
+        raise ValueError("--replicate is not supported for --successive-halving")
+    for _, direction in args.extra_objective:
+        if direction not in ("minimize", "maximize"):
+            raise ValueError(f"Direction of --extra-objective must be minimize or maximize: {direction}")
+    OBJECTIVES = ObjectiveSettings(
+        time=args.objective_time,
+        extra_objectives=[(pattern, direction) for pattern, direction in args.extra_objective],
+        time_limit=args.time_limit,
+        time_quantile=args.time_quantile,
+        extra_constraints=[(pattern, float(upper_bound)) for pattern, upper_bound in args.extra_constraint],
+    )
+    if not OBJECTIVES.is_empty() and (SUCCESSIVE_HALVING or REPLICATOR is not None or MEMO_FILE is not None):
+        raise ValueError("Extra objectives and constraints are not supported with --successive-halving, --replicate or --memo")
+    if OBJECTIVES.is_multi_objective() and PRUNER != "none":
+        raise ValueError("--pruner is not supported for multi-objective optimization")
+    if SHARD is not None and (REPLICATOR is not None or not OBJECTIVES.is_empty() or PRUNER != "none"):
+        raise ValueError("--shard is not supported with --replicate, --pruner or extra objectives and constraints")
+    ASYNC_DISPATCH: bool = args.async_dispatch
+    if ASYNC_DISPATCH and (GRID or SUCCESSIVE_HALVING):
+        raise ValueError("--async-dispatch is not supported with --grid or --successive-halving")
+    WARM_START_PATHS: list[Path] = [Path(p) for p in args.warm_start]
+    if (args.warm_start_default or len(WARM_START_PATHS) > 0) and GRID:
+        raise ValueError("--warm-start-default and --warm-start are not supported with --grid (every grid cell is run anyway)")
 
     # 編集前ソースをパラメータ化するクラス
-    parameterizer = SourceParameterizer(read_text_file(executor.cpp_file))
+    # NOTE: 参加するプロセスでは，ローカルのファイルではなく study に記録されたソースを用いる（全てのプロセスで HP の定義を揃えるため）
+    original_source = worker_study_attr["source"] if worker_study_attr is not None else read_text_file(extract_cpp_file(CMD))
+    parameterizer = SourceParameterizer(original_source)
+    if worker_study_attr is not None and [str(hp) for hp in parameterizer.hps] != worker_study_attr["hps"]:
+        raise ValueError("Hyperparameters parsed in this worker differ from those recorded in the study (ezopt versions may differ)")
 
     if len(parameterizer.hps) == 0:
         raise ValueError("No hyperparameters are found")
 
+    build_cache = BuildCache(CACHE_DIR, max_bytes=int(CACHE_SIZE_MB * 1024 * 1024)) if CACHE_DIR is not None else None
+
     # 各種情報の確認
     print("HyperParameters:")
     for hp in parameterizer.hps:
         print(f"    - {hp}")
     print("Optimization Direction:", DIRECTION)
-    print("Output Directory (will be created if not exists):", OUTPUT_DIR)
-    if input("Continue? [y/n] ") != "y":
+    print("Parallel Jobs:", N_JOBS)
+    print("Compile Once:", COMPILE_ONCE)
+    if PERSISTENT:
+        print("Persistent Target:", f"restarted every {args.persistent_max_evaluations} evaluations")
+    print("Build Cache:", build_cache)
+    print("Pruner:", PRUNER)
+    if ASYNC_DISPATCH:
+        print("Dispatch:", f"asynchronous ask / tell ({N_JOBS} trials in flight, constant-liar TPE)")
+    if not LIMITS.is_empty():
+        print("Execution Limits:", LIMITS)
+    if args.pin_cpus:
+        print("CPUs per Job:", SourceExecutorPool.split_cpus(N_JOBS))
+    if REPLICATOR is not None:
+        print("Replication:", REPLICATOR)
+    if not OBJECTIVES.is_empty():
+        print("Objectives:", OBJECTIVES.names(), OBJECTIVES.directions(DIRECTION))
+        if OBJECTIVES.time_limit is not None or len(OBJECTIVES.extra_constraints) > 0:
+            print("Constraints:", ([f"run_seconds (p{OBJECTIVES.time_quantile * 100:g}) <= {OBJECTIVES.time_limit}"] if OBJECTIVES.time_limit is not None else []) + [f"{pattern} <= {upper_bound}" for pattern, upper_bound in OBJECTIVES.extra_constraints])
+    # NOTE: 再開・参加する場合は study を作ったときに enqueue 済みなので作らない
+    warm_start: WarmStart | None = None
+    if (args.warm_start_default or len(WARM_START_PATHS) > 0) and not RESUME and not WORKER:
+        warm_start = WarmStart(parameterizer.hps)
+        if args.warm_start_default:
+            warm_start.add_default()
+        for path in WARM_START_PATHS:
+            if path.is_dir() and not (path / "stats.json").exists():
+                print(f"Warning: {path} has no stats.json; skipped for warm start")
+                continue
+            warm_start.add_prior_study(path, args.warm_start_top_k, DIRECTION)
+        print("Warm Start:", warm_start)
+    if INPUT_FILES is not None:
+        print(f"Input Files: {len(INPUT_FILES)} files ({INPUT_FILES[0]}, ...)")
+    if not WORKER:
+        print("Output Directory (will be created if not exists):", OUTPUT_DIR)
+    if SHARD is not None:
+        shard = GridShard(parameterizer.hps, shard_index=SHARD[0], n_shards=SHARD[1])
+        shard_results = GridShardResults(OUTPUT_DIR / GridShardResults.default_file_name(shard), shard, direction=DIRECTION)
+        print("Shard:", shard, f"(results: {shard_results.path})")
+    else:
+        print("Storage:", STORAGE, f"(study name: {STUDY_NAME}{', resumed' if RESUME else ''}{', joined as a worker' if WORKER else ''})")
+    # NOTE: 参加するプロセスは多数起動されうるので確認しない
+    if not WORKER and input("Continue? [y/n] ") != "y":
         exit()
 
-    evaluator = OutputEvaluator(VALUE_PATTERN, value_aggregation=AGGREGAGION)
-    if OPTIMIZE:
-        # 最適化を目的としている場合
-        study_conductor = BayesianOptimizationStudyConductor(parameterizer, executor, evaluator)
-        study_result = study_conductor.run(n_trials=N_TRIALS, direction=DIRECTION, sampling="grid" if GRID else "tpe")
-        print("Summary:")
-        print(f"    - Best params: {study_result.best_params}")
-        print(f"    - Best value: {study_result.best_value}")
-        if study_result.study is not None:
-            # 可視化の保存
-            StudyVisualizer.visualize(study_result.study, OUTPUT_DIR)
-            # 最適ソースの保存
-            if study_result.best_params is not None:
-                best_source = parameterizer.apply_params(study_result.best_params)
-                write_text_file(OUTPUT_DIR / "best_source.cpp", best_source)
-            print(f"Results are saved in the directory {OUTPUT_DIR}")
-            # TODO: visualize は定期的に保存されるようにする
-    else:
-        # 最適化を特に目的としていない場合（単に全ての条件で実行したい場合）
-        # NOTE: スコア形式を指定するのが面倒だが，とりあえず全通り走らせて欲しい，生出力を眺めたい，というニーズに対してはこれで対応
-        # TODO: optuna で grid search すれば良いので，こちらのモードはいずれ消したい（上に統合したい）
-        grid_search_study_conductor = GridSearchStudyConductor(parameterizer, executor, evaluator)
-        study_result = grid_search_study_conductor.run()
-        print(f"{study_result=}")
-        
+    # 編集後ソースを実行するクラス（ワーカーごとに独立したサンドボックスを持つ）
+    # NOTE: サンドボックスは close で削除されるので，作るのは確認の後にし，以降は例外で終了する場合も必ず close する
+    executor = SourceExecutorPool(
+        CMD,
+        n_workers=N_JOBS,
+        build_cache=build_cache,
+        n_case_workers=N_CASE_JOBS if INPUT_FILES is not None else 1,
+        limits=LIMITS if not LIMITS.is_empty() else None,
+        pin_cpus=args.pin_cpus,
+        output_tail_chars=int(args.output_tail * 1024),
+        persistent_max_evaluations=args.persistent_max_evaluations if PERSISTENT else None,
+        # NOTE: --compile-once ではビルドが一度だけなので，プリコンパイルしても速くならない
+        use_pch=not args.no_pch and not COMPILE_ONCE,
+    )
+    print("Precompiled Header:", executor.precompiled_header)
+    try:
+        # 引数を保存しておく（--resume で再開するときに用いる）
+        if not WORKER:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+        if not RESUME and not WORKER:
+            args.output_dir = str(OUTPUT_DIR)
+            args.storage = STORAGE
+            args.study_name = STUDY_NAME
+            # NOTE: shard どうしは出力ディレクトリを共有するので，shard ごとに別のファイル（shard_<i>_of_<N>.config.json）に書き出す
+            config_path = OUTPUT_DIR / CONFIG_FILE_NAME if SHARD is None else shard_results.path.with_suffix(".config.json")
+            write_text_file(config_path, json.dumps(vars(args), indent=2, ensure_ascii=False))
+        # ezopt worker が同じ設定・同じ HP の定義で参加できるよう，study に記録しておく
+        study_attrs = {
+            STUDY_ATTR_KEY: {
+                "config": vars(args),
+                "source": original_source,
+                "hps": [str(hp) for hp in parameterizer.hps],
+                "cwd": os.getcwd(),
+            },
+        } if not WORKER else None
+        # NOTE: shard は optuna を用いず，結果は shard ごとのファイルに書き込む
+        storage = create_storage(STORAGE) if SHARD is None else None
+        memo = TrialMemo(
+            MEMO_FILE,
+            max_repeats=MAX_REPEATS,
+            fingerprint=TrialMemo.compute_fingerprint(original_source, CMD, VALUE_PATTERN, AGGREGAGION, INPUT_FILES),
+        ) if MEMO_FILE is not None else None
+        if memo is not None:
+            print(f"Memo: {memo}")
+
+        evaluator = OutputEvaluator(VALUE_PATTERN, value_aggregation=AGGREGAGION, metric_patterns=OBJECTIVES.metric_patterns())
+        if OPTIMIZE:
+            # 最適化を目的としている場合
+            # NOTE: 可視化はバックグラウンドで定期的に更新される（試行の実行はブロックしない）
+            visualizer = PeriodicStudyVisualizer(OUTPUT_DIR, interval_seconds=args.visualize_interval, every_n_trials=args.visualize_every, max_plot_trials=args.max_plot_trials, seed=args.seed).start() if not WORKER and SHARD is None else None
+            if SHARD is not None:
+                # grid を分割した一部分のみを実行する（まとめるには ezopt merge を用いる）
+                grid_search_study_conductor = GridSearchStudyConductor(parameterizer, executor, evaluator, compile_once=COMPILE_ONCE, input_files=INPUT_FILES, memo=memo)
+                study_result = grid_search_study_conductor.run(shard=shard, results=shard_results, maximize=DIRECTION == "maximize")
+                print(f"Shard results are appended to {shard_results.path} (run 'ezopt merge {OUTPUT_DIR}' to combine the shards into stats.json)")
+            elif SUCCESSIVE_HALVING:
+                assert visualizer is not None
+                assert INPUT_FILES is not None
+                successive_halving_study_conductor = SuccessiveHalvingStudyConductor(parameterizer, executor, evaluator, input_files=INPUT_FILES, compile_once=COMPILE_ONCE, record_spans=args.trace)
+                study_result = successive_halving_study_conductor.run(
+                    n_trials=N_TRIALS,
+                    direction=DIRECTION,
+                    sampling="grid" if GRID else "random",
+                    min_cases=args.min_cases,
+                    reduction_factor=args.reduction_factor,
+                    seed=args.seed,
+                    storage=storage,
+                    study_name=STUDY_NAME,
+                    warm_start=warm_start,
+                    callbacks=[visualizer],
+                )
+                if study_result.study is not None:
+                    n_case_runs = sum(budget["n_case_runs"] for budget in study_result.study.user_attrs["rung_budgets"])
+                    print(f"Successive Halving: {n_case_runs} case runs ({n_case_runs / (N_TRIALS * len(INPUT_FILES)):.1%} of evaluating all candidates on all cases)")
+            else:
+                study_conductor = BayesianOptimizationStudyConductor(parameterizer, executor, evaluator, compile_once=COMPILE_ONCE, input_files=INPUT_FILES, progress_pattern=PROGRESS_PATTERN, memo=memo, record_spans=args.trace, replicator=REPLICATOR, objectives=OBJECTIVES)
+                study_result = study_conductor.run(
+                    n_trials=N_TRIALS,
+                    direction=DIRECTION,
+                    sampling="grid" if GRID else "tpe",
+                    pruner=create_pruner(PRUNER),
+                    storage=storage,
+                    study_name=STUDY_NAME,
+                    resume=RESUME,
+                    join=WORKER,
+                    study_attrs=study_attrs,
+                    warm_start=warm_start,
+                    async_dispatch=ASYNC_DISPATCH,
+                    callbacks=[visualizer] if visualizer is not None else [],
+                )
+            print("Summary:")
+            print(f"    - Best params: {study_result.best_params}")
+            print(f"    - Best value: {study_result.best_value}")
+            if study_result.study is not None and len(study_result.study.directions) > 1:
+                print(f"    - Pareto front: {len(study_result.study.best_trials)} trials (see pareto_front.html)")
+            if study_result.study is not None and visualizer is not None:
+                # 可視化の保存（最後の更新以降に変化のあったもののみ）
+                # NOTE: 参加するプロセスは出力ディレクトリに書き込まない（study を作ったプロセスか，--resume で集計する）
+                visualizer.stop(study_result.study)
+                if args.trace:
+                    TrialProfiler.write_chrome_trace(study_result.study.get_trials(deepcopy=False), OUTPUT_DIR / "trace.json", extra_spans=visualizer.spans)
+                # 最適ソースの保存
+                if study_result.best_params is not None:
+                    best_source = parameterizer.apply_params(study_result.best_params)
+                    write_text_file(OUTPUT_DIR / "best_source.cpp", best_source)
+                print(f"Results are saved in the directory {OUTPUT_DIR}")
+        else:
+            # 最適化を特に目的としていない場合（単に全ての条件で実行したい場合）
+            # NOTE: スコア形式を指定するのが面倒だが，とりあえず全通り走らせて欲しい，生出力を眺めたい，というニーズに対してはこれで対応
+            # TODO: optuna で grid search すれば良いので，こちらのモードはいずれ消したい（上に統合したい）
+            grid_search_study_conductor = GridSearchStudyConductor(parameterizer, executor, evaluator, compile_once=COMPILE_ONCE, input_files=INPUT_FILES, memo=memo)
+            study_result = grid_search_study_conductor.run()
+            print(f"{study_result=}")
+    finally:
+        # NOTE: 常駐プロセスは要求の書き込み先が閉じられると終了するが，kill されずに残ったものがあれば終了させる
+        executor.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,195 @@
+
+
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Any, Iterator
+
+from optuna.study import StudyDirection
+
+from ezopt.models import ChoiceType, HyperParameter, HyperParameterWithChoices
+from ezopt.utils import compute_product
+
+
+class GridShard:
+    """
+    全ての HP が有限個の選択肢を持つ場合の grid（選択肢の直積）を，混合基数の番号で扱うクラス
+    - 番号 index の点は itertools.product と同じ順（最後の HP が最も速く変わる）で，直積を列挙せずに番号から直接求まる
+    - N 個に分けた i 番目 (0 始まり) の shard は，番号の範囲 [size * i // N, size * (i + 1) // N) を担当する
+    """
+    def __init__(self, hps: list[HyperParameter], shard_index: int = 0, n_shards: int = 1):
+        choices_hps = [hp for hp in hps if isinstance(hp, HyperParameterWithChoices)]
+        assert len(choices_hps) == len(hps), "GridSearch is only supported for HyperParameterWithChoices"
+        if not 0 <= shard_index < n_shards:
+            raise ValueError(f"shard_index must be in [0, n_shards): {shard_index=}, {n_shards=}")
+        self.hps = choices_hps
+        self.shard_index = shard_index
+        self.n_shards = n_shards
+        self.size = compute_product([len(hp.choices) for hp in self.hps])
+        self.start = self.size * shard_index // n_shards
+        self.stop = self.size * (shard_index + 1) // n_shards
+
+    def __len__(self) -> int:
+        """
+        この shard が担当する点の数
+        """
+        return self.stop - self.start
+
+    def params_at(self, index: int) -> tuple[ChoiceType, ...]:
+        """
+        grid 全体での番号 index の点の HP の組
+        """
+        assert 0 <= index < self.size
+        values: list[ChoiceType] = []
+        for hp in reversed(self.hps):
+            index, digit = divmod(index, len(hp.choices))
+            values.append(hp.choices[digit])
+        return tuple(reversed(values))
+
+    def indices(self, done: set[int] | dict[int, Any] | None = None) -> Iterator[int]:
+        """
+        この shard が担当する番号のうち，done に含まれないものを順に返す
+        """
+        for index in range(self.start, self.stop):
+            if done is None or index not in done:
+                yield index
+
+    @staticmethod
+    def parse_spec(spec: str) -> tuple[int, int]:
+        """
+        "i/N" という形式の指定を (i, N) に変換する
+        """
+        try:
+            shard_index, n_shards = (int(s) for s in spec.split("/"))
+        except ValueError:
+            raise ValueError(f"Shard must be given as 'i/N' (e.g. '0/4'): {spec}")
+        if not 0 <= shard_index < n_shards:
+            raise ValueError(f"Shard index must be in [0, N): {spec}")
+        return shard_index, n_shards
+
+    def __repr__(self):
+        return f"GridShard(shard={self.shard_index}/{self.n_shards}, indices=[{self.start}, {self.stop}), grid_size={self.size})"
+
+
+class GridShardResults:
+    """
+    shard ごとの結果ファイル（JSON Lines．追記のみ行う）
+    - 1 行目は header: {"shard": i, "n_shards": N, "grid_size": ..., "hp_names": [...], "direction": ...}
+    - 以降は一点につき一行: {"index": grid 全体での番号, "params": {HP の名前: 値}, "value": 評価値（得られなかった場合は null）}
+    同じ shard を同じファイルで再び実行すると，記録済みの番号は実行されない
+    """
+    def __init__(self, path: str | Path, shard: GridShard, direction: str | None = None):
+        self.path = Path(path)
+        self.shard = shard
+        self.direction = direction
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_file_name(shard: GridShard) -> str:
+        return f"shard_{shard.shard_index}_of_{shard.n_shards}.jsonl"
+
+    def header(self) -> dict[str, Any]:
+        return {
+            "shard": self.shard.shard_index,
+            "n_shards": self.shard.n_shards,
+            "grid_size": self.shard.size,
+            "hp_names": [hp.name for hp in self.shard.hps],
+            "direction": self.direction,
+        }
+
+    def load(self) -> dict[int, float | None]:
+        """
+        記録済みの {番号: 評価値} を返す（ファイルが無ければ header を書いて空の dict を返す）
+        NOTE: 中断時に書きかけだった最後の行は無視する
+        """
+        if not self.path.exists():
+            os.makedirs(self.path.parent, exist_ok=True)
+            with open(self.path, "w") as f:
+                f.write(json.dumps(self.header(), ensure_ascii=False) + "\n")
+            return {}
+        header, records = self.__class__.read(self.path)
+        # 書きかけの行に続けて追記しないよう，最後の改行より後ろを切り捨てる
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            while position > 0:
+                f.seek(position - 1)
+                if f.read(1) == b"\n":
+                    break
+                position -= 1
+            f.truncate(position)
+        if header != self.header():
+            raise ValueError(f"The results file {self.path} was written for another grid or shard: {header}")
+        return {record["index"]: record["value"] for record in records}
+
+    def append(self, index: int, params: tuple[ChoiceType, ...], value: float | None) -> None:
+        record = {"index": index, "params": {hp.name: v for hp, v in zip(self.shard.hps, params)}, "value": value}
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    @staticmethod
+    def read(path: str | Path) -> tuple[dict[str, Any], list[dict[str, Any]]]:
+        """
+        結果ファイルを (header, 各点の記録のリスト) として読む
+        """
+        with open(path, "r") as f:
+            header = json.loads(f.readline())
+            records = []
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                records.append(json.loads(line))
+        return header, records
+
+    @classmethod
+    def merge(cls, paths: list[Path], output_path: Path) -> dict[str, Any]:
+        """
+        複数の shard の結果ファイルを一つの stats.json にまとめ，その header を返す
+        （同じ番号の記録が複数ある場合は後に読んだものを用いる．trials は番号順）
+        """
+        if len(paths) == 0:
+            raise ValueError("No shard results files to merge")
+        header: dict[str, Any] | None = None
+        shards: set[int] = set()
+        records: dict[int, dict[str, Any]] = {}
+        for path in paths:
+            shard_header, shard_records = cls.read(path)
+            grid_header = {k: v for k, v in shard_header.items() if k != "shard"}
+            if header is None:
+                header = grid_header
+            elif grid_header != header:
+                raise ValueError(f"The results file {path} was written for another grid: {shard_header}")
+            shards.add(shard_header["shard"])
+            for record in shard_records:
+                records[record["index"]] = record
+        assert header is not None
+
+        maximize = header["direction"] != "minimize"
+        valued = [record for record in records.values() if record["value"] is not None]
+        best = (max if maximize else min)(valued, key=lambda record: record["value"]) if len(valued) > 0 else None
+        stats_header: dict[str, Any] = {
+            "n_trials": len(records),
+            "best_value": best["value"] if best is not None else None,
+            "best_params": best["params"] if best is not None else None,
+            # NOTE: StudyVisualizer の stats.json と同じく，optuna の StudyDirection の値（1: minimize, 2: maximize）で書き出す
+            "direction": int(StudyDirection.MAXIMIZE if maximize else StudyDirection.MINIMIZE),
+            "shards": {
+                "n_shards": header["n_shards"],
+                "merged": sorted(shards),
+                "grid_size": header["grid_size"],
+                "n_missing": header["grid_size"] - len(records),
+            },
+        }
+        # NOTE: 試行数が多い場合に巨大な文字列を作らないよう，試行は一つずつ書き出す（StudyVisualizer の stats.json と同様の形式）
+        with open(output_path, "w") as f:
+            f.write("{\n")
+            for key, value in stats_header.items():
+                f.write(f"  {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)},\n")
+            f.write('  "trials": [')
+            for i, index in enumerate(sorted(records)):
+                f.write("\n    " if i == 0 else ",\n    ")
+                f.write(json.dumps(records[index], ensure_ascii=False))
+            f.write("\n  ]\n}\n")
+        return stats_header
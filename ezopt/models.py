@@ -1,3 +1,5 @@
+from dataclasses import dataclass, field
+
 from pydantic import BaseModel, StrictBool, StrictFloat, StrictInt, StrictStr
 
 
@@ -29,7 +31,82 @@ class HyperParameterWithRange(HyperParameter):
         return f"{self.__class__.__name__}(name={self.name}, low={self.low}, high={self.high}, log={self.log})"
 
 
-class ExecutionResult(BaseModel):
-    stdout: str
-    stderr: str
+# NOTE: 以下の PhaseSpan / StreamedValues / ExecutionResult は試行ごと（フェーズごと）に大量に作られるので，
+#       検証を伴う pydantic のモデルではなく，__slots__ を持つ dataclass として軽量に保持する
+@dataclass(slots=True)
+class PhaseSpan:
+    """
+    試行の一つのフェーズ（ソースの書き出し・ビルド・実行・出力の解析など）にかかった時間
+    """
+    name: str
+    start: float  # 開始時刻 (time.time())
+    end: float  # 終了時刻 (time.time())
+    thread: str  # 記録したスレッドの名前（trace 上で行を分けるために用いる）
+
+
+@dataclass(slots=True)
+class StreamedValues:
+    """
+    実行中の出力から逐次抽出した評価値の，ストリーム (stdout / stderr) ごとの個数と集約値
+    """
+    stdout_count: int = 0
+    stdout_aggregate: float = 0.0
+    stderr_count: int = 0
+    stderr_aggregate: float = 0.0
+    metrics: list["StreamedValues"] = field(default_factory=list)  # OutputEvaluator.metric_evaluators のそれぞれについての同様の値
+
+
+@dataclass(slots=True)
+class ExecutionResult:
+    stdout: str  # truncated の場合は末尾のみ
+    stderr: str  # truncated の場合は末尾のみ
     return_code: int
+    killed: bool = False  # 途中で打ち切られた（kill された）かどうか
+    limit_exceeded: str | None = None  # 超過した実行制限（"wall_time" / "cpu_time" / "memory"．超過していなければ None）
+    spans: list[PhaseSpan] = field(default_factory=list)  # 各フェーズにかかった時間
+    peak_rss_kb: int | None = None  # 起動したプロセスたちの最大常駐メモリ [KB]
+    streamed_values: StreamedValues | None = None  # 実行中に抽出済みの評価値（None なら stdout / stderr から抽出する）
+    truncated: bool = False  # stdout / stderr の先頭が捨てられているかどうか
+
+
+class ExecutionLimits(BaseModel):
+    """
+    ビルド・実行の各フェーズ（シェルコマンドの一回の実行）に課す制限（None なら制限しない）
+    """
+    wall_time: float | None = None  # 経過時間の上限 [秒]．超えるとプロセスグループごと kill する
+    cpu_time: float | None = None  # 各プロセスの CPU 時間の上限 [秒] (RLIMIT_CPU)
+    memory_mb: float | None = None  # 各プロセスのアドレス空間の上限 [MB] (RLIMIT_AS)
+
+    def is_empty(self) -> bool:
+        return self.wall_time is None and self.cpu_time is None and self.memory_mb is None
+
+
+class ObjectiveSettings(BaseModel):
+    """
+    評価値 (value_pattern) に加えて最適化する目的関数と，試行が満たすべき制約
+    - 目的関数の並びは [評価値, (time なら) 実行フェーズの経過時間, *extra_objectives の指標]
+    - 出力から抽出する指標は，評価値と同様に出力内・ケース間で和をとったもの
+    """
+    time: bool = False  # 実行フェーズの経過時間（ケースの平均）[秒] を，最小化する目的関数に加えるか
+    extra_objectives: list[tuple[str, str]] = []  # (出力から指標を抽出するパターン, "minimize" / "maximize")
+    time_limit: float | None = None  # 実行フェーズの経過時間の，ケース間の time_quantile 分位点の上限 [秒]
+    time_quantile: float = 0.99
+    extra_constraints: list[tuple[str, float]] = []  # (出力から指標を抽出するパターン, 上限)
+
+    def is_empty(self) -> bool:
+        return not self.time and len(self.extra_objectives) == 0 and self.time_limit is None and len(self.extra_constraints) == 0
+
+    def is_multi_objective(self) -> bool:
+        return self.time or len(self.extra_objectives) > 0
+
+    def metric_patterns(self) -> list[str]:
+        """
+        出力から抽出する指標のパターンたち（extra_objectives, extra_constraints の順）
+        """
+        return [pattern for pattern, _ in self.extra_objectives] + [pattern for pattern, _ in self.extra_constraints]
+
+    def directions(self, direction: str) -> list[str]:
+        return [direction] + (["minimize"] if self.time else []) + [d for _, d in self.extra_objectives]
+
+    def names(self) -> list[str]:
+        return ["value"] + (["run_seconds"] if self.time else []) + [pattern for pattern, _ in self.extra_objectives]
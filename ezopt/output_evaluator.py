@@ -2,7 +2,7 @@
 
 import math
 import re
-from ezopt.models import ExecutionResult
+from ezopt.models import ExecutionResult, StreamedValues
 from ezopt.utils import safe_float
 
 
@@ -14,11 +14,17 @@ class OutputEvaluator:
         self,
         value_pattern: str,
         value_aggregation: str = "sum",
+        metric_patterns: list[str] | None = None,
     ):
         self.value_pattern = value_pattern
         self.value_aggregation = value_aggregation
+        self._compiled_value_pattern = re.compile(value_pattern, re.MULTILINE)
+        # metric_patterns: 評価値とは別に出力から抽出する指標（目的関数・制約に用いる）のパターンたち（出力内では和をとる）
+        self.metric_evaluators = [self.__class__(pattern) for pattern in metric_patterns or []]
 
     def evaluate(self, execution_result: ExecutionResult) -> float | None:
+        if execution_result.streamed_values is not None:
+            return self._evaluate_streamed(execution_result.streamed_values)
         values_from_stdout = self.extract_values(execution_result.stdout)
         values_from_stderr = self.extract_values(execution_result.stderr)
         if len(values_from_stdout) > 0 and len(values_from_stderr) > 0:
@@ -28,7 +34,50 @@ class OutputEvaluator:
 
         if len(values) == 0:
             return None
-        
+
+        return self.aggregate(values)
+
+    def _evaluate_streamed(self, streamed_values: StreamedValues) -> float | None:
+        if streamed_values.stdout_count > 0 and streamed_values.stderr_count > 0:
+            raise RuntimeError("Both stdout and stderr contain values. This is ambiguous.")
+        if streamed_values.stdout_count > 0:
+            return streamed_values.stdout_aggregate
+        if streamed_values.stderr_count > 0:
+            return streamed_values.stderr_aggregate
+        return None
+
+    def create_stream_parser(self) -> "OutputStreamParser":
+        """
+        実行中の出力を逐次評価するためのパーサーを作る（一回の実行ごとに一つ作る）
+        """
+        return OutputStreamParser(self)
+
+    def evaluate_cases(self, execution_results: list[ExecutionResult]) -> tuple[float | None, list[float | None]]:
+        """
+        複数のテストケースの実行結果を受け取り，(全体の評価値, 各ケースの評価値のリスト) を返す
+        いずれかのケースで評価値が得られなかった場合，全体の評価値は None とする
+        """
+        case_values = [self.evaluate(result) for result in execution_results]
+        if any(v is None for v in case_values):
+            return None, case_values
+        # NOTE: 各ケースの評価値は既に集約済み（sumlog なら対数和）なので，ケース間では単純に和をとる
+        return sum(v for v in case_values if v is not None), case_values
+
+    def evaluate_metrics(self, execution_results: list[ExecutionResult]) -> list[float | None]:
+        """
+        複数のテストケースの実行結果を受け取り，metric_evaluators のそれぞれについてケース間で和をとった指標を返す
+        いずれかのケースで指標が得られなかった場合，その指標は None とする
+        """
+        metrics: list[float | None] = []
+        for i, metric_evaluator in enumerate(self.metric_evaluators):
+            case_metrics = [
+                metric_evaluator._evaluate_streamed(result.streamed_values.metrics[i]) if result.streamed_values is not None else metric_evaluator.evaluate(result)
+                for result in execution_results
+            ]
+            metrics.append(None if any(v is None for v in case_metrics) else sum(v for v in case_metrics if v is not None))
+        return metrics
+
+    def aggregate(self, values: list[float]) -> float:
         if self.value_aggregation == "sum":
             value = sum(values)
         elif self.value_aggregation == "sumlog":
@@ -37,22 +86,76 @@ class OutputEvaluator:
             raise ValueError(f"Unsupported value_aggregation: {self.value_aggregation}")
         
         return value
+
+    def aggregate_term(self, value: float) -> float:
+        """
+        aggregate の和の一項分（値を一つずつ受け取って集約値を更新するためのもの）
+        """
+        if self.value_aggregation == "sum":
+            return value
+        elif self.value_aggregation == "sumlog":
+            return math.log(value) if value > 0 else 0.0
+        else:
+            raise ValueError(f"Unsupported value_aggregation: {self.value_aggregation}")
     
     def extract_values(self, output: str) -> list[float]:
         """
         output から value として解釈可能な値を全て抽出して返す
         """
         values = [
-            value for m in re.finditer(self.value_pattern, output, re.MULTILINE)
+            value for m in self._compiled_value_pattern.finditer(output)
             if (value := safe_float(m.group(1))) is not None
         ]
         return values
     
+    def extract_value_from_line(self, line: str) -> float | None:
+        """
+        出力の一行から value として解釈可能な値を抽出して返す（実行中の出力を逐次評価するためのもの）
+        """
+        m = self._compiled_value_pattern.search(line)
+        return safe_float(m.group(1)) if m is not None else None
+
     def __repr__(self):
-        return f"OutputEvaluator(value_pattern={self.value_pattern}, value_aggregation={self.value_aggregation})"
+        metric_patterns = [e.value_pattern for e in self.metric_evaluators]
+        return f"OutputEvaluator(value_pattern={self.value_pattern}, value_aggregation={self.value_aggregation}" + (f", metric_patterns={metric_patterns})" if len(metric_patterns) > 0 else ")")
+
+class OutputStreamParser:
+    """
+    実行中の出力を（行単位の）塊ごとに受け取り，評価値を逐次抽出して集約するクラス
+    出力全体を保持しないので，対象プログラムがどれだけ出力してもメモリ使用量は増えない
+    NOTE: 塊の境界は実行ごとに変わりうるので，value_pattern は一行に収まるものである必要がある
+    """
+    def __init__(self, evaluator: OutputEvaluator):
+        self.evaluator = evaluator
+        # NOTE: stdout と stderr は別々のスレッドから feed されるので，ストリームごとに別の変数に集約する
+        self._counts = {"stdout": 0, "stderr": 0}
+        self._aggregates = {"stdout": 0.0, "stderr": 0.0}
+        self._metric_parsers = [self.__class__(metric_evaluator) for metric_evaluator in evaluator.metric_evaluators]
+
+    def feed(self, stream: str, text: str) -> None:
+        """
+        stream ("stdout" / "stderr") に出力された text（改行で終わる，一行以上の塊）から評価値を抽出する
+        """
+        for m in self.evaluator._compiled_value_pattern.finditer(text):
+            if (value := safe_float(m.group(1))) is not None:
+                self._counts[stream] += 1
+                self._aggregates[stream] += self.evaluator.aggregate_term(value)
+        for metric_parser in self._metric_parsers:
+            metric_parser.feed(stream, text)
+
+    def result(self) -> StreamedValues:
+        return StreamedValues(
+            stdout_count=self._counts["stdout"],
+            stdout_aggregate=self._aggregates["stdout"],
+            stderr_count=self._counts["stderr"],
+            stderr_aggregate=self._aggregates["stderr"],
+            metrics=[metric_parser.result() for metric_parser in self._metric_parsers],
+        )
 
-# TODO: 複数のスコアを受け取って，それらの和や対数和で評価するようなEvaluatorを作る？
 
 class TrivialOutputEvaluator:
     def evaluate(self, execution_result: ExecutionResult) -> float | None:
         return None
+
+    def evaluate_cases(self, execution_results: list[ExecutionResult]) -> tuple[float | None, list[float | None]]:
+        return None, [None for _ in execution_results]
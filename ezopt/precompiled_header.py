@@ -0,0 +1,133 @@
+
+
+import hashlib
+import os
+from pathlib import Path
+import re
+import shlex
+import subprocess
+import threading
+
+from ezopt.models import PhaseSpan
+from ezopt.trial_profiler import TrialProfiler
+from ezopt.utils import get_random_hex, write_text_file
+
+
+# 先頭のインクルードの並びとみなす行（空行・行コメント・山括弧のインクルード）
+LEADING_LINE_PATTERN = re.compile(r"\s*(//.*)?|\s*#\s*include\s*<[^>]+>\s*(//.*)?")
+# プリコンパイル済みヘッダ (.gch) を扱えるコンパイラ (g++) のコマンド名
+GXX_PATTERN = re.compile(r"(.*-)?g\+\+(-[\d.]+)?")
+
+
+class PrecompiledHeader:
+    """
+    ソースの先頭に並ぶ重いインクルード（#include <bits/stdc++.h> など）をプリコンパイル済みヘッダにして，各試行のビルドを速くするクラス
+    - ビルドコマンドと同じコンパイラ・フラグで，先頭のインクルードの並びだけのヘッダを一度だけ .gch にコンパイルしておく
+    - 各試行のソースは，先頭のインクルードの並びをそのヘッダのインクルード（と行数を合わせるための空行）に置き換えてからビルドする
+    - ヘッダはフラグとヘッダの内容のハッシュごとのディレクトリに置かれるので，フラグが変わればプリコンパイルし直される
+    - .gch を作れなかった場合は元のソースのままビルドする．また g++ は .gch が使えない場合（コンパイラの更新など）は自動的にテキストのヘッダを読む
+    """
+    HEADER_NAME = "ezopt_pch.h"
+
+    def __init__(self, compiler: str, flags: list[str], pch_dir: Path):
+        self.compiler = compiler
+        self.flags = flags
+        self.pch_dir = pch_dir
+        self._lock = threading.Lock()
+        # ヘッダの内容 → プリコンパイル済みのヘッダのパス（作れなかった場合は None）
+        self._headers: dict[str, Path | None] = {}
+
+    @classmethod
+    def from_build_cmd(cls, build_cmd: str, source_file: str, pch_dir: Path) -> "PrecompiledHeader | None":
+        """
+        ビルドコマンドのうち source_file をコンパイルする部分からコンパイラとフラグを取り出す（g++ の単純な呼び出しでなければ None）
+        リンクのためのフラグと出力先は除き，それ以外のフラグ（-O2, -std=..., -D... など）はそのまま用いる
+        """
+        parts = [part for part in re.split(r"\s*(?:&&|;)\s*", build_cmd) if source_file in part]
+        if len(parts) != 1:
+            return None
+        try:
+            tokens = shlex.split(parts[0])
+        except ValueError:
+            return None
+        if len(tokens) == 0 or GXX_PATTERN.fullmatch(os.path.basename(tokens[0])) is None:
+            return None
+        flags: list[str] = []
+        skip_next = False
+        for token in tokens[1:]:
+            if skip_next:
+                skip_next = False
+            elif token in ("-o", "-L", "-l"):
+                skip_next = True
+            elif token == source_file or token == "-c" or token.startswith(("-o", "-l", "-L", "-Wl,")):
+                continue
+            elif not token.startswith("-"):
+                # NOTE: 他のソースファイルやオブジェクトファイルと一緒にコンパイルする場合などは対応しない
+                return None
+            else:
+                flags.append(token)
+        return cls(tokens[0], flags, pch_dir)
+
+    @staticmethod
+    def split_leading_includes(source: str) -> tuple[str, str, int]:
+        """
+        source を (先頭のインクルードの並び, 残り, 先頭の並びの行数) に分ける（インクルードが無ければ先頭の並びは空）
+        """
+        lines = source.splitlines(keepends=True)
+        n_leading = 0
+        while n_leading < len(lines) and LEADING_LINE_PATTERN.fullmatch(lines[n_leading].rstrip("\r\n")) is not None:
+            n_leading += 1
+        # NOTE: 末尾の空行・コメントは残りに含める（インクルードを含まない並びは置き換えない）
+        while n_leading > 0 and re.match(r"\s*#\s*include", lines[n_leading - 1]) is None:
+            n_leading -= 1
+        return "".join(lines[:n_leading]), "".join(lines[n_leading:]), n_leading
+
+    def apply(self, source: str, spans: list[PhaseSpan] | None = None) -> str:
+        """
+        source の先頭のインクルードの並びをプリコンパイル済みヘッダのインクルードに置き換えたものを返す
+        （初めて現れた並びはここでプリコンパイルし，その時間は spans に pch というフェーズとして追加する）
+        """
+        header, rest, n_leading = self.__class__.split_leading_includes(source)
+        if len(header) == 0:
+            return source
+        with self._lock:
+            if header not in self._headers:
+                with TrialProfiler.span(spans if spans is not None else [], "pch"):
+                    self._headers[header] = self._compile(header)
+            header_path = self._headers[header]
+        if header_path is None:
+            return source
+        # NOTE: 置き換えた行数だけ空行を入れ，エラーメッセージの行番号・該当行が元のソースと一致するようにする
+        return f'#include "{header_path}"\n' + "\n" * (n_leading - 1) + rest
+
+    def _compile(self, header: str) -> Path | None:
+        h = hashlib.sha256()
+        for part in [self.compiler, *self.flags, header]:
+            h.update(part.encode())
+            h.update(b"\0")
+        header_dir = (self.pch_dir / h.hexdigest()[:16]).resolve()
+        header_path = header_dir / self.HEADER_NAME
+        gch_path = header_dir / f"{self.HEADER_NAME}.gch"
+        if gch_path.exists():
+            # NOTE: 同じコンパイラ・フラグ・内容で以前に作ったもの
+            return header_path
+        os.makedirs(header_dir, exist_ok=True)
+        write_text_file(header_path, header)
+        # NOTE: 他のプロセスと同時に作っても壊れたファイルが見えないよう，一時ファイルに書いてから rename する
+        tmp_gch_path = header_dir / f".{self.HEADER_NAME}.{get_random_hex(8)}.gch"
+        result = subprocess.run(
+            [self.compiler, *self.flags, "-x", "c++-header", str(header_path), "-o", str(tmp_gch_path)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if result.returncode != 0:
+            if tmp_gch_path.exists():
+                tmp_gch_path.unlink()
+            print(f"Warning: failed to precompile the leading includes; building without a precompiled header\n{result.stderr}")
+            return None
+        os.replace(tmp_gch_path, gch_path)
+        return header_path
+
+    def __repr__(self):
+        return f"PrecompiledHeader(compiler={self.compiler}, flags={self.flags}, pch_dir={self.pch_dir})"
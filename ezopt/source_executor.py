@@ -1,36 +1,501 @@
 
 
+import codecs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import locale
+import math
+import os
 from pathlib import Path
+import queue
 import re
+import resource
+import selectors
+import shlex
+import shutil
+import signal
 import subprocess
+import threading
+import time
+from typing import IO, Callable, Iterator
 
-from ezopt.models import ExecutionResult
+from ezopt.build_cache import BuildCache
+from ezopt.models import ExecutionLimits, ExecutionResult, PhaseSpan
+from ezopt.output_evaluator import OutputStreamParser
+from ezopt.precompiled_header import PrecompiledHeader
+from ezopt.trial_profiler import TrialProfiler
 from ezopt.utils import write_text_file
 
 
+class ExecutionMonitor:
+    """
+    実行中のプロセスの出力を逐次受け取り，実行を打ち切るべきかどうかを判断するクラスの基底クラス
+    """
+    def on_line(self, line: str) -> None:
+        pass
+
+    def on_case_finished(self, index: int, result: ExecutionResult) -> None:
+        pass
+
+    def should_stop(self) -> bool:
+        return False
+
+
+# 出力を一度に読み込む最大のバイト数
+READ_CHUNK_BYTES = 1 << 16
+# 改行が現れないまま溜まった出力がこの文字数を超えたら，そこまでを一つの塊として扱う（改行の無い巨大な出力でメモリを使い切らないように）
+MAX_LINE_CHARS = 1 << 20
+# monitor を渡して実行する場合に，（他のスレッドから指示されうる）打ち切りを確認する間隔 [s]
+MONITOR_POLL_SECONDS = 0.05
+
+
+class OutputBuffer:
+    """
+    出力を（行単位の）塊ごとに溜めておくバッファ．max_chars を指定すると末尾の max_chars 文字のみを保持するリングバッファとなる
+    """
+    def __init__(self, max_chars: int | None = None):
+        self.max_chars = max_chars
+        self.truncated = False
+        self._lines: deque[str] = deque()
+        self._n_chars = 0
+
+    def append(self, line: str) -> None:
+        self._lines.append(line)
+        self._n_chars += len(line)
+        if self.max_chars is None:
+            return
+        # NOTE: 最後の塊は（max_chars より長くても）残す（getvalue で切り詰める）
+        while self._n_chars > self.max_chars and len(self._lines) > 1:
+            self._n_chars -= len(self._lines.popleft())
+            self.truncated = True
+
+    def getvalue(self) -> str:
+        value = "".join(self._lines)
+        return value[-self.max_chars:] if self.max_chars is not None and self.truncated else value
+
+
 class SourceExecutor:
     """
     具体値代入後のソースを受け取って，それを実行するクラス
     """
-    def __init__(self, original_cmd: str):
-        self.tmp_file_path = self.__class__.get_tmp_file_path()
+    def __init__(
+        self,
+        original_cmd: str,
+        sandbox_dir: Path | None = None,
+        build_cache: BuildCache | None = None,
+        case_runner: ThreadPoolExecutor | None = None,
+        limits: ExecutionLimits | None = None,
+        cpus: list[int] | None = None,
+        output_tail_chars: int = 64 * 1024,
+        persistent_max_evaluations: int | None = None,
+        precompiled_header: PrecompiledHeader | None = None,
+    ):
+        # NOTE: ソースファイルとバイナリは sandbox_dir 内に閉じ込める（並列実行時に互いに干渉しないように）
+        self.sandbox_dir = (sandbox_dir if sandbox_dir is not None else self.__class__.get_tmp_file_path().parent).resolve()
+        os.makedirs(self.sandbox_dir, exist_ok=True)
+        self.tmp_file_path = self.sandbox_dir / self.__class__.get_tmp_file_path().name
 
         self.cpp_file = self.__class__.extract_cpp_file(original_cmd)
-        self.mod_cmd = original_cmd.replace(self.cpp_file, str(self.tmp_file_path))
+        mod_cmd = original_cmd.replace(self.cpp_file, str(self.tmp_file_path))
+        self.mod_cmd = self.__class__.isolate_binary_file(mod_cmd, self.sandbox_dir)
+        binary_file = self.__class__.extract_binary_file(original_cmd)
+        self.binary_path = self.sandbox_dir / Path(binary_file).name if binary_file is not None else None
+        # mod_cmd をビルドフェーズと実行フェーズに分割したもの（分割できない場合 run_cmd は None）
+        self.build_cmd, self.run_cmd = self.__class__.split_cmd(self.mod_cmd, str(self.tmp_file_path))
+        # NOTE: ビルドキャッシュのキーはサンドボックスの場所に依存しないようにする
+        self.build_cache = build_cache if self.run_cmd is not None and self.binary_path is not None else None
+        self._build_cmd_for_cache_key = self.build_cmd.replace(str(self.sandbox_dir), "<sandbox>")
+        # 複数の入力ファイルに対する実行を並列に行うためのスレッドプール（None なら逐次実行）
+        self.case_runner = case_runner
+        # ビルド・実行の各フェーズに課す制限（None なら制限しない）
+        self.limits = limits
+        # このワーカーが起動するプロセスを割り当てる CPU の番号たち（None なら割り当てない）
+        self.cpus = cpus
+        # 出力を逐次評価する場合に，エラーメッセージ用に残しておく各ストリームの末尾の文字数
+        self.output_tail_chars = output_tail_chars
+        # 現在サンドボックス内にあるバイナリのビルド元のソース（同じソースの再ビルドを省略するために用いる）
+        self._built_source: str | None = None
+        # persistent_max_evaluations: 実行フェーズを常駐プロセス (PersistentProcess) で行う場合の，一つのプロセスで行う評価の回数の上限（None なら評価ごとに起動する）
+        self.persistent_max_evaluations = persistent_max_evaluations
+        if persistent_max_evaluations is not None and self.run_cmd is None:
+            raise ValueError(f"Persistent processes require CMD of the form '<build> && <run>': {self.mod_cmd=}")
+        self._persistent_processes: list[PersistentProcess] = []
+        self._idle_persistent_processes: queue.Queue[PersistentProcess] = queue.Queue()
+        self._persistent_lock = threading.Lock()
+        # precompiled_header: ビルドフェーズで先頭のインクルードの並びをプリコンパイル済みヘッダに置き換えるためのもの（None なら置き換えない）
+        self.precompiled_header = precompiled_header
 
-    def execute(self, mod_source: str) -> ExecutionResult:
+    def execute(
+        self,
+        mod_source: str,
+        env: dict[str, str] | None = None,
+        monitor: ExecutionMonitor | None = None,
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> ExecutionResult:
+        """
+        env は環境変数に追加される（ビルドと実行に分割できる場合は実行フェーズのみ）
+        output_parser を指定すると，実行フェーズの出力はそれが返すパーサーで逐次評価され，結果には出力の末尾のみが残る
+        """
+        if self.run_cmd is not None:
+            # ビルドと実行に分割できる場合は分けて行う（それぞれの時間を計測でき，キャッシュにヒットすればビルドを省略できる）
+            build_result = self.build(mod_source)
+            if build_result.return_code != 0:
+                return build_result
+            run_result = self.run(env=env, monitor=monitor, output_parser=output_parser)
+            return ExecutionResult(
+                stdout=build_result.stdout + run_result.stdout,
+                stderr=build_result.stderr + run_result.stderr,
+                return_code=run_result.return_code,
+                killed=run_result.killed,
+                limit_exceeded=run_result.limit_exceeded,
+                spans=build_result.spans + run_result.spans,
+                peak_rss_kb=run_result.peak_rss_kb,  # NOTE: コンパイラではなく対象プログラムのメモリ使用量を見たいので，実行フェーズのもののみ
+                streamed_values=run_result.streamed_values,
+                truncated=run_result.truncated,
+            )
+        spans: list[PhaseSpan] = []
         # source を一時ファイルに書き出す
-        write_text_file(self.tmp_file_path, mod_source)
+        with TrialProfiler.span(spans, "write"):
+            write_text_file(self.tmp_file_path, mod_source)
         # cmd の cppfile 部分を一時ファイルのパスに差し替えた mod_cmd を実行する
-        proc = subprocess.run(self.mod_cmd, shell=True, capture_output=True, text=True)
-        # TODO: 出力をリアルタイムで見られるようにする機能
-        # TODO: 出力をリアルタイムで監視して pruning する機能
+        result = self._run_shell(self.mod_cmd, env=env, monitor=monitor, phase="execute", output_parser=output_parser)
+        result.spans[:0] = spans
+        return result
+
+    def build(self, mod_source: str) -> ExecutionResult:
+        """
+        ビルドフェーズのみを実行する（直前にこのサンドボックスでビルドしたものと同じソースなら，ビルドを省略する）
+        """
+        if self.run_cmd is None:
+            raise ValueError(f"CMD cannot be split into build and run phases (expected '<build> && <run>'): {self.mod_cmd=}")
+        if mod_source == self._built_source and (self.binary_path is None or self.binary_path.exists()):
+            return ExecutionResult(stdout="", stderr="", return_code=0)
+        self._built_source = None
+        cache_key = None
+        spans: list[PhaseSpan] = []
+        if self.build_cache is not None:
+            assert self.binary_path is not None
+            cache_key = self.build_cache.compute_key(mod_source, self._build_cmd_for_cache_key)
+            with TrialProfiler.span(spans, "cache_load"):
+                hit = self.build_cache.load(cache_key, self.binary_path)
+            if hit:
+                self._built_source = mod_source
+                return ExecutionResult(stdout="", stderr="", return_code=0, spans=spans)
+        build_source = self.precompiled_header.apply(mod_source, spans) if self.precompiled_header is not None else mod_source
+        with TrialProfiler.span(spans, "write"):
+            write_text_file(self.tmp_file_path, build_source)
+        result = self._run_shell(self.build_cmd, phase="build")
+        result.spans[:0] = spans
+        if result.return_code == 0:
+            self._built_source = mod_source
+        if cache_key is not None and result.return_code == 0:
+            assert self.build_cache is not None and self.binary_path is not None
+            with TrialProfiler.span(result.spans, "cache_store"):
+                self.build_cache.store(cache_key, self.binary_path)
+        return result
+
+    def run(
+        self,
+        env: dict[str, str] | None = None,
+        input_file: Path | None = None,
+        monitor: ExecutionMonitor | None = None,
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> ExecutionResult:
+        """
+        ビルド済みのバイナリに対して実行フェーズのみを実行する（env は環境変数に追加される）
+        input_file が指定された場合は，実行フェーズの標準入力をそのファイルに差し替える
+        output_parser については execute を参照
+        """
+        if self.run_cmd is None:
+            raise ValueError(f"CMD cannot be split into build and run phases (expected '<build> && <run>'): {self.mod_cmd=}")
+        if self.persistent_max_evaluations is not None:
+            return self._run_persistent(env=env, input_file=input_file, monitor=monitor, output_parser=output_parser)
+        run_cmd = self.run_cmd if input_file is None else self.__class__.redirect_stdin(self.run_cmd, input_file)
+        return self._run_shell(run_cmd, env=env, monitor=monitor, phase="run", output_parser=output_parser)
+
+    def _run_persistent(
+        self,
+        env: dict[str, str] | None = None,
+        input_file: Path | None = None,
+        monitor: ExecutionMonitor | None = None,
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> ExecutionResult:
+        """
+        空いている常駐プロセスに評価を依頼する（全て使用中なら新たに作る．入力ファイルごとの並列実行ではその数だけ常駐する）
+        """
+        assert self.run_cmd is not None and self.persistent_max_evaluations is not None
+        try:
+            process = self._idle_persistent_processes.get_nowait()
+        except queue.Empty:
+            process = PersistentProcess(self.run_cmd, self.persistent_max_evaluations, limits=self.limits, cpus=self.cpus, output_tail_chars=self.output_tail_chars)
+            with self._persistent_lock:
+                self._persistent_processes.append(process)
+        # NOTE: 標準入力は評価ごとに読み直させる（input_file が無ければ CMD のリダイレクト先）
+        m = re.search(r"<\s*([^\s<>|&;]+)", self.run_cmd)
+        stdin_file = str(input_file) if input_file is not None else (m.group(1) if m is not None else "")
+        try:
+            return process.evaluate({**(env if env is not None else {}), "EZOPT_INPUT": stdin_file}, monitor=monitor, output_parser=output_parser)
+        finally:
+            self._idle_persistent_processes.put(process)
+
+    def close(self) -> None:
+        """
+        常駐プロセスを終了させる
+        """
+        with self._persistent_lock:
+            for process in self._persistent_processes:
+                process.close()
+
+    @property
+    def is_persistent(self) -> bool:
+        return self.persistent_max_evaluations is not None
+
+    @contextmanager
+    def retain_builds(self) -> Iterator[None]:
+        """
+        with ブロックの間，ビルド済みのバイナリをサンドボックス内の一時的なビルドキャッシュに残し，同じソースの再ビルドを省略する
+        （いくつもの候補を交互に実行する successive halving などのため．ビルドキャッシュが既にある場合はそれを用いる）
+        """
+        with self.__class__._retain_builds([self], self.sandbox_dir / "builds"):
+            yield
+
+    @staticmethod
+    @contextmanager
+    def _retain_builds(executors: list["SourceExecutor"], cache_dir: Path) -> Iterator[None]:
+        # NOTE: キーはサンドボックスの場所に依存しないので，一つのキャッシュを executors の全てで共有できる
+        targets = [executor for executor in executors if executor.build_cache is None and executor.run_cmd is not None and executor.binary_path is not None]
+        if len(targets) == 0:
+            yield
+            return
+        build_cache = BuildCache(cache_dir)
+        for executor in targets:
+            executor.build_cache = build_cache
+        try:
+            yield
+        finally:
+            for executor in targets:
+                executor.build_cache = None
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def run_cases(
+        self,
+        input_files: list[Path],
+        env: dict[str, str] | None = None,
+        monitor: ExecutionMonitor | None = None,
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> list[ExecutionResult]:
+        """
+        ビルド済みのバイナリを各入力ファイルに対して（case_runner があれば並列に）実行し，入力ファイルと同じ順で結果を返す
+        monitor が打ち切りを指示した後，またはいずれかのケースが実行制限を超えた後のケースは実行せず，killed な結果とする
+        """
+        limit_exceeded = threading.Event()
+
+        def _run_case(index: int, input_file: Path) -> ExecutionResult:
+            if (monitor is not None and monitor.should_stop()) or limit_exceeded.is_set():
+                return ExecutionResult(stdout="", stderr="", return_code=-signal.SIGKILL, killed=True)
+            result = self.run(env=env, input_file=input_file, monitor=monitor, output_parser=output_parser)
+            if result.limit_exceeded is not None:
+                # NOTE: 制限を超えたケースがあれば試行自体が失敗扱いになるので，残りのケースは実行しない
+                limit_exceeded.set()
+            if monitor is not None:
+                monitor.on_case_finished(index, result)
+            return result
+
+        if self.case_runner is None:
+            return [_run_case(i, input_file) for i, input_file in enumerate(input_files)]
+        return list(self.case_runner.map(_run_case, range(len(input_files)), input_files))
+
+    def execute_cases(
+        self,
+        mod_source: str,
+        input_files: list[Path],
+        env: dict[str, str] | None = None,
+        monitor: ExecutionMonitor | None = None,
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> list[ExecutionResult]:
+        """
+        一度だけビルドし，各入力ファイルに対して実行する（ビルドに失敗した場合はビルドの結果のみを返す）
+        """
+        build_result = self.build(mod_source)
+        if build_result.return_code != 0:
+            return [build_result]
+        results = self.run_cases(input_files, env=env, monitor=monitor, output_parser=output_parser)
+        # NOTE: ビルドにかかった時間が失われないよう，先頭のケースの結果に含めておく
+        results[0].spans[:0] = build_result.spans
+        return results
+
+    def _run_shell(
+        self,
+        cmd: str,
+        env: dict[str, str] | None = None,
+        monitor: ExecutionMonitor | None = None,
+        phase: str = "execute",
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> ExecutionResult:
+        """
+        cmd を実行し，stdout / stderr を一行ずつ読みながら monitor に渡す
+        monitor が打ち切りを指示した場合，または経過時間が self.limits.wall_time を超えた場合はプロセスグループごと kill する
+        実行にかかった時間は phase という名前のフェーズとして記録する
+        output_parser を指定すると，各行はそのパーサーに渡され，stdout / stderr は末尾 self.output_tail_chars 文字程度のみが残される
+        """
+        cls = self.__class__
+        limits = self.limits if self.limits is not None else ExecutionLimits()
+        start = time.time()
+        with cls._pin_current_thread(self.cpus):
+            # NOTE: CPU の割り当ては fork 時に子プロセスへ引き継がれる
+            proc = subprocess.Popen(
+                cls.apply_limits(cmd, limits),
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env={**os.environ, **env} if env is not None else None,
+                start_new_session=True,  # NOTE: kill するときにシェルの子孫プロセスもまとめて kill できるようにする
+            )
+        deadline = time.monotonic() + limits.wall_time if limits.wall_time is not None else None
+        assert proc.stdout is not None and proc.stderr is not None
+        parser = output_parser() if output_parser is not None else None
+        max_chars = self.output_tail_chars if parser is not None else None
+        stdout_buffer = OutputBuffer(max_chars)
+        stderr_buffer = OutputBuffer(max_chars)
+        readers = {
+            proc.stdout.fileno(): _OutputReader(proc.stdout, "stdout", stdout_buffer, monitor, parser),
+            proc.stderr.fileno(): _OutputReader(proc.stderr, "stderr", stderr_buffer, monitor, parser),
+        }
+        # NOTE: シェルの終了は pidfd で待つ（シェルが終了しても，バックグラウンドに残った子孫プロセスがパイプを握っていることがあるため）
+        pidfd = os.pidfd_open(proc.pid) if hasattr(os, "pidfd_open") else None
+        selector = selectors.DefaultSelector()
+        for fd in readers:
+            selector.register(fd, selectors.EVENT_READ)
+        if pidfd is not None:
+            selector.register(pidfd, selectors.EVENT_READ)
+
+        killed = False
+        timed_out = False
+        rusage: resource.struct_rusage | None = None
+        try:
+            # NOTE: 出力が閉じられてもシェルが終了していなければ，（制限時間などを確認しながら）その終了を待つ
+            while len(readers) > 0 or (rusage is None and pidfd is not None):
+                # NOTE: 出力・シェルの終了・制限時間のいずれかまで待つ（monitor への打ち切りの指示は他のスレッドからも来るので，一定間隔で確認する）
+                timeout: float | None = None
+                if not killed and deadline is not None:
+                    timeout = max(0.0, deadline - time.monotonic())
+                if not killed and monitor is not None:
+                    timeout = min(timeout, MONITOR_POLL_SECONDS) if timeout is not None else MONITOR_POLL_SECONDS
+                for key, _ in selector.select(timeout):
+                    if key.fd == pidfd:
+                        selector.unregister(pidfd)
+                        rusage = cls._reap(proc)
+                        # NOTE: シェルが先に終了しても，バックグラウンドに残った子孫プロセスがパイプを握ったままにならないようにする
+                        if deadline is not None:
+                            cls._kill_process_group(proc)
+                    elif not readers[key.fd].read():
+                        selector.unregister(key.fd)
+                        del readers[key.fd]
+                if killed or rusage is not None:
+                    continue
+                if monitor is not None and monitor.should_stop():
+                    cls._kill_process_group(proc)
+                    killed = True
+                elif deadline is not None and time.monotonic() > deadline:
+                    cls._kill_process_group(proc)
+                    killed = timed_out = True
+        finally:
+            selector.close()
+            if pidfd is not None:
+                os.close(pidfd)
+        if rusage is None:
+            # NOTE: pidfd が使えない環境では，出力が閉じられた後はブロックしてシェルの終了を待つ
+            rusage = cls._reap(proc)
+        if deadline is not None:
+            cls._kill_process_group(proc)
+
+        stderr = stderr_buffer.getvalue()
         return ExecutionResult(
-            stdout=proc.stdout,
-            stderr=proc.stderr,
+            stdout=stdout_buffer.getvalue(),
+            stderr=stderr,
             return_code=proc.returncode,
+            killed=killed,
+            limit_exceeded="wall_time" if timed_out else cls.detect_limit_exceeded(proc.returncode, stderr, limits),
+            spans=[PhaseSpan(name=phase, start=start, end=time.time(), thread=threading.current_thread().name)],
+            peak_rss_kb=rusage.ru_maxrss,  # NOTE: Linux では KB 単位
+            streamed_values=parser.result() if parser is not None else None,
+            truncated=stdout_buffer.truncated or stderr_buffer.truncated,
         )
-        
+
+    @staticmethod
+    def apply_limits(cmd: str, limits: ExecutionLimits) -> str:
+        """
+        CPU 時間・アドレス空間の制限を（シェルの ulimit で）かけた上で cmd を実行するコマンドを返す
+        NOTE: preexec_fn はスレッドと併用すると安全でないため，シェルの組み込みコマンドで制限する
+        """
+        prefixes: list[str] = []
+        if limits.cpu_time is not None:
+            # NOTE: soft limit で SIGXCPU を送らせ（制限超過を判別できるように），それを無視するプロセスは 1 秒後の hard limit で SIGKILL させる
+            cpu_seconds = max(1, math.ceil(limits.cpu_time))
+            prefixes.append(f"ulimit -S -t {cpu_seconds}; ulimit -H -t {cpu_seconds + 1}")
+        if limits.memory_mb is not None:
+            prefixes.append(f"ulimit -v {max(1, int(limits.memory_mb * 1024))}")
+        if len(prefixes) == 0:
+            return cmd
+        return "; ".join(prefixes) + "; " + cmd
+
+    @staticmethod
+    def detect_limit_exceeded(return_code: int, stderr: str, limits: ExecutionLimits) -> str | None:
+        """
+        終了したプロセスの終了コード・標準エラー出力から，CPU 時間・アドレス空間の制限を超えたかどうかを推定する
+        - CPU 時間: SIGXCPU で終了した（シェル経由の場合は 128 + SIGXCPU）
+        - アドレス空間: メモリ確保の失敗を表すメッセージ (std::bad_alloc など) が出力された
+        """
+        if limits.cpu_time is not None and return_code in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+            return "cpu_time"
+        if limits.memory_mb is not None and return_code != 0 and re.search(r"bad_alloc|Cannot allocate memory|[Oo]ut of memory", stderr) is not None:
+            return "memory"
+        return None
+
+    @staticmethod
+    @contextmanager
+    def _pin_current_thread(cpus: list[int] | None) -> Iterator[None]:
+        """
+        with ブロックの間だけ，呼び出したスレッドを cpus に割り当てる
+        NOTE: Linux の sched_setaffinity(0, ...) は呼び出したスレッドのみに作用するので，他のワーカーのスレッドには影響しない
+        """
+        if cpus is None or not hasattr(os, "sched_setaffinity"):
+            yield
+            return
+        original_cpus = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cpus)
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, original_cpus)
+
+    @staticmethod
+    def _reap(proc: subprocess.Popen) -> resource.struct_rusage:
+        """
+        シェルの終了を（ブロックして）待って終了コードを proc に設定し，rusage を返す
+        NOTE: 最大常駐メモリを得るため，Popen.wait ではなく wait4 でシェル（とその子孫）の rusage ごと回収する
+        """
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return rusage
+
+    @staticmethod
+    def _kill_process_group(proc: subprocess.Popen) -> None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    @contextmanager
+    def acquire(self) -> Iterator["SourceExecutor"]:
+        # NOTE: SourceExecutorPool と同じインターフェースで扱えるようにするためのもの
+        yield self
+
+    @property
+    def n_workers(self) -> int:
+        return 1
+
     @staticmethod
     def extract_cpp_file(cmd: str) -> str:
         cpp_files = re.findall(r"[\w\./]+\.cpp", cmd)
@@ -40,7 +505,485 @@ class SourceExecutor:
             raise ValueError("Multiple C++ source files are found")
         return cpp_files[0]
 
+    @staticmethod
+    def extract_binary_file(cmd: str) -> str | None:
+        """
+        cmd 内でコンパイラが出力するバイナリのパスを返す（見つからなければ None）
+        """
+        if (m := re.search(r"(?:^|\s)-o\s*([\w\./]+)", cmd)) is not None:
+            return m.group(1)
+        if re.search(r"(?:^|\s)(?:g\+\+|clang\+\+|c\+\+)(?:-[\w\.]+)?\s", cmd) is not None:
+            return "a.out"
+        return None
+
+    @classmethod
+    def isolate_binary_file(cls, cmd: str, sandbox_dir: Path) -> str:
+        """
+        cmd 内のバイナリのパスを sandbox_dir 内のパスに差し替えた cmd を返す
+        """
+        binary_file = cls.extract_binary_file(cmd)
+        if binary_file is None:
+            return cmd
+        sandboxed = str(sandbox_dir / Path(binary_file).name)
+        if re.search(r"(?:^|\s)-o\s*[\w\./]+", cmd) is not None:
+            cmd = re.sub(r"(^|\s)-o\s*[\w\./]+", lambda m: f"{m.group(1)}-o {sandboxed}", cmd, count=1)
+        else:
+            # NOTE: -o が無い場合はデフォルトの a.out をカレントディレクトリに出力するので，出力先を明示する
+            cmd = re.sub(r"(^|\s)((?:g\+\+|clang\+\+|c\+\+)(?:-[\w\.]+)?)(\s)", lambda m: f"{m.group(1)}{m.group(2)} -o {sandboxed}{m.group(3)}", cmd, count=1)
+        binary_pattern = r"(?<![\w\./-])(?:\./)?" + re.escape(binary_file.removeprefix("./")) + r"(?![\w\./-])"
+        return re.sub(binary_pattern, lambda _: sandboxed, cmd)
+
+    @staticmethod
+    def split_cmd(cmd: str, source_file: str) -> tuple[str, str | None]:
+        """
+        cmd を '&&' で区切り，ソースファイルを参照する最後の部分までをビルドフェーズ，残りを実行フェーズとして返す
+        """
+        parts = re.split(r"\s*&&\s*", cmd.strip())
+        build_part_indices = [i for i, part in enumerate(parts) if source_file in part]
+        if len(build_part_indices) == 0 or build_part_indices[-1] == len(parts) - 1:
+            return cmd, None
+        n_build_parts = build_part_indices[-1] + 1
+        return " && ".join(parts[:n_build_parts]), " && ".join(parts[n_build_parts:])
+
+    @staticmethod
+    def redirect_stdin(cmd: str, input_file: Path) -> str:
+        """
+        cmd の標準入力のリダイレクト先を input_file に差し替える（リダイレクトが無ければ追加する）
+        """
+        quoted = shlex.quote(str(input_file))
+        if re.search(r"<\s*[^\s<>|&;]+", cmd) is not None:
+            return re.sub(r"<\s*[^\s<>|&;]+", lambda _: f"< {quoted}", cmd, count=1)
+        return f"{cmd} < {quoted}"
+
     @staticmethod
     def get_tmp_file_path() -> Path:
         this_dir = Path(__file__).parent
         return this_dir / ".." / "tmp" / "_tmp.cpp"
+
+
+class PersistentProcess:
+    """
+    対象プログラムを一度だけ起動して常駐させ，HP の組を一つずつ送って評価させるためのプロセス（起動・初期化が重い対象のため）
+    プロトコル:
+    - 要求: 環境変数 EZOPT_REQUEST_FD の番号のファイルディスクリプタに，"NAME=VALUE" をタブ区切りで並べた一行を書き込む
+      （HP の値 EZOPT_HP_<i> などと，標準入力として読み直すべきファイル EZOPT_INPUT）
+    - 応答: 対象プログラムは評価の出力を stdout に書き，最後に delimiter だけの行を書く（その行までが一回の評価の出力）
+    - 要求の書き込み先が閉じられたら（EOF），対象プログラムは終了する
+    C++ の対象プログラムでは PRELUDE の ezopt_next() / ezopt_end() がこのプロトコルを実装する
+    NOTE: 評価値は stdout からのみ抽出する（stderr は評価の区切りが分からないので，エラーメッセージ用に末尾を残すのみ）
+    """
+    DELIMITER = "EZOPT_END"
+    PRELUDE = (
+        "#include <cstdio>\n"
+        "#include <cstdlib>\n"
+        "#include <iostream>\n"
+        "#include <string>\n"
+        "#define EZOPT_PERSISTENT 1\n"
+        "static bool ezopt_next() {\n"
+        "    static FILE* request = fdopen(std::atoi(std::getenv(\"EZOPT_REQUEST_FD\")), \"r\");\n"
+        "    std::string line;\n"
+        "    int c;\n"
+        "    while ((c = std::fgetc(request)) != EOF && c != '\\n') line.push_back(static_cast<char>(c));\n"
+        "    if (c == EOF && line.empty()) return false;\n"
+        "    for (std::size_t start = 0; start < line.size();) {\n"
+        "        std::size_t end = line.find('\\t', start);\n"
+        "        if (end == std::string::npos) end = line.size();\n"
+        "        std::size_t eq = line.find('=', start);\n"
+        "        if (eq < end) setenv(line.substr(start, eq - start).c_str(), line.substr(eq + 1, end - eq - 1).c_str(), 1);\n"
+        "        start = end + 1;\n"
+        "    }\n"
+        "    const char* input = std::getenv(\"EZOPT_INPUT\");\n"
+        "    if (input != nullptr && input[0] != '\\0' && std::freopen(input, \"r\", stdin) != nullptr) std::cin.clear();\n"
+        "    return true;\n"
+        "}\n"
+        "static void ezopt_end() {\n"
+        "    std::cout << std::flush;\n"
+        "    std::printf(\"\\n" + DELIMITER + "\\n\");\n"
+        "    std::fflush(stdout);\n"
+        "}\n"
+    )
+
+    def __init__(
+        self,
+        cmd: str,
+        max_evaluations: int,
+        limits: ExecutionLimits | None = None,
+        cpus: list[int] | None = None,
+        output_tail_chars: int = 64 * 1024,
+    ):
+        if max_evaluations < 1:
+            raise ValueError(f"max_evaluations must be positive: {max_evaluations=}")
+        self.cmd = cmd
+        # 一つのプロセスで行う評価の回数の上限（達したら次の評価の前に起動し直す．状態の蓄積やメモリリークの影響を抑えるため）
+        self.max_evaluations = max_evaluations
+        self.limits = limits if limits is not None else ExecutionLimits()
+        self.cpus = cpus
+        self.output_tail_chars = output_tail_chars
+        self._proc: subprocess.Popen | None = None
+        self._request: IO[bytes] | None = None
+        self._readers: list[threading.Thread] = []
+        self._n_evaluations = 0
+        # 評価中の出力の行き先（評価と評価の間の出力は捨てる）
+        self._frame: _PersistentFrame | None = None
+        self._frame_lock = threading.Lock()
+
+    def evaluate(
+        self,
+        request: dict[str, str],
+        monitor: ExecutionMonitor | None = None,
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> ExecutionResult:
+        """
+        request を送って一回分の評価を行う（プロセスが無い・終了している・上限回数に達した場合は起動し直す）
+        対象プログラムが応答の途中で終了した場合は，その終了コードの結果を返す（プロセスは次の評価の前に起動し直される）
+        """
+        spans: list[PhaseSpan] = []
+        if self._proc is None or self._proc.poll() is not None or self._n_evaluations >= self.max_evaluations:
+            with TrialProfiler.span(spans, "spawn"):
+                self._restart()
+        assert self._proc is not None and self._request is not None
+        frame = _PersistentFrame(
+            parser=output_parser() if output_parser is not None else None,
+            monitor=monitor,
+            max_chars=self.output_tail_chars if output_parser is not None else None,
+        )
+        with self._frame_lock:
+            self._frame = frame
+        self._n_evaluations += 1
+        start = time.time()
+        deadline = time.monotonic() + self.limits.wall_time if self.limits.wall_time is not None else None
+        try:
+            line = "\t".join(f"{name}={value}" for name, value in request.items()) + "\n"
+            self._request.write(line.encode())
+            self._request.flush()
+        except BrokenPipeError:
+            pass  # NOTE: 既に終了している．応答が得られないことは下で検出される
+
+        killed = False
+        timed_out = False
+        while not frame.done.wait(0.05):
+            if monitor is not None and monitor.should_stop():
+                killed = True
+            elif deadline is not None and time.monotonic() > deadline:
+                killed = timed_out = True
+            if killed:
+                self.close()
+                break
+        with self._frame_lock:
+            self._frame = None
+
+        if frame.completed:
+            return_code = 0
+        else:
+            # 応答の途中で終了した（クラッシュした）か，kill した
+            self.close()
+            assert self._proc is not None
+            return_code = self._proc.returncode
+        stderr = frame.stderr.getvalue()
+        return ExecutionResult(
+            stdout=frame.stdout.getvalue(),
+            stderr=stderr,
+            return_code=return_code,
+            killed=killed,
+            limit_exceeded="wall_time" if timed_out else SourceExecutor.detect_limit_exceeded(return_code, stderr, self.limits),
+            spans=spans + [PhaseSpan(name="run", start=start, end=time.time(), thread=threading.current_thread().name)],
+            streamed_values=frame.parser.result() if frame.parser is not None else None,
+            truncated=frame.stdout.truncated or frame.stderr.truncated,
+        )
+
+    def _restart(self) -> None:
+        self.close()
+        request_fd, request_write_fd = os.pipe()
+        with SourceExecutor._pin_current_thread(self.cpus):
+            self._proc = subprocess.Popen(
+                SourceExecutor.apply_limits(self.cmd, self.limits),
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env={**os.environ, "EZOPT_REQUEST_FD": str(request_fd)},
+                pass_fds=(request_fd,),
+                start_new_session=True,
+            )
+        os.close(request_fd)
+        self._request = os.fdopen(request_write_fd, "wb")
+        self._n_evaluations = 0
+        assert self._proc.stdout is not None and self._proc.stderr is not None
+        self._readers = [
+            threading.Thread(target=self._read_frames, args=(self._proc.stdout, "stdout"), daemon=True),
+            threading.Thread(target=self._read_frames, args=(self._proc.stderr, "stderr"), daemon=True),
+        ]
+        for reader in self._readers:
+            reader.start()
+
+    def _read_frames(self, stream: IO[bytes], stream_name: str) -> None:
+        """
+        stream を届いた分ずつ読み，完結した行の塊を評価中の frame に渡す（stdout の delimiter の行で frame を完了させる）
+        stream が閉じられたら（プロセスが終了したら），評価中の frame を未完了のまま終わらせる
+        """
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace")
+        delimiter_line = self.DELIMITER + "\n"
+        pending = ""
+        while True:
+            data = os.read(stream.fileno(), READ_CHUNK_BYTES)
+            text = pending + decoder.decode(data, final=len(data) == 0)
+            if len(data) == 0:
+                block, pending = text, ""
+            else:
+                newline_index = text.rfind("\n")
+                if newline_index < 0 and len(text) <= MAX_LINE_CHARS:
+                    pending = text
+                    continue
+                split_index = newline_index + 1 if newline_index >= 0 else len(text)
+                block, pending = text[:split_index], text[split_index:]
+            if stream_name == "stdout" and delimiter_line in block:
+                # NOTE: 区切りの行を含む塊のみ行ごとに見る（それ以外の塊はそのまま渡す）
+                chunk: list[str] = []
+                for line in block.splitlines(keepends=True):
+                    if line == delimiter_line:
+                        self._feed(stream_name, "".join(chunk))
+                        chunk = []
+                        with self._frame_lock:
+                            if self._frame is not None:
+                                self._frame.completed = True
+                                self._frame.done.set()
+                                self._frame = None
+                    else:
+                        chunk.append(line)
+                block = "".join(chunk)
+            self._feed(stream_name, block)
+            if len(data) == 0:
+                break
+        stream.close()
+        if stream_name == "stdout":
+            with self._frame_lock:
+                if self._frame is not None:
+                    self._frame.done.set()
+
+    def _feed(self, stream_name: str, block: str) -> None:
+        with self._frame_lock:
+            frame = self._frame
+        if frame is None or len(block) == 0:
+            return
+        if stream_name == "stdout":
+            frame.stdout.append(block)
+            if frame.parser is not None:
+                frame.parser.feed(stream_name, block)
+        else:
+            frame.stderr.append(block)
+        if frame.monitor is not None:
+            for line in block.splitlines(keepends=True):
+                frame.monitor.on_line(line)
+
+    def close(self) -> None:
+        """
+        プロセスを終了させる（要求の書き込み先を閉じ，残ったプロセスグループは kill する）
+        """
+        if self._request is not None:
+            try:
+                self._request.close()
+            except BrokenPipeError:
+                pass
+            self._request = None
+        if self._proc is not None:
+            SourceExecutor._kill_process_group(self._proc)
+            self._proc.wait()
+            for reader in self._readers:
+                reader.join()
+            self._readers = []
+
+
+class _OutputReader:
+    """
+    SourceExecutor._run_shell で，プロセスの stdout / stderr の一方を届いた分ずつ読み，
+    完結した行の塊ごとに buffer・parser・monitor（こちらは一行ずつ）に渡すもの
+    """
+    def __init__(
+        self,
+        stream: IO[bytes],
+        stream_name: str,
+        buffer: OutputBuffer,
+        monitor: ExecutionMonitor | None,
+        parser: OutputStreamParser | None,
+    ):
+        self.stream = stream
+        self.stream_name = stream_name
+        self.buffer = buffer
+        self.monitor = monitor
+        self.parser = parser
+        self._decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace")
+        self._pending = ""
+
+    def read(self) -> bool:
+        """
+        届いている出力を読む（読めるようになってから呼ぶこと）．EOF に達した場合は stream を閉じて False を返す
+        """
+        data = os.read(self.stream.fileno(), READ_CHUNK_BYTES)
+        text = self._pending + self._decoder.decode(data, final=len(data) == 0)
+        if len(data) == 0:
+            block, self._pending = text, ""
+        else:
+            newline_index = text.rfind("\n")
+            if newline_index < 0 and len(text) <= MAX_LINE_CHARS:
+                self._pending = text
+                return True
+            split_index = newline_index + 1 if newline_index >= 0 else len(text)
+            block, self._pending = text[:split_index], text[split_index:]
+        if len(block) > 0:
+            self.buffer.append(block)
+            if self.parser is not None:
+                self.parser.feed(self.stream_name, block)
+            if self.monitor is not None:
+                for line in block.splitlines(keepends=True):
+                    self.monitor.on_line(line)
+        if len(data) == 0:
+            self.stream.close()
+            return False
+        return True
+
+
+class _PersistentFrame:
+    """
+    PersistentProcess での一回分の評価の出力の受け取り先
+    """
+    def __init__(self, parser: OutputStreamParser | None, monitor: ExecutionMonitor | None, max_chars: int | None):
+        self.parser = parser
+        self.monitor = monitor
+        self.stdout = OutputBuffer(max_chars)
+        self.stderr = OutputBuffer(max_chars)
+        # delimiter の行まで受け取ったか（False のまま done になったら，応答の途中でプロセスが終了した）
+        self.completed = False
+        self.done = threading.Event()
+
+
+class SourceExecutorPool:
+    """
+    それぞれ独立したサンドボックス（ソースファイル・バイナリの置き場）を持つ SourceExecutor を束ね，
+    複数の試行を同時に実行できるようにするクラス
+    """
+    def __init__(
+        self,
+        original_cmd: str,
+        n_workers: int = 1,
+        build_cache: BuildCache | None = None,
+        n_case_workers: int = 1,
+        limits: ExecutionLimits | None = None,
+        pin_cpus: bool = False,
+        output_tail_chars: int = 64 * 1024,
+        sandbox_name: str | None = None,
+        persistent_max_evaluations: int | None = None,
+        use_pch: bool = False,
+    ):
+        """
+        i 番目のワーカーのサンドボックスは tmp/<sandbox_name>_<i> となる
+        sandbox_name のデフォルトは worker<pid> で，同じ環境で同時に動く ezopt のプロセス（shard や ezopt worker など）どうしは別のサンドボックスを用いる
+        （プロセスごとのサンドボックスは close で削除する）
+        use_pch=True の場合，ソースの先頭のインクルードの並びを tmp/pch/ 以下にプリコンパイルし，全ワーカーのビルドで共有する
+        （ビルドコマンドが g++ の単純な呼び出しでない場合は何もしない）
+        """
+        if n_workers < 1:
+            raise ValueError(f"n_workers must be positive: {n_workers=}")
+        tmp_dir = SourceExecutor.get_tmp_file_path().parent
+        if sandbox_name is None:
+            sandbox_name = f"worker{os.getpid()}"
+        # NOTE: 入力ファイルごとの実行は，全ワーカーで共有する一つのスレッドプールで行う
+        self.case_runner = ThreadPoolExecutor(max_workers=n_case_workers) if n_case_workers > 1 else None
+        cpu_slices = self.__class__.split_cpus(n_workers) if pin_cpus else [None] * n_workers
+        self.executors = [
+            SourceExecutor(
+                original_cmd,
+                sandbox_dir=tmp_dir / f"{sandbox_name}_{i}",
+                build_cache=build_cache,
+                case_runner=self.case_runner,
+                limits=limits,
+                cpus=cpu_slices[i],
+                output_tail_chars=output_tail_chars,
+                persistent_max_evaluations=persistent_max_evaluations,
+            )
+            for i in range(n_workers)
+        ]
+        self._idle_executors: queue.Queue[SourceExecutor] = queue.Queue()
+        for executor in self.executors:
+            self._idle_executors.put(executor)
+        first = self.executors[0]
+        self.precompiled_header = PrecompiledHeader.from_build_cmd(first.build_cmd, str(first.tmp_file_path), tmp_dir / "pch") if use_pch and first.run_cmd is not None else None
+        for executor in self.executors:
+            executor.precompiled_header = self.precompiled_header
+
+    @property
+    def cpp_file(self) -> str:
+        return self.executors[0].cpp_file
+
+    @property
+    def n_workers(self) -> int:
+        return len(self.executors)
+
+    @property
+    def is_persistent(self) -> bool:
+        return self.executors[0].is_persistent
+
+    @contextmanager
+    def retain_builds(self) -> Iterator[None]:
+        """
+        with ブロックの間，どのワーカーでビルドしたバイナリも一時的なビルドキャッシュに残し，全ワーカーで同じソースの再ビルドを省略する
+        （SourceExecutor.retain_builds を参照．キャッシュは先頭のワーカーのサンドボックスに置く）
+        """
+        with SourceExecutor._retain_builds(self.executors, self.executors[0].sandbox_dir / "builds"):
+            yield
+
+    def close(self) -> None:
+        """
+        常駐プロセスを終了させ，サンドボックスを削除する
+        """
+        for executor in self.executors:
+            executor.close()
+            shutil.rmtree(executor.sandbox_dir, ignore_errors=True)
+
+    @contextmanager
+    def acquire(self) -> Iterator[SourceExecutor]:
+        """
+        空いている SourceExecutor を一つ借りる（全て使用中なら空くまで待つ）
+        """
+        executor = self._idle_executors.get()
+        try:
+            yield executor
+        finally:
+            self._idle_executors.put(executor)
+
+    def execute(
+        self,
+        mod_source: str,
+        env: dict[str, str] | None = None,
+        monitor: ExecutionMonitor | None = None,
+        output_parser: Callable[[], OutputStreamParser] | None = None,
+    ) -> ExecutionResult:
+        with self.acquire() as executor:
+            return executor.execute(mod_source, env=env, monitor=monitor, output_parser=output_parser)
+
+    def build(self, mod_source: str) -> ExecutionResult:
+        """
+        先頭のワーカーでビルドし，できたバイナリを他のワーカーのサンドボックスにコピーする
+        """
+        first, *rest = self.executors
+        result = first.build(mod_source)
+        if result.return_code == 0 and first.binary_path is not None:
+            for executor in rest:
+                assert executor.binary_path is not None
+                shutil.copy2(first.binary_path, executor.binary_path)
+                executor._built_source = mod_source
+        return result
+
+    @staticmethod
+    def split_cpus(n_workers: int) -> list[list[int] | None]:
+        """
+        このプロセスが使える CPU を n_workers 個の互いに素な組に分ける（CPU がワーカーより少ない場合は重複して割り当てる）
+        CPU の割り当てに対応していない環境では全て None を返す
+        """
+        if not hasattr(os, "sched_getaffinity"):
+            return [None] * n_workers
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < n_workers:
+            return [[cpus[i % len(cpus)]] for i in range(n_workers)]
+        return [cpus[i * len(cpus) // n_workers:(i + 1) * len(cpus) // n_workers] for i in range(n_workers)]
+
+    def __repr__(self):
+        return f"SourceExecutorPool(n_workers={self.n_workers})"
@@ -7,21 +7,66 @@ from ezopt.models import ChoiceType, HyperParameter, HyperParameterWithChoices,
 from ezopt.utils import UniqueRenamer, get_random_hex
 
 
+HP_PATTERN = re.compile(r"\(([^)]+)\)\s*/\*\s*(HP.*)\s*:\s*(.+)\s*\*/")
+
+
 class SourceParameterizer:
     """
     ソースを受け取り，以下をする
     - ソース内の HP を把握する
     - HP の具体値を受け取ると，それらをソースに埋め込んだものを返す
+
+    ソースは「HP の値が入る箇所 (slot) で区切られた文字列の断片 (segments)」として保持しておき，
+    具体値の埋め込みは断片と値を交互に一度だけ連結することで行う
+    （i 番目の HP の値は segments[i] と segments[i + 1] の間に入る）
     """
     def __init__(self, source: str):
-        self.hps, self.source = self.__class__.collect_hyper_parameters(source)
-    
+        self.hps, self.segments = self.__class__.compile_template(source)
+        # NOTE: 値の箇所を各 HP のハッシュにしたソース（以前のバージョンとの互換性のため）
+        self.source = self._render([hp.hash for hp in self.hps])
+
     def apply_params(self, values: tuple[ChoiceType, ...]) -> str:
         assert len(values) == len(self.hps)
-        source = self.source
-        for hp, value in zip(self.hps, values):
-            source = source.replace(hp.hash, self.__class__._to_cpp_repr(value))
-        return source
+        return self._render([self.__class__._to_cpp_repr(value) for value in values])
+
+    def apply_params_batch(self, values_list: list[tuple[ChoiceType, ...]]) -> list[str]:
+        """
+        複数の具体値の組をまとめて埋め込む
+        """
+        to_cpp_repr = self.__class__._to_cpp_repr
+        render = self._render
+        return [render([to_cpp_repr(value) for value in values]) for values in values_list]
+
+    def apply_runtime_params(self) -> str:
+        """
+        各 HP の箇所を「実行時に環境変数から値を読む式」に置き換えたソースを返す
+        （ビルドを一度だけ行い，試行ごとには to_runtime_env の環境変数を与えて実行するためのもの）
+        """
+        source = self._render([
+            self.__class__._to_cpp_runtime_read(hp, self.__class__.runtime_env_name(i))
+            for i, hp in enumerate(self.hps)
+        ])
+        return "#include <cstdlib>\n" + source
+
+    def _render(self, slot_texts: list[str]) -> str:
+        parts = [""] * (2 * len(self.segments) - 1)
+        parts[0::2] = self.segments
+        parts[1::2] = slot_texts
+        return "".join(parts)
+
+    def to_runtime_env(self, values: tuple[ChoiceType, ...]) -> dict[str, str]:
+        """
+        apply_runtime_params で生成したソースに HP の具体値を渡すための環境変数を返す
+        """
+        assert len(values) == len(self.hps)
+        return {
+            self.__class__.runtime_env_name(i): self.__class__._to_env_repr(value)
+            for i, value in enumerate(values)
+        }
+
+    @staticmethod
+    def runtime_env_name(index: int) -> str:
+        return f"EZOPT_HP_{index}"
 
     @property
     def is_all_discrete(self) -> bool:
@@ -38,33 +83,69 @@ class SourceParameterizer:
         else:
             raise ValueError(f"Unsupported choice type: {type(x)}")
 
-    @classmethod
-    def collect_hyper_parameters(cls, source: str) -> tuple[list[HyperParameter], str]:
-        # 全てのプレースホルダをランダムなハッシュに置き換える
-        hash_to_original: dict[str, str] = {}
-        
-        hp_pattern = r"\(([^)]+)\)\s*/\*\s*(HP.*)\s*:\s*(.+)\s*\*/"
+    @staticmethod
+    def _to_env_repr(x: ChoiceType) -> str:
+        if isinstance(x, bool):
+            return "1" if x else "0"
+        elif isinstance(x, (int, float)):
+            return repr(x)
+        elif isinstance(x, str):
+            return x
+        else:
+            raise ValueError(f"Unsupported choice type: {type(x)}")
 
-        def _fn_replacer(m):
-            hash = get_random_hex(24)
-            hash_to_original[hash] = m.group(1)
-            return f"({hash})/*{m.group(2)}:{m.group(3)}*/"
+    @staticmethod
+    def _to_cpp_runtime_read(hp: HyperParameter, env_name: str) -> str:
+        """
+        環境変数 env_name から HP の値を読み出す C++ の式を返す（式の型は元のリテラルの型に合わせる）
+        """
+        getenv = f'std::getenv("{env_name}")'
+        if isinstance(hp, HyperParameterWithRange):
+            return f"std::atof({getenv})"
+        elif isinstance(hp, HyperParameterWithChoices):
+            if all(isinstance(c, bool) for c in hp.choices):
+                return f"(std::atoi({getenv}) != 0)"
+            elif all(isinstance(c, int) and not isinstance(c, bool) for c in hp.choices):
+                if all(-2**31 <= c < 2**31 for c in hp.choices):  # type: ignore[operator]
+                    return f"std::atoi({getenv})"
+                return f"std::atoll({getenv})"
+            elif all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in hp.choices):
+                return f"std::atof({getenv})"
+            elif all(isinstance(c, str) for c in hp.choices):
+                return getenv
+            raise ValueError(f"Choices of mixed types cannot be read at runtime: {hp}")
+        else:
+            raise RuntimeError(f"Unsupported hyperparameter type: {hp}")
 
-        source = re.sub(
-            hp_pattern,
-            _fn_replacer,
-            source
-        )
+    @classmethod
+    def collect_hyper_parameters(cls, source: str) -> tuple[list[HyperParameter], str]:
+        """
+        HP のリストと，全ての HP の値の箇所をそれぞれのハッシュに置き換えたソースを返す
+        """
+        parameterizer = cls(source)
+        return parameterizer.hps, parameterizer.source
 
-        # HyperParameer のリストを取得する
-        annotation_matches = re.findall(hp_pattern, source)
+    @classmethod
+    def compile_template(cls, source: str) -> tuple[list[HyperParameter], list[str]]:
+        """
+        ソースを一度だけ走査して，HP のリストと，HP の値の箇所で区切ったソースの断片のリストを返す
+        """
         hps: list[HyperParameter] = []
+        segments: list[str] = []
         renamer = UniqueRenamer()
-        for hash, name, search_space_spec in annotation_matches:
+        last_end = 0
+        text_after_last_value = ""
+        for m in HP_PATTERN.finditer(source):
+            original, name, search_space_spec = m.group(1), m.group(2), m.group(3)
+            segments.append(text_after_last_value + source[last_end:m.start()] + "(")
+            # NOTE: 値以外の部分は「(値)/*名前:探索範囲*/」の形に正規化する
+            text_after_last_value = f")/*{name}:{search_space_spec}*/"
+            last_end = m.end()
+            hash = get_random_hex(24)
             # search_space_spec をパースし，その結果ごとに異なる種類の HP を生成する
             if (choices := cls.try_to_parse_search_space_spec_as_choices(search_space_spec)) is not None:
                 hps.append(HyperParameterWithChoices(
-                    original=hash_to_original[hash],
+                    original=original,
                     hash=hash,
                     name=renamer(name),
                     choices=choices           
@@ -72,7 +153,7 @@ class SourceParameterizer:
             elif (spec := cls.try_to_parse_search_space_spec_as_range(search_space_spec)) is not None:
                 low, high, log = spec
                 hps.append(HyperParameterWithRange(
-                    original=hash_to_original[hash],
+                    original=original,
                     hash=hash,
                     name=renamer(name),
                     low=low,
@@ -81,7 +162,8 @@ class SourceParameterizer:
                 ))
             else:
                 raise ValueError(f"Invalid search space spec: {search_space_spec=}")
-        return hps, source
+        segments.append(text_after_last_value + source[last_end:])
+        return hps, segments
     
     @staticmethod
     def try_to_parse_search_space_spec_as_choices(search_space_spec: str) -> list[ChoiceType] | None:
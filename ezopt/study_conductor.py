@@ -1,68 +1,336 @@
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
 import itertools
-from typing import Any
+import math
+from pathlib import Path
+import random
+import re
+import statistics
+import threading
+import time
+from typing import Any, Callable, Iterator, overload
+import warnings
 import optuna
-from pydantic import BaseModel
-from ezopt.models import ChoiceType, HyperParameterWithChoices, HyperParameterWithRange
+from ezopt.grid_shard import GridShard, GridShardResults
+from ezopt.models import ChoiceType, ExecutionResult, HyperParameterWithChoices, HyperParameterWithRange, ObjectiveSettings, PhaseSpan
 from ezopt.output_evaluator import OutputEvaluator
 
-from ezopt.source_executor import SourceExecutor
+from ezopt.source_executor import ExecutionMonitor, PersistentProcess, SourceExecutor, SourceExecutorPool
 from ezopt.source_parameterizer import SourceParameterizer
-from ezopt.utils import compute_product
+from ezopt.study_storage import count_finished_trials, recover_interrupted_trials, select_best_trial
+from ezopt.trial_dispatcher import AsyncTrialDispatcher
+from ezopt.trial_memo import TrialMemo
+from ezopt.trial_profiler import TrialProfiler
+from ezopt.trial_replicator import TrialReplicator
+from ezopt.utils import compute_product, compute_quantile, safe_float
+from ezopt.warm_start import WarmStart
 
 
-class StudyResult(BaseModel):
-    trial_results: list[tuple[tuple[ChoiceType, ...], float | None]]
+class StudyTrialResults(Sequence[tuple[tuple[ChoiceType, ...], float | None]]):
+    """
+    optuna の study の試行たちの (HP の具体値の組, 評価値) の読み取り専用の列
+    NOTE: 試行の記録は study が保持しているので複製せず，参照されたときに変換する
+    """
+    __slots__ = ("_trials", "_decode_params")
+
+    def __init__(self, study: optuna.study.Study, decode_params: Callable[[dict[str, Any]], tuple[ChoiceType, ...]], n_params: int):
+        # NOTE: 全ての HP が提案される前に止まった試行は除く
+        self._trials = [t for t in study.get_trials(deepcopy=False) if len(t.params) == n_params]
+        self._decode_params = decode_params
+
+    def __len__(self) -> int:
+        return len(self._trials)
+
+    @overload
+    def __getitem__(self, index: int) -> tuple[tuple[ChoiceType, ...], float | None]: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[tuple[tuple[ChoiceType, ...], float | None]]: ...
+
+    def __getitem__(self, index: int | slice) -> tuple[tuple[ChoiceType, ...], float | None] | list[tuple[tuple[ChoiceType, ...], float | None]]:
+        if isinstance(index, slice):
+            return [self._item(trial) for trial in self._trials[index]]
+        return self._item(self._trials[index])
+
+    def _item(self, trial: optuna.trial.FrozenTrial) -> tuple[tuple[ChoiceType, ...], float | None]:
+        return self._decode_params(trial.params), trial.values[0] if trial.values is not None else None
+
+    def __repr__(self):
+        return f"StudyTrialResults(n_trials={len(self)})"
+
+
+class GridTrialResults(Sequence[tuple[tuple[ChoiceType, ...], float | None]]):
+    """
+    grid search で実行した点たちの (HP の具体値の組, 評価値) の列
+    NOTE: 点は grid 全体での番号，評価値は実数（評価値が無い場合は NaN）として配列に保持し，HP の組は参照されたときに番号から求める
+    """
+    __slots__ = ("shard", "_indices", "_values")
+
+    def __init__(self, shard: GridShard):
+        self.shard = shard
+        self._indices = array("q")
+        self._values = array("d")
+
+    def append(self, index: int, value: float | None) -> None:
+        self._indices.append(index)
+        self._values.append(value if value is not None else math.nan)
+
+    def __len__(self) -> int:
+        return len(self._indices)
+
+    @overload
+    def __getitem__(self, index: int) -> tuple[tuple[ChoiceType, ...], float | None]: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[tuple[tuple[ChoiceType, ...], float | None]]: ...
+
+    def __getitem__(self, index: int | slice) -> tuple[tuple[ChoiceType, ...], float | None] | list[tuple[tuple[ChoiceType, ...], float | None]]:
+        if isinstance(index, slice):
+            return [self._item(grid_index, value) for grid_index, value in zip(self._indices[index], self._values[index])]
+        return self._item(self._indices[index], self._values[index])
+
+    def _item(self, grid_index: int, value: float) -> tuple[tuple[ChoiceType, ...], float | None]:
+        return self.shard.params_at(grid_index), value if not math.isnan(value) else None
+
+    def __repr__(self):
+        return f"GridTrialResults(n_trials={len(self)}, shard={self.shard})"
+
+
+@dataclass(slots=True)
+class StudyResult:
+    trial_results: Sequence[tuple[tuple[ChoiceType, ...], float | None]]
     study: optuna.study.Study | None
     best_params: tuple[ChoiceType, ...] | None
     best_value: float | None
 
-    class Config:
-        arbitrary_types_allowed = True
 
-class BayesianOptimizationStudyConductor:
+class ExecutionLimitExceeded(RuntimeError):
+    """
+    試行のビルド・実行が実行制限（経過時間・CPU 時間・アドレス空間）を超えたことを表す例外
+    study.optimize はこの例外を捕まえて試行を FAIL とし，study 自体は続行する
+    """
+
+
+class TrialPruningMonitor(ExecutionMonitor):
+    """
+    実行中の出力から中間評価値を取り出して trial.report し，pruner が打ち切りを判断したら実行を止めさせるクラス
+    - 入力ファイルが複数ある場合: 先頭から連続して完了したケースの評価値の和を，完了ケース数をステップとして報告する
+    - そうでない場合: progress_pattern（無ければ value_pattern）にマッチした行ごとに値を報告する
+      （value_pattern の場合はそれまでにマッチした値の集約値を報告する）
+    """
+    def __init__(
+        self,
+        trial: optuna.Trial,
+        evaluator: OutputEvaluator,
+        n_cases: int | None = None,
+        progress_pattern: str | None = None,
+    ):
+        self.trial = trial
+        self.evaluator = evaluator
+        self.n_cases = n_cases
+        self.progress_pattern = re.compile(progress_pattern) if progress_pattern is not None else None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._step = 0
+        self._line_values: list[float] = []
+        self._case_values: list[float | None] = [None] * n_cases if n_cases is not None else []
+        self._case_finished: list[bool] = [False] * n_cases if n_cases is not None else []
+        self._n_prefix_cases = 0
+        self._prefix_value: float | None = 0.0
+
+    def on_line(self, line: str) -> None:
+        if self.n_cases is not None or self._stop.is_set():
+            return
+        if self.progress_pattern is not None:
+            m = self.progress_pattern.search(line)
+            if m is not None and (value := safe_float(m.group(1))) is not None:
+                self._report(value)
+        elif (value := self.evaluator.extract_value_from_line(line)) is not None:
+            with self._lock:
+                self._line_values.append(value)
+                aggregated = self.evaluator.aggregate(self._line_values)
+            self._report(aggregated)
+
+    def on_case_finished(self, index: int, result: ExecutionResult) -> None:
+        if self.n_cases is None or result.killed:
+            return
+        value = self.evaluator.evaluate(result)
+        with self._lock:
+            self._case_values[index] = value
+            self._case_finished[index] = True
+            # NOTE: 試行間で比較できるよう，先頭から連続して完了したケースについてのみ報告する
+            while self._n_prefix_cases < self.n_cases and self._case_finished[self._n_prefix_cases]:
+                prefix_case_value = self._case_values[self._n_prefix_cases]
+                self._n_prefix_cases += 1
+                if prefix_case_value is None:
+                    # NOTE: 評価値が得られなかったケースがあれば，試行自体が失敗扱いになるので以降は報告しない
+                    self._prefix_value = None
+                if self._prefix_value is not None and prefix_case_value is not None:
+                    self._prefix_value += prefix_case_value
+                    self._report_unlocked(self._prefix_value, self._n_prefix_cases)
+
+    def should_stop(self) -> bool:
+        return self._stop.is_set()
+
+    def _report(self, value: float) -> None:
+        with self._lock:
+            self._step += 1
+            self._report_unlocked(value, self._step)
+
+    def _report_unlocked(self, value: float, step: int) -> None:
+        if self._stop.is_set():
+            return
+        self.trial.report(value, step)
+        if self.trial.should_prune():
+            self._stop.set()
+
+
+class StudyConductorBase:
+    """
+    HP の具体値を受け取ってソースの生成・実行を行う部分の，各 StudyConductor に共通する処理
+    """
     def __init__(
         self,
         parameterizer: SourceParameterizer,
-        executor: SourceExecutor,
-        evaluator: OutputEvaluator
+        executor: SourceExecutor | SourceExecutorPool,
+        evaluator: OutputEvaluator,
+        compile_once: bool = False,
+        input_files: list[Path] | None = None,
+        memo: TrialMemo | None = None,
+        record_spans: bool = False,
     ):
         self.parameterizer = parameterizer
+        self.executor = executor
+        self.evaluator = evaluator
+        # compile_once: HP を実行時に環境変数から読むソースを一度だけビルドし，試行ごとには実行のみを行うモード
+        self.compile_once = compile_once
+        # input_files: 各試行で実行する入力ファイル（テストケース）たち（None なら CMD をそのまま実行する）
+        self.input_files = input_files
+        # memo: 同じ HP の組が再び現れたときに，実行せずに記録済みの評価値を用いるためのメモ
+        self.memo = memo
+        # record_spans: 各フェーズの時刻を trial の user attribute `spans` に記録するか（trace の書き出しに用いる）
+        self.record_spans = record_spans
         # self.hps = [hp for hp in self.parameterizer.hps if isinstance(hp, HyperParameterWithChoices)]
         # assert len(self.hps) == len(self.parameterizer.hps), "BayesianOptimization is only supported for HyperParameterWithChoices"
         self.hps = self.parameterizer.hps
-        self.executor = executor
-        self.evaluator = evaluator
-    
-    def run(self, n_trials: int, direction: str, sampling: str = "tpe") -> StudyResult:
+
+    def _prepare(self) -> None:
+        """
+        試行を始める前に一度だけ行う準備
+        """
+        if self.compile_once:
+            source = self.parameterizer.apply_runtime_params()
+            if self.executor.is_persistent:
+                # NOTE: 常駐プロセスとして実行する場合は，次の HP の組を受け取る ezopt_next() などのプロトコルの実装を加えておく
+                source = PersistentProcess.PRELUDE + source
+            result = self.executor.build(source)
+            if result.return_code != 0:
+                raise RuntimeError(f"Build failed in compile-once mode.\n----\n{result.stderr}")
+
+    @staticmethod
+    def _enqueue_warm_start(study: optuna.study.Study, warm_start: WarmStart) -> None:
+        """
+        warm_start の試行を study の最初の試行として enqueue する（出どころは user attribute `warm_start` に記録する）
+        """
+        for params, source in warm_start.trials:
+            study.enqueue_trial(params, user_attrs={"warm_start": source})
+
+    @contextmanager
+    def _acquire_executor(self, spans: list[PhaseSpan]) -> Iterator[SourceExecutor]:
+        """
+        空いているワーカーを借りる（空きを待った時間は queue というフェーズとして spans に追加される）
+        """
+        queue_start = time.time()
+        with self.executor.acquire() as executor:
+            spans.append(PhaseSpan(name="queue", start=queue_start, end=time.time(), thread=threading.current_thread().name))
+            yield executor
+
+    def _execute_params(
+        self,
+        params: tuple[ChoiceType, ...],
+        monitor: ExecutionMonitor | None = None,
+        input_files: list[Path] | None = None,
+        spans: list[PhaseSpan] | None = None,
+        env: dict[str, str] | None = None,
+        executor: SourceExecutor | None = None,
+    ) -> list[ExecutionResult]:
+        """
+        HP の具体値に対してソースを実行し，実行結果のリスト（テストケースごと．input_files が無ければ長さ 1）を返す
+        input_files を指定すると self.input_files の代わりにそれらを用いる
+        spans を指定すると，空きワーカーを待った時間 (queue) と各実行結果のフェーズがそこに追加される
+        env は実行フェーズの環境変数に追加される
+        executor（借りているワーカー）を指定すると，新たに借りずにそれで実行する
+        """
+        if executor is None:
+            queue_spans: list[PhaseSpan] = []
+            with self._acquire_executor(queue_spans) as executor:
+                if spans is not None:
+                    spans.extend(queue_spans)
+                return self._execute_params(params, monitor=monitor, input_files=input_files, spans=spans, env=env, executor=executor)
+        input_files = input_files if input_files is not None else self.input_files
+        # NOTE: 出力は実行中に逐次評価し，巨大な出力を丸ごとメモリに保持しないようにする
+        output_parser = self.evaluator.create_stream_parser
+        own_spans: list[PhaseSpan] = []
+        if self.compile_once:
+            env = {**self.parameterizer.to_runtime_env(params), **(env if env is not None else {})}
+            if input_files is None:
+                results = [executor.run(env=env, monitor=monitor, output_parser=output_parser)]
+            else:
+                results = executor.run_cases(input_files, env=env, monitor=monitor, output_parser=output_parser)
+        else:
+            with TrialProfiler.span(own_spans, "render"):
+                mod_source = self.parameterizer.apply_params(params)
+            if input_files is None:
+                results = [executor.execute(mod_source, env=env, monitor=monitor, output_parser=output_parser)]
+            else:
+                results = executor.execute_cases(mod_source, input_files, env=env, monitor=monitor, output_parser=output_parser)
+        if spans is not None:
+            spans.extend(own_spans)
+            for result in results:
+                spans.extend(result.spans)
+        return results
+
+    def _record_profile(
+        self,
+        trial: optuna.Trial,
+        spans: list[PhaseSpan],
+        results: list[ExecutionResult] | None = None,
+    ) -> None:
+        """
+        フェーズごとの合計時間 (timings) と，results があれば最大常駐メモリ (peak_rss_kb)・終了ステータス (exit_status) を
+        trial の user attribute に記録する（終了ステータスは 0 でないものがあればその最初のもの）
+        """
+        trial.set_user_attr("timings", TrialProfiler.total_durations(spans))
+        if self.record_spans:
+            trial.set_user_attr("spans", TrialProfiler.to_user_attr(spans))
+        if results is not None:
+            trial.set_user_attr("peak_rss_kb", max((r.peak_rss_kb for r in results if r.peak_rss_kb is not None), default=None))
+            trial.set_user_attr("exit_status", next((r.return_code for r in results if r.return_code != 0), 0))
+
+    @staticmethod
+    def _find_limit_exceeded(results: list[ExecutionResult]) -> ExecutionResult | None:
+        """
+        実行制限を超えた実行結果があればそれを返す（打ち切られた出力から得られる評価値は信用できないので，その試行は失敗とする）
+        """
+        return next((result for result in results if result.limit_exceeded is not None), None)
+
+    def _create_sampler(self, sampling: str, seed: int | None = None) -> optuna.samplers.BaseSampler | None:
         if sampling == "tpe":
-            sampler = None  # TPE will be used by default
+            return None  # TPE will be used by default
+        elif sampling == "random":
+            return optuna.samplers.RandomSampler(seed=seed)
         elif sampling == "grid":
             assert self.parameterizer.is_all_discrete, "Grid search is only supported for all discrete hyperparameters"
             search_space = {
                 hp.name: hp.choices for hp in self.hps if isinstance(hp, HyperParameterWithChoices)
             }  # NOTE: isinstance チェックは全て通るはず（mypy のために明示的に書いている）
-            sampler = optuna.samplers.GridSampler(search_space)
+            return optuna.samplers.GridSampler(search_space)
         else:
             raise ValueError(f"Unsupported sampling method: {sampling}")
-        
-        study = optuna.create_study(direction=direction, sampler=sampler)
-
-        try:
-            study.optimize(
-                lambda trial: self._objective(
-                    trial,
-                ),
-                n_trials=n_trials
-            )
-        except KeyboardInterrupt:
-            pass
-
-        return StudyResult(
-            trial_results=[(self._decode_params(t.params), t.value) for t in study.trials],
-            study=study,
-            best_params=self._decode_params(study.best_params) if study.best_params is not None else None,
-            best_value=study.best_value
-        )
 
     def _decode_params(self, params: dict[str, Any]) -> tuple[ChoiceType, ...]:
         """
@@ -79,21 +347,7 @@ class BayesianOptimizationStudyConductor:
                 raise RuntimeError(f"Unsupported hyperparameter type: {hp}")
 
         return tuple(raw_params)
-    
-    def _objective(
-        self,
-        trial: optuna.Trial,
-    ) -> float:
-        params = self._suggest_params(trial)
-        # print(f"[suggestion] {params=}")
-        mod_source = self.parameterizer.apply_params(params)
-        result = self.executor.execute(mod_source)
-        value = self.evaluator.evaluate(result)
-        # print(f"    {value=}")
-        if value is None:
-            raise RuntimeError(f"Value extraction failed. Check that result.stdout or result.stderr contains the value patterns.\n----\n{self.evaluator=}\n----\n{result=}")
-        return value
-    
+
     def _suggest_params(self, trial: optuna.Trial) -> tuple[ChoiceType, ...]:
         """
         HyperParameter たちから optuna の suggestion を行う
@@ -113,51 +367,531 @@ class BayesianOptimizationStudyConductor:
         return tuple(raw_params)
 
 
-class GridSearchSourceIterator:
-    def __init__(self, parameterizer: SourceParameterizer):
-        self.parameterizer = parameterizer
-        hps = [hp for hp in self.parameterizer.hps if isinstance(hp, HyperParameterWithChoices)]
-        assert len(hps) == len(self.parameterizer.hps), "GridSearch is only supported for HyperParameterWithChoices"
-        self.product: itertools.product[tuple[ChoiceType, ...]] = itertools.product(*[hp.choices for hp in hps])
-        self.length = compute_product([len(hp.choices) for hp in hps])
-    
-    def __len__(self) -> int:
-        return self.length
+class BayesianOptimizationStudyConductor(StudyConductorBase):
+    def __init__(
+        self,
+        parameterizer: SourceParameterizer,
+        executor: SourceExecutor | SourceExecutorPool,
+        evaluator: OutputEvaluator,
+        compile_once: bool = False,
+        input_files: list[Path] | None = None,
+        progress_pattern: str | None = None,
+        memo: TrialMemo | None = None,
+        record_spans: bool = False,
+        replicator: TrialReplicator | None = None,
+        objectives: ObjectiveSettings | None = None,
+    ):
+        super().__init__(parameterizer, executor, evaluator, compile_once=compile_once, input_files=input_files, memo=memo, record_spans=record_spans)
+        # progress_pattern: 実行途中の中間評価値を表す行のパターン（pruning に用いる）
+        self.progress_pattern = progress_pattern
+        # replicator: 有望な候補をシードを変えて繰り返し実行するかどうかを判断するもの（None なら各試行で一度だけ実行する）
+        self.replicator = replicator
+        # objectives: 評価値に加える目的関数と制約（None なら評価値のみの単目的最適化）
+        # NOTE: 出力からの指標の抽出には evaluator.metric_evaluators を用いるので，evaluator は objectives.metric_patterns() で作る必要がある
+        self.objectives = objectives if objectives is not None and not objectives.is_empty() else None
+        if self.objectives is not None and (memo is not None or replicator is not None):
+            raise ValueError("Extra objectives and constraints are not supported with memo or replication")
+        if self.objectives is not None and not hasattr(optuna.Trial, "set_constraint"):
+            # NOTE: optuna < 5.0 には Trial.set_constraint が無い
+            raise ValueError("Extra objectives and constraints require optuna >= 5.0")
     
-    def __iter__(self):
-        return self
+    def run(
+        self,
+        n_trials: int,
+        direction: str,
+        sampling: str = "tpe",
+        pruner: optuna.pruners.BasePruner | None = None,
+        storage: optuna.storages.BaseStorage | None = None,
+        study_name: str | None = None,
+        resume: bool = False,
+        join: bool = False,
+        study_attrs: dict[str, Any] | None = None,
+        warm_start: WarmStart | None = None,
+        async_dispatch: bool = False,
+        callbacks: list[Callable[[optuna.study.Study, optuna.trial.FrozenTrial], None]] | None = None,
+    ) -> StudyResult:
+        """
+        storage を指定すると，各試行の結果は完了するたびに storage に書き込まれる
+        n_trials は study 全体の試行数で，同じ study を複数のプロセスで分担している場合も合計がそれに達した時点で終了する
+        resume=True の場合は storage 上の既存の study を再開し，完了済みの試行は再実行せず，残りの試行数だけ実行する
+        join=True の場合は他のプロセスが作った storage 上の study に参加して試行を分担する（実行中の試行は他のプロセスのものなので回復しない）
+        study_attrs は study の user attribute として記録される（参加するプロセスが同じ設定で実行するために用いる）
+        warm_start の試行は，新しく作った study の最初の試行として enqueue される（再開・参加した study には enqueue しない）
+        async_dispatch=True の場合は study.optimize の代わりに AsyncTrialDispatcher で ask / tell する（次の候補を実行中の試行の裏で提案する）
+        """
+        sampler = self._create_sampler(sampling)
+        if async_dispatch and sampler is None:
+            # NOTE: 実行中の試行が多い状態で提案するので，実行中の試行の評価値を仮置きする constant liar を明示的に用いる
+            sampler = optuna.samplers.TPESampler(constant_liar=True)
+        # NOTE: GridSampler は試行の番号順にセルを割り当てるので，全てのセルが割り当て済みかどうかの判定に用いる
+        self._grid_size = compute_product([len(hp.choices) for hp in self.hps if isinstance(hp, HyperParameterWithChoices)]) if sampling == "grid" else None
+
+        # NOTE: pruner が指定されていない場合は中間評価値の監視自体を行わない
+        self._pruning = pruner is not None
+        multi_objective = self.objectives is not None and self.objectives.is_multi_objective()
+        if multi_objective and self._pruning:
+            raise ValueError("Pruning is not supported for multi-objective optimization")
+        study = optuna.create_study(
+            direction=direction if not multi_objective else None,
+            directions=self.objectives.directions(direction) if self.objectives is not None and multi_objective else None,
+            sampler=sampler,
+            pruner=pruner,
+            storage=storage,
+            study_name=study_name,
+            load_if_exists=resume or join,
+        )
+        for key, value in (study_attrs or {}).items():
+            study.set_user_attr(key, value)
+        if self.objectives is not None and multi_objective:
+            with warnings.catch_warnings():
+                # NOTE: set_metric_names は experimental（名前は可視化と stats.json に用いる）
+                warnings.simplefilter("ignore", optuna.exceptions.ExperimentalWarning)
+                study.set_metric_names(self.objectives.names())
+        if resume:
+            assert storage is not None, "storage is required to resume a study"
+            n_recovered = recover_interrupted_trials(study, storage)
+            n_trials = max(0, n_trials - count_finished_trials(study))
+            print(f"Resuming the study {study.study_name}: {n_trials} trials remaining ({n_recovered} interrupted trials will be re-run)")
+        elif join:
+            n_finished = count_finished_trials(study)
+            print(f"Joining the study {study.study_name}: {n_finished} trials finished, {max(0, n_trials - n_finished)} trials remaining")
+            n_trials = max(0, n_trials - n_finished)
+        elif warm_start is not None:
+            self.__class__._enqueue_warm_start(study, warm_start)
+        if (resume or join) and self.replicator is not None:
+            for t in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)):
+                self.replicator.record(t.user_attrs.get("replicate_values", []))
+        self._prepare()
+
+        # NOTE: 他のプロセスの試行も含めた合計が所定の試行数に達したら終了する
+        n_total_trials = n_trials + count_finished_trials(study)
+        try:
+            if async_dispatch:
+                AsyncTrialDispatcher(
+                    study,
+                    objective=self._objective,
+                    suggest=self._suggest_params,
+                    n_in_flight=self.executor.n_workers,
+                    catch=(ExecutionLimitExceeded,),
+                    callbacks=callbacks,
+                ).run(n_trials, n_total_trials=n_total_trials)
+            else:
+                study.optimize(
+                    lambda trial: self._objective(
+                        trial,
+                    ),
+                    n_trials=n_trials,
+                    n_jobs=self.executor.n_workers,  # NOTE: 各スレッドは executor から空いているサンドボックスを借りて実行する
+                    callbacks=[*(callbacks or []), optuna.study.MaxTrialsCallback(n_total_trials, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED))],
+                    catch=(ExecutionLimitExceeded,),  # NOTE: 制限を超えた試行は FAIL として記録し，study は止めない
+                )
+        except KeyboardInterrupt:
+            pass
+
+        best_trial = select_best_trial(study)
+        return StudyResult(
+            trial_results=StudyTrialResults(study, self._decode_params, len(self.hps)),
+            study=study,
+            best_params=self._decode_params(best_trial.params) if best_trial is not None else None,
+            best_value=best_trial.values[0] if best_trial is not None else None,
+        )
+
+    def _objective(
+        self,
+        trial: optuna.Trial,
+        spans: list[PhaseSpan] | None = None,
+    ) -> float | tuple[float, ...]:
+        """
+        spans を渡した場合は，HP は提案済み（その時間は spans に記録済み）とみなす（AsyncTrialDispatcher から呼ばれる場合）
+        """
+        if spans is not None:
+            # NOTE: 提案済みの HP について suggest_* は記録済みの値を返すだけ
+            params = self._suggest_params(trial)
+        else:
+            spans = []
+            # NOTE: optuna の sampler は ask の中（試行の開始時刻以降）と suggest_* の中で動くので，その両方を sample とみなす
+            with TrialProfiler.span(spans, "sample", start=trial.datetime_start.timestamp() if trial.datetime_start is not None else None):
+                params = self._suggest_params(trial)
+        # print(f"[suggestion] {params=}")
+        if self._grid_size is not None and trial.number >= self._grid_size and self._is_running_or_finished(trial, params):
+            # NOTE: 複数のプロセスで分担していると，全てのセルが割り当て済みになった後にも試行が作られることがあり，
+            #       GridSampler はそれに実行中・実行済みのセルを割り当てる．同じセルを二重に実行しないよう，実行せずに止める
+            trial.set_user_attr("duplicate", True)
+            trial.study.stop()
+            raise optuna.TrialPruned("All grid cells are already assigned")
+        try:
+            if self.objectives is not None:
+                return self._evaluate_trial_objectives(trial, params, spans)
+            if self.memo is None:
+                return self._evaluate_trial(trial, params, spans)
+            if (memoized_value := self.memo.acquire(params)) is not None:
+                trial.set_user_attr("memoized", True)
+                return memoized_value
+            value = None
+            try:
+                value = self._evaluate_trial(trial, params, spans)
+                return value
+            finally:
+                self.memo.record(params, value)
+        finally:
+            self._record_profile(trial, spans)
+
+    def _create_monitor(self, trial: optuna.Trial) -> TrialPruningMonitor | None:
+        return TrialPruningMonitor(
+            trial,
+            self.evaluator,
+            n_cases=len(self.input_files) if self.input_files is not None else None,
+            progress_pattern=self.progress_pattern,
+        ) if self._pruning else None
+
+    def _evaluate_trial(self, trial: optuna.Trial, params: tuple[ChoiceType, ...], spans: list[PhaseSpan]) -> float:
+        monitor = self._create_monitor(trial)
+        if self.replicator is not None:
+            return self._evaluate_replicated_trial(trial, params, monitor, spans)
+        results = self._execute_params(params, monitor=monitor, spans=spans)
+        self._record_profile(trial, spans, results)
+        return self._evaluate_results(trial, results, monitor, spans)
+
+    def _evaluate_trial_objectives(
+        self,
+        trial: optuna.Trial,
+        params: tuple[ChoiceType, ...],
+        spans: list[PhaseSpan],
+    ) -> float | tuple[float, ...]:
+        """
+        評価値に加えて self.objectives の目的関数を計算し，制約を trial に設定する（単目的の場合は評価値のみを返す）
+        実行フェーズの経過時間（ケースごと）と出力から抽出した指標は，trial の user attribute `run_seconds` / `metrics` に記録する
+        """
+        assert self.objectives is not None
+        monitor = self._create_monitor(trial)
+        results = self._execute_params(params, monitor=monitor, spans=spans)
+        self._record_profile(trial, spans, results)
+        value = self._evaluate_results(trial, results, monitor, spans)
+
+        # NOTE: 分割できない CMD の場合，実行フェーズ (execute) の時間にはビルドの時間も含まれる
+        run_seconds = [
+            sum(seconds for name, seconds in TrialProfiler.total_durations(result.spans).items() if name in ("run", "execute"))
+            for result in results
+        ]
+        metrics = self.evaluator.evaluate_metrics(results)
+        patterns = self.objectives.metric_patterns()
+        trial.set_user_attr("run_seconds", run_seconds)
+        trial.set_user_attr("metrics", dict(zip(patterns, metrics)))
+        if (missing := next((pattern for pattern, metric in zip(patterns, metrics) if metric is None), None)) is not None:
+            raise RuntimeError(f"Metric extraction failed. Check that result.stdout or result.stderr contains the pattern: {missing}")
+
+        # NOTE: 制約の値は 0 以下なら満たしているとみなされる
+        constraints: dict[str, float] = {}
+        if self.objectives.time_limit is not None:
+            constraints["time_limit"] = compute_quantile(run_seconds, self.objectives.time_quantile) - self.objectives.time_limit
+        n_extra_objectives = len(self.objectives.extra_objectives)
+        for (pattern, upper_bound), metric in zip(self.objectives.extra_constraints, metrics[n_extra_objectives:]):
+            assert metric is not None
+            constraints[pattern] = metric - upper_bound
+        for key, constraint in constraints.items():
+            trial.set_constraint(key, constraint)
+        if len(constraints) > 0:
+            trial.set_user_attr("feasible", all(constraint <= 0 for constraint in constraints.values()))
+        if not self.objectives.is_multi_objective():
+            return value
+        values = [value] + ([statistics.fmean(run_seconds)] if self.objectives.time else [])
+        values += [metric for metric in metrics[:n_extra_objectives] if metric is not None]
+        return tuple(values)
+
+    def _evaluate_replicated_trial(
+        self,
+        trial: optuna.Trial,
+        params: tuple[ChoiceType, ...],
+        monitor: TrialPruningMonitor | None,
+        spans: list[PhaseSpan],
+    ) -> float:
+        """
+        self.replicator が止めるまでシードを変えて繰り返し実行し，評価値の平均を返す
+        各回の評価値・分散・平均の信頼区間の半幅・止めた理由は trial の user attribute に記録する
+        （中間評価値の報告による pruning は 1 回目の実行でのみ行う）
+        """
+        assert self.replicator is not None
+        maximize = trial.study.direction == optuna.study.StudyDirection.MAXIMIZE
+        incumbent = self.__class__._get_best_value(trial.study)
+        values: list[float] = []
+        all_results: list[ExecutionResult] = []
+        queue_spans: list[PhaseSpan] = []
+        # NOTE: 同じワーカーで繰り返すことで，ビルドは最初の一回で済む
+        with self._acquire_executor(queue_spans) as executor:
+            spans.extend(queue_spans)
+            while True:
+                run_monitor = monitor if len(values) == 0 else None
+                results = self._execute_params(params, monitor=run_monitor, spans=spans, env=self.replicator.env(len(values)), executor=executor)
+                all_results.extend(results)
+                self._record_profile(trial, spans, all_results)
+                values.append(self._evaluate_results(trial, results, run_monitor, spans))
+                trial.set_user_attr("replicate_values", values)
+                if (stop_reason := self.replicator.stop_reason(values, incumbent, maximize)) is not None:
+                    break
+        self.replicator.record(values)
+        half_width = self.replicator.half_width(values)
+        trial.set_user_attr("value_variance", statistics.variance(values) if len(values) >= 2 else None)
+        trial.set_user_attr("value_half_width", half_width if math.isfinite(half_width) else None)
+        trial.set_user_attr("replicate_stop_reason", stop_reason)
+        return statistics.fmean(values)
+
+    def _evaluate_results(
+        self,
+        trial: optuna.Trial,
+        results: list[ExecutionResult],
+        monitor: TrialPruningMonitor | None,
+        spans: list[PhaseSpan],
+    ) -> float:
+        if monitor is not None and monitor.should_stop():
+            raise optuna.TrialPruned()
+        if (exceeded := self._find_limit_exceeded(results)) is not None:
+            trial.set_user_attr("limit_exceeded", exceeded.limit_exceeded)
+            raise ExecutionLimitExceeded(f"Execution limit exceeded ({exceeded.limit_exceeded}).\n----\n{exceeded.stderr[-1000:]}")
+        with TrialProfiler.span(spans, "parse"):
+            value, case_values = self.evaluator.evaluate_cases(results)
+        # print(f"    {value=}")
+        if self.input_files is not None:
+            trial.set_user_attr("case_values", case_values)
+        if value is None:
+            result = next(r for r, v in zip(results, case_values) if v is None)
+            raise RuntimeError(f"Value extraction failed. Check that result.stdout or result.stderr contains the value patterns.\n----\n{self.evaluator=}\n----\n{result=}")
+        return value
+
+    def _is_running_or_finished(self, trial: optuna.Trial, params: tuple[ChoiceType, ...]) -> bool:
+        """
+        trial 以外に，同じ HP の組で実行中・実行済みの試行があるかどうか
+        """
+        states = (optuna.trial.TrialState.RUNNING, optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+        return any(
+            t.number != trial.number and len(t.params) == len(self.hps) and self._decode_params(t.params) == params and not t.user_attrs.get("duplicate", False)
+            for t in trial.study.get_trials(deepcopy=False, states=states)
+        )
+
+    @staticmethod
+    def _get_best_value(study: optuna.study.Study) -> float | None:
+        try:
+            return study.best_value
+        except ValueError:
+            # NOTE: 完了した試行がまだ無い
+            return None
     
-    def __next__(self) -> tuple[tuple[ChoiceType, ...], str]:
-        values = next(self.product)
-        return values, self.parameterizer.apply_params(values)
 
 
-class GridSearchStudyConductor:
+class SuccessiveHalvingStudyConductor(StudyConductorBase):
+    """
+    候補たちを，だんだん大きくなるテストケースの部分集合（例: 8 → 32 → 128 → 全て）で評価し，
+    各段 (rung) で上位 1/reduction_factor のみを次の段に進める (successive halving)
+    - テストケースの順番は seed により study ごとに一つに固定されるので，同じ段の候補どうしは同じケース集合で比較される
+    - 前の段で評価済みのケースは再実行せず，追加分のケースのみを実行する
+    - 途中の段で落とされた候補は PRUNED として study に記録される
+    NOTE: 最初の段の候補は全て，どの候補の評価値も tell する前に ask される（同じケース集合で比べてから上位を選ぶため）．
+    そのため TPE は他の候補の結果を参照できずランダムな提案と変わらないので，sampling のデフォルトは random とする
+    """
     def __init__(
         self,
         parameterizer: SourceParameterizer,
-        executor: SourceExecutor,
-        evaluator: OutputEvaluator
+        executor: SourceExecutor | SourceExecutorPool,
+        evaluator: OutputEvaluator,
+        input_files: list[Path],
+        compile_once: bool = False,
+        record_spans: bool = False,
     ):
-        self.parameterizer = parameterizer
-        self.executor = executor
-        self.evaluator = evaluator
-    
-    def run(self) -> StudyResult:
-        trial_results: list[tuple[tuple[ChoiceType, ...], float | None]]  = []
-        iterator = GridSearchSourceIterator(self.parameterizer)
-        for i, (param, mod_source) in enumerate(iterator, start=1):
-            print(f"[{i} / {len(iterator)}] {param=}")
-            result = self.executor.execute(mod_source)
-            value = self.evaluator.evaluate(result)
-            trial_results.append((param, value))
-            print(f"    {value=}")
-        
-        trial_results_with_value = [(param, value) for param, value in trial_results if value is not None]
-        best_trial = max(trial_results_with_value, key=lambda x: x[1]) if len(trial_results_with_value) > 0 else None
+        super().__init__(parameterizer, executor, evaluator, compile_once=compile_once, input_files=input_files, record_spans=record_spans)
+        self.input_files: list[Path] = input_files
+
+    def run(
+        self,
+        n_trials: int,
+        direction: str,
+        sampling: str = "random",
+        min_cases: int = 8,
+        reduction_factor: int = 4,
+        seed: int = 0,
+        storage: optuna.storages.BaseStorage | None = None,
+        study_name: str | None = None,
+        warm_start: WarmStart | None = None,
+        callbacks: list[Callable[[optuna.study.Study, optuna.trial.FrozenTrial], None]] | None = None,
+    ) -> StudyResult:
+        if reduction_factor < 2:
+            raise ValueError(f"reduction_factor must be at least 2: {reduction_factor=}")
+        case_order = list(self.input_files)
+        random.Random(seed).shuffle(case_order)
+        rung_sizes = self.__class__.compute_rung_sizes(len(case_order), min_cases, reduction_factor)
+
+        study = optuna.create_study(direction=direction, sampler=self._create_sampler(sampling, seed=seed), storage=storage, study_name=study_name)
+        study.set_user_attr("case_order", [str(f) for f in case_order])
+        if warm_start is not None:
+            # NOTE: enqueue した試行は最初の ask で候補になる
+            self.__class__._enqueue_warm_start(study, warm_start)
+        self._prepare()
+
+        # 全ての候補を先に ask しておく（各段の評価値を report するため，tell は最後の段まで保留する）
+        candidates: list[tuple[optuna.Trial, tuple[ChoiceType, ...]]] = []
+        spans: dict[int, list[PhaseSpan]] = {}
+        for _ in range(n_trials):
+            sample_spans: list[PhaseSpan] = []
+            with TrialProfiler.span(sample_spans, "sample"):
+                trial = study.ask()
+                params = self._suggest_params(trial)
+            candidates.append((trial, params))
+            spans[trial.number] = sample_spans
+        case_values: dict[int, list[float | None]] = {trial.number: [] for trial, _ in candidates}
+        # NOTE: 最大常駐メモリ・終了ステータスを記録するため，各段の実行結果から出力を除いたものを残しておく
+        profiled_results: dict[int, list[ExecutionResult]] = {trial.number: [] for trial, _ in candidates}
+        rung_budgets: list[dict[str, Any]] = []
+
+        # NOTE: 次の段に進んだ候補は（空いている）別のワーカーで実行されうるので，ビルド済みのバイナリを残しておき再ビルドを省略する
+        retain_builds = self.executor.retain_builds() if not self.compile_once else nullcontext()
+        try:
+            with retain_builds:
+                n_done_cases = 0
+                for rung, rung_size in enumerate(rung_sizes):
+                    new_cases = case_order[n_done_cases:rung_size]
+                    start_time = time.perf_counter()
+
+                    def _evaluate(candidate: tuple[optuna.Trial, tuple[ChoiceType, ...]]) -> None:
+                        trial, params = candidate
+                        trial_spans = spans[trial.number]
+                        results = self._execute_params(params, input_files=new_cases, spans=trial_spans)
+                        profiled_results[trial.number].extend(
+                            ExecutionResult(stdout="", stderr="", return_code=r.return_code, peak_rss_kb=r.peak_rss_kb) for r in results
+                        )
+                        self._record_profile(trial, trial_spans, profiled_results[trial.number])
+                        if (exceeded := self._find_limit_exceeded(results)) is not None:
+                            trial.set_user_attr("limit_exceeded", exceeded.limit_exceeded)
+                            case_values[trial.number].append(None)
+                            return
+                        with TrialProfiler.span(trial_spans, "parse"):
+                            _, new_case_values = self.evaluator.evaluate_cases(results)
+                        case_values[trial.number].extend(new_case_values)
+                        self._record_profile(trial, trial_spans)
+
+                    with ThreadPoolExecutor(max_workers=self.executor.n_workers) as pool:
+                        list(pool.map(_evaluate, candidates))
+
+                    rung_budgets.append({
+                        "rung": rung,
+                        "n_cases": rung_size,
+                        "n_candidates": len(candidates),
+                        "n_case_runs": len(candidates) * len(new_cases),
+                        "elapsed_seconds": time.perf_counter() - start_time,
+                    })
+                    print(f"[rung {rung}] {len(candidates)} candidates x {len(new_cases)} new cases (total {rung_size} cases): {rung_budgets[-1]['elapsed_seconds']:.1f}s")
+
+                    # 評価値が得られなかった候補は失敗とし，残りを評価値で並べる
+                    scored: list[tuple[float, optuna.Trial, tuple[ChoiceType, ...]]] = []
+                    for trial, params in candidates:
+                        values = case_values[trial.number]
+                        trial.set_user_attr("case_values", values)
+                        if any(v is None for v in values):
+                            study.tell(trial, state=optuna.trial.TrialState.FAIL)
+                            continue
+                        score = sum(v for v in values if v is not None)
+                        trial.report(score, rung_size)
+                        scored.append((score, trial, params))
+                    scored.sort(key=lambda x: x[0], reverse=(direction == "maximize"))
+
+                    n_done_cases = rung_size
+                    if rung == len(rung_sizes) - 1:
+                        for score, trial, _ in scored:
+                            frozen_trial = study.tell(trial, score)
+                            for callback in callbacks or []:
+                                callback(study, frozen_trial)
+                        break
+                    n_promoted = max(1, len(scored) // reduction_factor)
+                    for _, trial, _ in scored[n_promoted:]:
+                        frozen_trial = study.tell(trial, state=optuna.trial.TrialState.PRUNED)
+                        for callback in callbacks or []:
+                            callback(study, frozen_trial)
+                    candidates = [(trial, params) for _, trial, params in scored[:n_promoted]]
+        except KeyboardInterrupt:
+            pass
+
+        study.set_user_attr("rung_budgets", rung_budgets)
+        completed_trials = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))
+        return StudyResult(
+            trial_results=StudyTrialResults(study, self._decode_params, len(self.hps)),
+            study=study,
+            best_params=self._decode_params(study.best_params) if len(completed_trials) > 0 else None,
+            best_value=study.best_value if len(completed_trials) > 0 else None,
+        )
+
+    @staticmethod
+    def compute_rung_sizes(n_cases: int, min_cases: int, reduction_factor: int) -> list[int]:
+        """
+        各段で用いるケース数のリストを返す（例: n_cases=500, min_cases=8, reduction_factor=4 なら [8, 32, 128, 500]）
+        """
+        rung_sizes: list[int] = []
+        size = min_cases
+        while size < n_cases:
+            rung_sizes.append(size)
+            size *= reduction_factor
+        rung_sizes.append(n_cases)
+        return rung_sizes
+
+
+class GridSearchStudyConductor(StudyConductorBase):
+    def run(
+        self,
+        shard: GridShard | None = None,
+        results: GridShardResults | None = None,
+        maximize: bool = True,
+    ) -> StudyResult:
+        """
+        grid（shard を指定した場合はその担当範囲）の全ての点を実行する
+        results を指定すると，各点の結果は完了するたびにそのファイルに追記され，記録済みの点は実行されない
+        （この場合は結果をメモリに溜めないので，StudyResult の trial_results は空になる）
+        """
+        shard = shard if shard is not None else GridShard(self.hps)
+        done = results.load() if results is not None else {}
+        trial_results = GridTrialResults(shard)
+        best: tuple[tuple[ChoiceType, ...], float] | None = None
+        for index, value in done.items():
+            if value is not None and (best is None or (value > best[1] if maximize else value < best[1])):
+                best = (shard.params_at(index), value)
+        if len(done) > 0:
+            print(f"Skipping {len(done)} finished points of {shard}")
+        self._prepare()
+
+        def _evaluate(param: tuple[ChoiceType, ...]) -> tuple[tuple[ChoiceType, ...], float | None]:
+            if self.memo is not None and (memoized_value := self.memo.acquire(param)) is not None:
+                return param, memoized_value
+            value = None
+            try:
+                execution_results = self._execute_params(param)
+                if self._find_limit_exceeded(execution_results) is None:
+                    value, _ = self.evaluator.evaluate_cases(execution_results)
+                return param, value
+            finally:
+                if self.memo is not None:
+                    self.memo.record(param, value)
+
+        # NOTE: grid を一度に全て submit するとその分のメモリを使うので，実行中の点の数をワーカー数の 2 倍までに抑えて逐次 submit する
+        n_in_flight = 2 * self.executor.n_workers
+        index_iterator = shard.indices(done)
+        with ThreadPoolExecutor(max_workers=self.executor.n_workers) as pool:
+            in_flight: deque[tuple[int, Future[tuple[tuple[ChoiceType, ...], float | None]]]] = deque(
+                (index, pool.submit(_evaluate, shard.params_at(index))) for index in itertools.islice(index_iterator, n_in_flight)
+            )
+            i = len(done)
+            while len(in_flight) > 0:
+                i += 1
+                index, future = in_flight.popleft()
+                param, value = future.result()
+                if (next_index := next(index_iterator, None)) is not None:
+                    in_flight.append((next_index, pool.submit(_evaluate, shard.params_at(next_index))))
+                print(f"[{i} / {len(shard)}] {param=}")
+                print(f"    {value=}")
+                if results is not None:
+                    results.append(index, param, value)
+                else:
+                    trial_results.append(index, value)
+                if value is not None and (best is None or (value > best[1] if maximize else value < best[1])):
+                    best = (param, value)
+
         return StudyResult(
             trial_results=trial_results,
             study=None,
-            best_params=best_trial[0] if best_trial is not None else None,
-            best_value=best_trial[1] if best_trial is not None else None
+            best_params=best[0] if best is not None else None,
+            best_value=best[1] if best is not None else None
         )
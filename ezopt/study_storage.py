@@ -0,0 +1,62 @@
+
+
+import optuna
+from optuna.trial import TrialState
+
+
+def create_storage(storage: str) -> optuna.storages.BaseStorage:
+    """
+    --storage の指定から optuna の storage を作る
+    - "sqlite:///path/to/db" のような URL の場合は RDBStorage
+    - それ以外はファイルパスとみなして JournalStorage（追記型のファイル）
+    """
+    if "://" in storage:
+        return optuna.storages.RDBStorage(storage)
+    try:
+        from optuna.storages.journal import JournalFileBackend
+        return optuna.storages.JournalStorage(JournalFileBackend(storage))
+    except ImportError:
+        # NOTE: optuna < 4.0 には JournalFileBackend が無い
+        return optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(storage))  # type: ignore[attr-defined]
+
+
+def recover_interrupted_trials(study: optuna.study.Study, storage: optuna.storages.BaseStorage) -> int:
+    """
+    中断された study を再開するための処理
+    - 中断時に実行中だった (RUNNING のまま残っている) 試行を FAIL とし，同じパラメータで再実行されるように enqueue する
+    - 戻り値は再実行のために enqueue した試行の数
+    """
+    interrupted_trials = study.get_trials(deepcopy=False, states=(TrialState.RUNNING,))
+    for trial in interrupted_trials:
+        storage.set_trial_state_values(trial._trial_id, state=TrialState.FAIL)
+        study.enqueue_trial(trial.params)
+    return len(interrupted_trials)
+
+
+def count_finished_trials(study: optuna.study.Study) -> int:
+    """
+    既に結果が確定している（再実行の必要の無い）試行の数
+    NOTE: 実行済みの grid のセルと重複したために実行せずに止めた試行 (user_attrs["duplicate"]) は数えない
+    """
+    return len([
+        t for t in study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED))
+        if not t.user_attrs.get("duplicate", False)
+    ])
+
+
+def select_best_trial(study: optuna.study.Study) -> optuna.trial.FrozenTrial | None:
+    """
+    制約を満たす完了した試行のうち，評価値が最良のもの（多目的の場合は Pareto 解のうち，最初の目的関数である評価値が最良のもの）
+    """
+    if len(study.directions) == 1:
+        try:
+            return study.best_trial
+        except ValueError:
+            # NOTE: 完了した（制約を満たす）試行がまだ無い
+            return None
+    best_trials = study.best_trials
+    if len(best_trials) == 0:
+        return None
+    if study.directions[0] == optuna.study.StudyDirection.MAXIMIZE:
+        return max(best_trials, key=lambda t: t.values[0])
+    return min(best_trials, key=lambda t: t.values[0])
@@ -4,8 +4,18 @@ import json
 import os
 from pathlib import Path
 import pickle
+import random
+import threading
+import traceback
+from typing import Any, Callable
 
 import optuna
+from optuna.trial import TrialState
+
+from ezopt.models import PhaseSpan
+from ezopt.study_storage import select_best_trial
+from ezopt.trial_profiler import TrialProfiler
+from ezopt.utils import get_random_hex
 
 
 class StudyVisualizer:
@@ -13,43 +23,256 @@ class StudyVisualizer:
     def visualize(
         cls,
         study: optuna.study.Study,
-        output_dir: Path
+        output_dir: Path,
+        fingerprints: dict[str, Any] | None = None,
+        max_plot_trials: int | None = None,
+        seed: int = 0,
+        extra_spans: list[PhaseSpan] | None = None,
     ) -> None:
         """
         optuna の study を受け取って，その結果を可視化してディレクトリに書き出す
+        stats.json には各フェーズにかかった時間の集計も書き出す（extra_spans は試行に属さないフェーズ．可視化自体など）
+        fingerprints を渡すと，前回の呼び出しから入力が変わっていないファイルは再生成しない（fingerprints は更新される）
+        max_plot_trials を渡すと，完了した試行がそれより多い場合は，上位の試行と残りからの層化抽出とで max_plot_trials 個に間引いた上で
+        parallel_coordinate / param_importances / contour / slice を描画する（重要度の推定にも seed を用いる）
+        多目的の場合は Pareto front (pareto_front.html) も描画し，その他の図は最初の目的関数（評価値）について描画する
         """
         os.makedirs(output_dir, exist_ok=True)
-        with open(output_dir / "stats.json", "w") as f:
-            json.dump({
-                "n_trials": len(study.trials),
-                "best_value": study.best_value,
-                "best_params": study.best_params,
-                "direction": study.direction,
-                "trials": [
-                    {
-                        "params": t.params,
-                        "value": t.value,
-                    }
-                    for t in study.trials
-                ]
-            }, f, indent=2, ensure_ascii=False)
-        
-        optuna.visualization.plot_optimization_history(study).write_html(output_dir / "optimization_history.html")
-        optuna.visualization.plot_parallel_coordinate(study).write_html(output_dir / "parallel_coordinate.html")
-        
-        if len(study.best_params) > 1:
-            fig = optuna.visualization.plot_param_importances(study)
-            fig.write_html(output_dir / "param_importances.html")
+        trials = study.get_trials(deepcopy=False)
+        finished_trials = [t for t in trials if t.state.is_finished()]
+        completed_trials = [t for t in finished_trials if t.state == TrialState.COMPLETE]
+        # NOTE: 各ファイルの入力が変わったかどうかは，対象となる試行の (番号, 状態) の並びで判定する
+        finished_fingerprint = tuple((t.number, t.state) for t in finished_trials)
+        completed_fingerprint = tuple(t.number for t in completed_trials)
+        if fingerprints is None:
+            fingerprints = {}
+
+        sampled = max_plot_trials is not None and len(completed_trials) > max_plot_trials
+        report_info = {
+            "n_plot_trials": max_plot_trials if sampled else len(completed_trials),
+            "sampled": sampled,
+            "seed": seed if sampled else None,
+        }
+
+        if fingerprints.get("stats") != finished_fingerprint:
+            timings = TrialProfiler.summarize(finished_trials, extra_spans=extra_spans or [])
+            cls._write_atomic(output_dir / "stats.json", lambda path: cls._write_stats(study, finished_trials, completed_trials, report_info, timings, path))
+            cls._write_atomic(output_dir / "study.pkl", lambda path: cls._write_pickle(study, path))
+            fingerprints["stats"] = finished_fingerprint
+
+        if len(completed_trials) == 0 or fingerprints.get("plots") == completed_fingerprint:
+            return
+
+        multi_objective = len(study.directions) > 1
+        target: Callable[[optuna.trial.FrozenTrial], float] | None = (lambda t: t.values[0]) if multi_objective else None
+        target_name = study.metric_names[0] if multi_objective and study.metric_names is not None else "Objective Value"
+        # NOTE: 重要度の推定 (PED-ANOVA) は target が小さいほど良いとみなすので，最初の目的関数を最大化する場合は符号を反転したものを渡す
+        importance_target: Callable[[optuna.trial.FrozenTrial], float] | None = target
+        if multi_objective and study.directions[0] == optuna.study.StudyDirection.MAXIMIZE:
+            importance_target = lambda t: -t.values[0]
+        cls._write_html_atomic(optuna.visualization.plot_optimization_history(study, target=target, target_name=target_name), output_dir / "optimization_history.html")
+        if multi_objective:
+            # NOTE: 目的関数が 4 つ以上の場合は，先頭の 3 つについて描画する
+            fig = optuna.visualization.plot_pareto_front(
+                study,
+                target_names=study.metric_names[:3] if study.metric_names is not None else [f"Objective {i}" for i in range(min(3, len(study.directions)))],
+                targets=(lambda t: t.values[:3]) if len(study.directions) > 3 else None,
+            )
+            cls._write_html_atomic(fig, output_dir / "pareto_front.html")
+
+        plot_study = study
+        importance_evaluator = None
+        if sampled:
+            assert max_plot_trials is not None
+            plot_study = cls._create_sampled_study(study, completed_trials, max_plot_trials, seed)
+            importance_evaluator = cls._create_importance_evaluator(seed)
+        cls._write_html_atomic(optuna.visualization.plot_parallel_coordinate(plot_study, target=target, target_name=target_name), output_dir / "parallel_coordinate.html")
+
+        param_names = list(completed_trials[-1].params.keys())
+        if len(param_names) > 1:
+            fig = optuna.visualization.plot_param_importances(plot_study, evaluator=importance_evaluator, target=importance_target, target_name=target_name)
+            cls._write_html_atomic(fig, output_dir / "param_importances.html")
             params_sorted_by_importance: list[str] = list(fig.data[0].y[::-1])
             # NOTE: get_param_importances で再計算するのは重たい（また seed を合わせないと結果が再現しない）ため，
             # visualization fig から重要パラメータを抽出するようにしている
-        
-            optuna.visualization.plot_contour(study, params=params_sorted_by_importance[:3]).write_html(output_dir / "contour.html")
+
+            cls._write_html_atomic(optuna.visualization.plot_contour(plot_study, params=params_sorted_by_importance[:3], target=target, target_name=target_name), output_dir / "contour.html")
             # NOTE: contour を全変数について出力すると html ファイルサイズが膨大となるので，重要度が高いと思われる 3 パラメータに絞って描画している
         else:
-            params_sorted_by_importance = list(study.best_params.keys())
+            params_sorted_by_importance = param_names
 
-        optuna.visualization.plot_slice(study, params=params_sorted_by_importance[:3]).write_html(output_dir / "slice.html")
+        cls._write_html_atomic(optuna.visualization.plot_slice(plot_study, params=params_sorted_by_importance[:3], target=target, target_name=target_name), output_dir / "slice.html")
+        fingerprints["plots"] = completed_fingerprint
 
-        with open(output_dir / "study.pkl", "wb") as f:
+    @staticmethod
+    def _create_importance_evaluator(seed: int) -> Any:
+        # NOTE: fANOVA は seed を固定しないと結果が再現しないので，決定的な PED-ANOVA が使えるならそちらを使う
+        if hasattr(optuna.importance, "PedAnovaImportanceEvaluator"):
+            return optuna.importance.PedAnovaImportanceEvaluator()
+        return optuna.importance.FanovaImportanceEvaluator(seed=seed)
+
+    @staticmethod
+    def _create_sampled_study(
+        study: optuna.study.Study,
+        completed_trials: list[optuna.trial.FrozenTrial],
+        n_samples: int,
+        seed: int,
+    ) -> optuna.study.Study:
+        """
+        完了した試行を n_samples 個に間引いた（メモリ上の）study を作る
+        - 評価値（多目的の場合は最初の目的関数）の上位 n_samples // 4 個は必ず残す
+        - 残りは評価値の順に並べて層に分け，各層から一様に抽出する（評価値の分布の形を保つため）
+        """
+        sorted_trials = sorted(completed_trials, key=lambda t: t.values[0], reverse=(study.directions[0] == optuna.study.StudyDirection.MAXIMIZE))
+        n_best = n_samples // 4
+        rest = sorted_trials[n_best:]
+        n_rest_samples = n_samples - n_best
+        rng = random.Random(seed)
+        sampled_rest: list[optuna.trial.FrozenTrial] = []
+        for i in range(n_rest_samples):
+            stratum = rest[i * len(rest) // n_rest_samples:(i + 1) * len(rest) // n_rest_samples]
+            sampled_rest.append(rng.choice(stratum))
+
+        sampled_study = optuna.create_study(directions=study.directions)
+        sampled_study.add_trials(sorted(sorted_trials[:n_best] + sampled_rest, key=lambda t: t.number))
+        return sampled_study
+
+    @staticmethod
+    def _write_stats(
+        study: optuna.study.Study,
+        finished_trials: list[optuna.trial.FrozenTrial],
+        completed_trials: list[optuna.trial.FrozenTrial],
+        report_info: dict[str, Any],
+        timings: dict[str, Any],
+        path: Path,
+    ) -> None:
+        # NOTE: 試行数が多い場合に巨大な dict を作らないよう，試行は一つずつ書き出す
+        # NOTE: 多目的の場合，best_value / best_params は Pareto 解のうち最初の目的関数（評価値）が最良のもの
+        multi_objective = len(study.directions) > 1
+        best_trial = select_best_trial(study) if len(completed_trials) > 0 else None
+        header: dict[str, Any] = {
+            "n_trials": len(finished_trials),
+            "best_value": best_trial.values[0] if best_trial is not None else None,
+            "best_params": best_trial.params if best_trial is not None else None,
+            "direction": study.directions[0],
+        }
+        if multi_objective:
+            header["directions"] = study.directions
+            header["objective_names"] = study.metric_names
+            header["pareto_front"] = [{"number": t.number, "params": t.params, "values": t.values} for t in study.best_trials]
+        header["report"] = report_info
+        header["timings"] = timings
+        with open(path, "w") as f:
+            f.write("{\n")
+            for key, value in header.items():
+                f.write(f"  {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)},\n")
+            f.write('  "trials": [')
+            for i, t in enumerate(finished_trials):
+                f.write("\n    " if i == 0 else ",\n    ")
+                record: dict[str, Any] = {"params": t.params, "value": t.values[0] if t.values is not None else None}
+                if multi_objective:
+                    record["values"] = t.values
+                if "feasible" in t.user_attrs:
+                    record["feasible"] = t.user_attrs["feasible"]
+                if "replicate_values" in t.user_attrs:
+                    # NOTE: シードを変えて繰り返し実行した試行は，value が平均値なのでその分散も書き出す
+                    record["n_runs"] = len(t.user_attrs["replicate_values"])
+                    record["value_variance"] = t.user_attrs.get("value_variance")
+                f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n  ]\n}\n")
+
+    @staticmethod
+    def _write_pickle(study: optuna.study.Study, path: Path) -> None:
+        with open(path, "wb") as f:
             pickle.dump(study, f)
+
+    @classmethod
+    def _write_html_atomic(cls, fig: Any, path: Path) -> None:
+        cls._write_atomic(path, lambda tmp_path: fig.write_html(tmp_path))
+
+    @staticmethod
+    def _write_atomic(path: Path, write: Callable[[Path], None]) -> None:
+        """
+        一時ファイルに書き出してから rename することで，書きかけのファイルが読まれないようにする
+        """
+        tmp_path = path.with_name(f".{path.name}.{get_random_hex(8)}.tmp")
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+class PeriodicStudyVisualizer:
+    """
+    最適化の実行中に，バックグラウンドのスレッドで定期的に StudyVisualizer.visualize を行うクラス
+    - interval_seconds 秒ごと，または every_n_trials 試行が完了するごとに可視化を更新する
+    - study.optimize の callbacks に渡して使う（試行の実行はブロックしない）
+    """
+    def __init__(
+        self,
+        output_dir: Path,
+        interval_seconds: float | None = None,
+        every_n_trials: int | None = None,
+        max_plot_trials: int | None = None,
+        seed: int = 0,
+    ):
+        self.output_dir = output_dir
+        self.interval_seconds = interval_seconds
+        self.every_n_trials = every_n_trials
+        self.max_plot_trials = max_plot_trials
+        self.seed = seed
+        self._study: optuna.study.Study | None = None
+        self._n_finished_trials = 0
+        self._fingerprints: dict[str, Any] = {}
+        # 可視化にかかった時間（stats.json の集計と trace に用いる）
+        self.spans: list[PhaseSpan] = []
+        self._requested = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self) -> "PeriodicStudyVisualizer":
+        self._thread.start()
+        return self
+
+    def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
+        self._study = study
+        self._n_finished_trials += 1
+        if self.every_n_trials is not None and self._n_finished_trials % self.every_n_trials == 0:
+            self._requested.set()
+
+    def stop(self, study: optuna.study.Study | None = None) -> None:
+        """
+        バックグラウンドのスレッドを止め，最後にもう一度（変更があれば）可視化を行う
+        """
+        self._stopped.set()
+        self._requested.set()
+        self._thread.join()
+        if study is not None:
+            self._study = study
+        if self._study is not None:
+            self._visualize(self._study)
+
+    def _loop(self) -> None:
+        while not self._stopped.is_set():
+            self._requested.wait(timeout=self.interval_seconds)
+            self._requested.clear()
+            if self._stopped.is_set() or self._study is None:
+                continue
+            try:
+                self._visualize(self._study)
+            except Exception:
+                # NOTE: 可視化の失敗で最適化自体を止めないようにする
+                traceback.print_exc()
+
+    def _visualize(self, study: optuna.study.Study) -> None:
+        with TrialProfiler.span(self.spans, "visualize"):
+            StudyVisualizer.visualize(
+                study,
+                self.output_dir,
+                fingerprints=self._fingerprints,
+                max_plot_trials=self.max_plot_trials,
+                seed=self.seed,
+                extra_spans=self.spans,
+            )
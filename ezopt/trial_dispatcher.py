@@ -0,0 +1,129 @@
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Sequence
+
+import optuna
+from optuna.trial import TrialState
+
+from ezopt.models import PhaseSpan
+from ezopt.study_storage import count_finished_trials
+from ezopt.trial_profiler import TrialProfiler
+
+
+_logger = optuna.logging.get_logger("optuna.ezopt")
+
+
+class AsyncTrialDispatcher:
+    """
+    optuna の ask / tell を用いて，試行の提案と実行を切り離して進めるクラス（asyncio のイベントループで駆動する）
+    - 実行中の試行が常に n_in_flight 個になるよう，試行が（どの順でも）終わり次第 tell して次の試行を始める
+    - 次の候補は実行中の試行の裏で sampler 用のスレッドが前もって提案しておくので，sampler の時間が各試行に上乗せされない
+    - 実行中の試行は RUNNING として study に記録されているので，constant liar の TPE はそれを考慮して並列の提案が固まらないようにする
+    NOTE: 試行の実行（ビルド・実行・出力の解析）自体は，実行制限・常駐プロセスなどを扱う SourceExecutor をそのままスレッドで用いる
+    """
+    def __init__(
+        self,
+        study: optuna.study.Study,
+        objective: Callable[[optuna.Trial, list[PhaseSpan]], float | Sequence[float]],
+        suggest: Callable[[optuna.Trial], Any],
+        n_in_flight: int,
+        catch: tuple[type[Exception], ...] = (),
+        callbacks: list[Callable[[optuna.study.Study, optuna.trial.FrozenTrial], None]] | None = None,
+    ):
+        """
+        suggest は候補の HP を trial に提案させる関数（sampler 用のスレッドで呼ばれる）
+        objective は提案済みの trial を評価する関数（提案にかかった時間の spans を受け取る）
+        catch に含まれる例外で失敗した試行は FAIL として続行し，それ以外の例外は実行中の試行を待ってから送出する
+        """
+        if n_in_flight < 1:
+            raise ValueError(f"n_in_flight must be positive: {n_in_flight=}")
+        self.study = study
+        self.objective = objective
+        self.suggest = suggest
+        self.n_in_flight = n_in_flight
+        self.catch = catch
+        self.callbacks = callbacks or []
+
+    def run(self, n_trials: int, n_total_trials: int | None = None) -> None:
+        """
+        n_trials 個の試行を実行する（n_total_trials を指定すると，他のプロセスの試行も含めた完了数がそれに達した時点で終了する）
+        """
+        asyncio.run(self._dispatch(n_trials, n_total_trials))
+
+    async def _dispatch(self, n_trials: int, n_total_trials: int | None) -> None:
+        loop = asyncio.get_running_loop()
+        running: set[asyncio.Future] = set()
+        next_candidate: asyncio.Future | None = None  # 提案中（または提案済みで空きを待っている）の次の候補
+        n_started = 0
+        stopping = False
+        error: BaseException | None = None
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="sampler") as sampler_pool, \
+                ThreadPoolExecutor(max_workers=self.n_in_flight, thread_name_prefix="trial") as trial_pool:
+            while True:
+                if not stopping and next_candidate is None and n_started < n_trials:
+                    next_candidate = loop.run_in_executor(sampler_pool, self._ask)
+                if next_candidate is not None and not stopping and len(running) < self.n_in_flight:
+                    trial, spans = await next_candidate
+                    next_candidate = None
+                    running.add(loop.run_in_executor(trial_pool, self._evaluate, trial, spans))
+                    n_started += 1
+                    continue
+                if len(running) == 0:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    trial, state, values, func_err = future.result()
+                    frozen_trial = self._tell(trial, state, values, func_err)
+                    if func_err is not None and not isinstance(func_err, (optuna.TrialPruned, *self.catch)):
+                        error = error or func_err
+                        stopping = True
+                        continue
+                    for callback in self.callbacks:
+                        callback(self.study, frozen_trial)
+                    if n_total_trials is not None and count_finished_trials(self.study) >= n_total_trials:
+                        stopping = True
+            if next_candidate is not None:
+                # NOTE: 途中で終了した場合，提案済みで実行しなかった候補は FAIL とする（再開時に再実行されないように）
+                trial, _ = await next_candidate
+                trial.set_user_attr("not_run", True)
+                self.study.tell(trial, state=TrialState.FAIL)
+        if error is not None:
+            raise error
+
+    def _ask(self) -> tuple[optuna.Trial, list[PhaseSpan]]:
+        spans: list[PhaseSpan] = []
+        with TrialProfiler.span(spans, "sample"):
+            trial = self.study.ask()
+            self.suggest(trial)
+        return trial, spans
+
+    def _evaluate(self, trial: optuna.Trial, spans: list[PhaseSpan]) -> tuple[optuna.Trial, TrialState, float | Sequence[float] | None, BaseException | None]:
+        try:
+            return trial, TrialState.COMPLETE, self.objective(trial, spans), None
+        except optuna.TrialPruned as e:
+            return trial, TrialState.PRUNED, None, e
+        except Exception as e:
+            return trial, TrialState.FAIL, None, e
+
+    def _tell(
+        self,
+        trial: optuna.Trial,
+        state: TrialState,
+        values: float | Sequence[float] | None,
+        func_err: BaseException | None,
+    ) -> optuna.trial.FrozenTrial:
+        if state == TrialState.COMPLETE:
+            frozen_trial = self.study.tell(trial, values, skip_if_finished=True)
+        else:
+            frozen_trial = self.study.tell(trial, state=state, skip_if_finished=True)
+        if frozen_trial.state == TrialState.COMPLETE:
+            assert frozen_trial.values is not None
+            value_text = f"value: {frozen_trial.values[0]}" if len(frozen_trial.values) == 1 else f"values: {frozen_trial.values}"
+            _logger.info(f"Trial {frozen_trial.number} finished with {value_text} and parameters: {frozen_trial.params}.")
+        elif frozen_trial.state == TrialState.PRUNED:
+            _logger.info(f"Trial {frozen_trial.number} pruned. {func_err}")
+        else:
+            _logger.warning(f"Trial {frozen_trial.number} failed with parameters: {frozen_trial.params} because of the following error: {func_err!r}.")
+        return frozen_trial
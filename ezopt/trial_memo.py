@@ -0,0 +1,101 @@
+
+
+from collections import defaultdict
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+
+from ezopt.models import ChoiceType
+
+
+class TrialMemo:
+    """
+    HP の具体値の組をキーとして評価値を記録しておき，同じ組が再び現れたときに実行を省略するためのメモ
+    - 同じ組は max_repeats 回まで実際に実行され（ノイズのある目的関数のため），それ以降は記録済みの値の平均を返す
+    - path を指定すると，記録はファイル (JSON Lines) に追記され，以降の起動でも再利用される
+    - 同じ組が並列に要求された場合，実行中のものの結果を待ってから判断する（二重に実行しないように）
+    - fingerprint（評価値を左右するソース・コマンドなどのハッシュ）を指定すると，各記録に添えて書き込み，
+      ファイルから読み込む際は fingerprint が一致しない記録を無視する（ソースなどを変えた後に古い評価値を返さないように）
+    """
+    def __init__(self, path: str | Path | None = None, max_repeats: int = 1, fingerprint: str | None = None):
+        if max_repeats < 1:
+            raise ValueError(f"max_repeats must be positive: {max_repeats=}")
+        self.path = Path(path) if path is not None else None
+        self.max_repeats = max_repeats
+        self.fingerprint = fingerprint
+        self._values: dict[str, list[float]] = defaultdict(list)
+        self._n_pending: dict[str, int] = defaultdict(int)
+        self._cond = threading.Condition()
+        self.n_stale_records = 0  # fingerprint が一致せず無視した記録の数
+        if self.path is not None and self.path.exists():
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        if record.get("fingerprint") != self.fingerprint:
+                            self.n_stale_records += 1
+                            continue
+                        self._values[self.__class__._key(record["params"])].append(record["value"])
+            if self.n_stale_records > 0:
+                print(f"Warning: ignored {self.n_stale_records} memo records in {self.path} made with a different source, command, value pattern or inputs")
+
+    @staticmethod
+    def compute_fingerprint(source: str, cmd: str, value_pattern: str, aggregation: str, input_files: list[Path] | None = None) -> str:
+        """
+        評価値を左右する入力（編集前のソース・コマンド・評価値のパターンと集約方法・入力ファイルの名前と内容）のハッシュを返す
+        """
+        h = hashlib.sha256()
+        for text in (source, cmd, value_pattern, aggregation):
+            h.update(text.encode())
+            h.update(b"\0")
+        for input_file in input_files or []:
+            h.update(str(input_file).encode())
+            h.update(b"\0")
+            h.update(input_file.read_bytes())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def acquire(self, params: tuple[ChoiceType, ...]) -> float | None:
+        """
+        記録済みの値を使えるならその平均を返す．そうでなければ None を返す（呼び出し側は実行して record する必要がある）
+        """
+        key = self.__class__._key(params)
+        with self._cond:
+            while True:
+                values = self._values[key]
+                if len(values) >= self.max_repeats:
+                    return sum(values) / len(values)
+                if len(values) + self._n_pending[key] < self.max_repeats:
+                    self._n_pending[key] += 1
+                    return None
+                self._cond.wait()
+
+    def record(self, params: tuple[ChoiceType, ...], value: float | None) -> None:
+        """
+        acquire で None が返された組について，実行結果の評価値を記録する（実行に失敗した場合は value=None）
+        """
+        key = self.__class__._key(params)
+        with self._cond:
+            self._n_pending[key] -= 1
+            if value is not None:
+                self._values[key].append(value)
+                if self.path is not None:
+                    os.makedirs(self.path.parent, exist_ok=True)
+                    with open(self.path, "a") as f:
+                        record = {"params": list(params), "value": value}
+                        if self.fingerprint is not None:
+                            record["fingerprint"] = self.fingerprint
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._cond.notify_all()
+
+    @staticmethod
+    def _key(params: tuple[ChoiceType, ...] | list[ChoiceType]) -> str:
+        return json.dumps(list(params), ensure_ascii=False)
+
+    def __len__(self) -> int:
+        return sum(1 for values in self._values.values() if len(values) > 0)
+
+    def __repr__(self):
+        return f"TrialMemo(path={self.path}, max_repeats={self.max_repeats}, n_entries={len(self)}, n_stale_records={self.n_stale_records})"
@@ -0,0 +1,113 @@
+
+
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Iterable, Iterator
+
+import optuna
+
+from ezopt.models import PhaseSpan
+
+
+class TrialProfiler:
+    """
+    試行の各フェーズ（ソースの書き出し・ビルド・実行・出力の解析・サンプリング・可視化など）にかかった時間を扱うクラス
+    - 各試行のフェーズごとの合計時間は optuna の trial の user attribute `timings` に記録される
+    - それらの study 全体での集計を stats.json に，各フェーズの時刻を Chrome の trace event 形式のファイルに書き出す
+    """
+    @staticmethod
+    @contextmanager
+    def span(spans: list[PhaseSpan], name: str, start: float | None = None) -> Iterator[None]:
+        """
+        with ブロックの実行にかかった時間を name のフェーズとして spans に追加する（start を指定するとそれを開始時刻とする）
+        """
+        if start is None:
+            start = time.time()
+        try:
+            yield
+        finally:
+            spans.append(PhaseSpan(name=name, start=start, end=time.time(), thread=threading.current_thread().name))
+
+    @staticmethod
+    def total_durations(spans: Iterable[PhaseSpan]) -> dict[str, float]:
+        """
+        フェーズごとの合計時間 [秒] を返す（並列に実行されたケースの実行時間も単純に足し合わせる）
+        """
+        durations: dict[str, float] = defaultdict(float)
+        for span in spans:
+            durations[span.name] += span.end - span.start
+        return dict(durations)
+
+    @staticmethod
+    def summarize(trials: list[optuna.trial.FrozenTrial], extra_spans: Iterable[PhaseSpan] = ()) -> dict[str, Any]:
+        """
+        各試行の user attribute `timings` / `peak_rss_kb` を集計する（extra_spans は試行に属さないフェーズ．可視化など）
+        """
+        totals: dict[str, float] = defaultdict(float)
+        counts: dict[str, int] = defaultdict(int)
+        peak_rss_kb: int | None = None
+        for trial in trials:
+            for name, seconds in trial.user_attrs.get("timings", {}).items():
+                totals[name] += seconds
+                counts[name] += 1
+            if (rss := trial.user_attrs.get("peak_rss_kb")) is not None:
+                peak_rss_kb = rss if peak_rss_kb is None else max(peak_rss_kb, rss)
+        for span in extra_spans:
+            totals[span.name] += span.end - span.start
+            counts[span.name] += 1
+        return {
+            "phases": {
+                name: {"total_seconds": totals[name], "mean_seconds": totals[name] / counts[name], "count": counts[name]}
+                for name in sorted(totals, key=lambda name: -totals[name])
+            },
+            "peak_rss_kb": peak_rss_kb,
+        }
+
+    @staticmethod
+    def to_user_attr(spans: list[PhaseSpan]) -> list[list[Any]]:
+        # NOTE: storage に書き込まれるので，[name, start, end, thread] のリストとしてコンパクトに保存する
+        return [[span.name, span.start, span.end, span.thread] for span in spans]
+
+    @classmethod
+    def write_chrome_trace(
+        cls,
+        trials: list[optuna.trial.FrozenTrial],
+        path: Path,
+        extra_spans: Iterable[PhaseSpan] = (),
+    ) -> None:
+        """
+        各試行の user attribute `spans` を Chrome の trace event 形式 (chrome://tracing や Perfetto で開ける) で書き出す
+        スレッドごとに行が分かれるので，ワーカーの待ち時間や空いているコアを時系列で確認できる
+        """
+        spans: list[tuple[PhaseSpan, int | None]] = []
+        for trial in trials:
+            for name, start, end, thread in trial.user_attrs.get("spans", []):
+                spans.append((PhaseSpan(name=name, start=start, end=end, thread=thread), trial.number))
+        spans.extend((span, None) for span in extra_spans)
+        if len(spans) == 0:
+            return
+        origin = min(span.start for span, _ in spans)
+        thread_ids: dict[str, int] = {}
+        events: list[dict[str, Any]] = []
+        for span, trial_number in sorted(spans, key=lambda x: x[0].start):
+            if span.thread not in thread_ids:
+                thread_ids[span.thread] = len(thread_ids)
+                events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": thread_ids[span.thread], "args": {"name": span.thread}})
+            events.append({
+                "name": span.name,
+                "cat": "trial" if trial_number is not None else "study",
+                "ph": "X",
+                "ts": (span.start - origin) * 1e6,
+                "dur": (span.end - span.start) * 1e6,
+                "pid": 0,
+                "tid": thread_ids[span.thread],
+                "args": {"trial": trial_number} if trial_number is not None else {},
+            })
+        os.makedirs(path.parent, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,90 @@
+import math
+import statistics
+import threading
+
+
+class TrialReplicator:
+    """
+    ノイズのある目的関数のため，有望な候補をシードを変えて繰り返し実行し，評価値の平均を試行の値とするための判断を行うクラス
+    - k 回目 (0 始まり) の実行には，シード seed + k を環境変数 seed_env で渡す（CMD に "$EZOPT_SEED" と書けば引数としても渡せる）
+    - 候補ごとに同じシード列を用いるので，候補どうしは同じ乱数系列の上で比較される
+    - 次のいずれかを満たしたら繰り返しを止める
+        - 平均の信頼区間の半幅が |平均| の tolerance 倍以下になった (min_runs 回以上実行した場合のみ)
+        - 信頼区間全体が incumbent（それまでの最良の値）より悪い（明らかに劣っている）
+        - max_runs 回実行した
+    - 1 回しか実行していない候補の分散には，それまでに複数回実行した候補たちの合併分散を用いる（無ければ判断せずに続行する）
+    """
+    def __init__(
+        self,
+        max_runs: int,
+        min_runs: int = 2,
+        tolerance: float = 0.01,
+        confidence: float = 0.95,
+        seed: int = 0,
+        seed_env: str = "EZOPT_SEED",
+    ):
+        if max_runs < 1 or min_runs < 1:
+            raise ValueError(f"max_runs and min_runs must be positive: {max_runs=}, {min_runs=}")
+        if not 0.0 < confidence < 1.0:
+            raise ValueError(f"confidence must be in (0, 1): {confidence=}")
+        self.max_runs = max_runs
+        self.min_runs = min(min_runs, max_runs)
+        self.tolerance = tolerance
+        self.confidence = confidence
+        self.seed = seed
+        self.seed_env = seed_env
+        self._z = statistics.NormalDist().inv_cdf((1.0 + confidence) / 2.0)
+        self._lock = threading.Lock()
+        # 合併分散の計算に用いる，偏差平方和の合計と自由度の合計
+        self._pooled_sum_squares = 0.0
+        self._pooled_dof = 0
+
+    def env(self, k: int) -> dict[str, str]:
+        """
+        k 回目の実行に渡す環境変数
+        """
+        return {self.seed_env: str(self.seed + k)}
+
+    def half_width(self, values: list[float]) -> float:
+        """
+        values の平均の信頼区間の半幅（分散が推定できない場合は inf）
+        """
+        if len(values) >= 2:
+            variance = statistics.variance(values)
+        else:
+            with self._lock:
+                if self._pooled_dof == 0:
+                    return math.inf
+                variance = self._pooled_sum_squares / self._pooled_dof
+        return self._z * math.sqrt(variance / len(values))
+
+    def stop_reason(self, values: list[float], incumbent: float | None, maximize: bool) -> str | None:
+        """
+        これまでの評価値 values を見て，繰り返しを止めるならその理由 ("max_runs" / "worse" / "converged")，続けるなら None を返す
+        """
+        if len(values) >= self.max_runs:
+            return "max_runs"
+        mean = statistics.fmean(values)
+        half_width = self.half_width(values)
+        if incumbent is not None and (mean + half_width < incumbent if maximize else mean - half_width > incumbent):
+            return "worse"
+        if len(values) >= self.min_runs and half_width <= self.tolerance * abs(mean):
+            return "converged"
+        return None
+
+    def record(self, values: list[float]) -> None:
+        """
+        繰り返しを終えた候補の評価値を，合併分散の推定に加える
+        """
+        if len(values) < 2:
+            return
+        mean = statistics.fmean(values)
+        with self._lock:
+            self._pooled_sum_squares += sum((v - mean) ** 2 for v in values)
+            self._pooled_dof += len(values) - 1
+
+    def __repr__(self):
+        return (
+            f"TrialReplicator(max_runs={self.max_runs}, min_runs={self.min_runs}, tolerance={self.tolerance}, "
+            f"confidence={self.confidence}, seed={self.seed}, seed_env={self.seed_env})"
+        )
@@ -15,6 +15,15 @@ def compute_product(xs: list[int]) -> int:
     return ans
 
 
+def compute_quantile(xs: list[float], q: float) -> float:
+    # xs の q 分位点（隣り合う値の線形補間）
+    sorted_xs = sorted(xs)
+    position = q * (len(sorted_xs) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_xs) - 1)
+    return sorted_xs[lower] + (sorted_xs[upper] - sorted_xs[lower]) * (position - lower)
+
+
 def get_random_hex(n: int) -> str:
     # 16進数の乱数を生成する n 桁の
     return "".join(random.choices("0123456789abcdef", k=n))
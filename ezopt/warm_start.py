@@ -0,0 +1,135 @@
+
+
+import json
+from pathlib import Path
+import re
+from typing import Any
+
+from optuna.study import StudyDirection
+
+from ezopt.models import ChoiceType, HyperParameter, HyperParameterWithChoices, HyperParameterWithRange
+
+
+# C++ の数値リテラルの接尾辞（1.5f, 100LL, 10u など）
+NUMERIC_SUFFIX_PATTERN = re.compile(r"[uUlLfF]+$")
+
+
+class WarmStart:
+    """
+    最初に実行する試行たち（warm start）を，以前の知見から作るクラス
+    - ソースに書かれている元の値 (HyperParameter.original) の組
+    - 以前の study の stats.json のうち評価値が上位の試行
+    どちらも HP の名前で対応づけ，今の探索範囲・選択肢に写す（数値の選択肢は範囲内なら最も近いものに丸める）．
+    写せない HP は試行に含めず，その HP は sampler が選ぶ（一つも写せない試行は除く）
+    """
+    DEFAULT_SOURCE = "default"
+
+    def __init__(self, hps: list[HyperParameter]):
+        self.hps = hps
+        self.trials: list[tuple[dict[str, ChoiceType], str]] = []  # (HP の名前 → 値, 出どころ)
+        self._keys: set[str] = set()
+
+    def add(self, params: dict[str, ChoiceType], source: str) -> bool:
+        """
+        試行を追加する（空の場合や，既に追加した試行と同じ場合は追加せずに False を返す）
+        """
+        key = json.dumps(sorted(params.items()), ensure_ascii=False)
+        if len(params) == 0 or key in self._keys:
+            return False
+        self._keys.add(key)
+        self.trials.append((params, source))
+        return True
+
+    def add_default(self) -> int:
+        """
+        ソースに書かれている元の値の組を追加し，追加した試行の数を返す
+        """
+        params: dict[str, ChoiceType] = {}
+        for hp in self.hps:
+            try:
+                params[hp.name] = self.__class__.map_value(hp, self.__class__.parse_literal(hp.original))
+            except ValueError:
+                print(f"Warning: the original value ({hp.original}) of {hp.name} is outside its search space; it is left to the sampler")
+        return int(self.add(params, self.__class__.DEFAULT_SOURCE))
+
+    def add_prior_study(self, path: str | Path, top_k: int, direction: str) -> int:
+        """
+        以前の study の stats.json（または stats.json のある出力ディレクトリ）から，評価値が上位 top_k 個の試行を追加し，追加した試行の数を返す
+        NOTE: 上位かどうかはその study の方向で判断する（方向が記録されていない場合は direction）．制約を満たさない試行は除く
+        """
+        path = Path(path)
+        if path.is_dir():
+            path = path / "stats.json"
+        with open(path, "r") as f:
+            stats = json.load(f)
+        maximize = self.__class__._is_maximize(stats.get("direction"), direction)
+        records = [
+            record for record in stats.get("trials", [])
+            if record.get("value") is not None and record.get("feasible", True)
+        ]
+        records.sort(key=lambda record: record["value"], reverse=maximize)
+        n_added = 0
+        for record in records[:top_k]:
+            params: dict[str, ChoiceType] = {}
+            for hp in self.hps:
+                if hp.name not in record["params"]:
+                    continue
+                try:
+                    params[hp.name] = self.__class__.map_value(hp, record["params"][hp.name])
+                except ValueError:
+                    continue
+            n_added += int(self.add(params, str(path)))
+        return n_added
+
+    @staticmethod
+    def parse_literal(text: str) -> ChoiceType:
+        """
+        ソース上の値のテキスト（C++ のリテラル）を Python の値に変換する（解釈できない場合は ValueError）
+        """
+        text = text.strip()
+        if text in ("true", "false"):
+            return text == "true"
+        if len(text) >= 2 and text[0] == text[-1] == '"':
+            return text[1:-1]
+        number = NUMERIC_SUFFIX_PATTERN.sub("", text) if not text.lower().startswith("0x") else text
+        try:
+            return int(number, 0)
+        except ValueError:
+            return float(number)
+
+    @staticmethod
+    def map_value(hp: HyperParameter, value: Any) -> ChoiceType:
+        """
+        value を hp の探索範囲・選択肢に写したものを返す（範囲外・選択肢に無い場合は ValueError）
+        """
+        is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if isinstance(hp, HyperParameterWithRange):
+            if not is_number or not hp.low <= value <= hp.high:
+                raise ValueError(f"{value!r} is outside [{hp.low}, {hp.high}]")
+            return float(value)
+        elif isinstance(hp, HyperParameterWithChoices):
+            for choice in hp.choices:
+                # NOTE: True == 1 なので，bool とそれ以外は区別して比べる
+                if isinstance(choice, bool) == isinstance(value, bool) and type(choice) is not str and choice == value:
+                    return choice
+                if isinstance(choice, str) and choice == value:
+                    return choice
+            numeric_choices = [c for c in hp.choices if isinstance(c, (int, float)) and not isinstance(c, bool)]
+            if is_number and len(numeric_choices) > 0 and min(numeric_choices) <= value <= max(numeric_choices):  # type: ignore[type-var, operator]
+                return min(numeric_choices, key=lambda c: abs(c - value))  # type: ignore[operator]
+            raise ValueError(f"{value!r} is not in {hp.choices}")
+        else:
+            raise RuntimeError(f"Unsupported hyperparameter type: {hp}")
+
+    @staticmethod
+    def _is_maximize(recorded_direction: Any, direction: str) -> bool:
+        # NOTE: stats.json の direction は optuna の StudyDirection の値（1: minimize, 2: maximize）
+        if recorded_direction is None:
+            return direction == "maximize"
+        return recorded_direction == StudyDirection.MAXIMIZE
+
+    def __repr__(self):
+        sources: dict[str, int] = {}
+        for _, source in self.trials:
+            sources[source] = sources.get(source, 0) + 1
+        return f"WarmStart(n_trials={len(self.trials)}, sources={sources})"